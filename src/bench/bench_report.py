@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import openpyxl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "report"))
+# pylint: disable=wrong-import-position
+import process_report
+import warn_diff
+import warn_index
+import warn_store
+
+# Header cells the way EDD writes them, including the embedded newlines
+# and stray spaces that load_report() normalizes.
+SHEET_HEADERS = [
+    "Notice\nDate", "Effective \nDate", "Processed\nDate", "Company", "City",
+    "County/ Parish", "No. Of\nEmployees", "Layoff/\nClosure", "Address", "Related Industry"
+]
+COUNTIES = [
+    "Alameda County", "Los Angeles County", "Orange County", "Sacramento County",
+    "San Diego County", "San Francisco County", "San Mateo County", "Santa Clara County"
+]
+COMPANIES = [
+    "Acme Corp", "Google US-Mountain View", "Initech - Building 4", "Initech - Layoff 2",
+    "Globex", "Umbrella Inc.", "Hooli", "Soylent Green LLC", "Wonka Industries"
+]
+# The entry points of the Lambdas (the directory and the module), for
+# the import time check, and the modules neither should import when it
+# starts; they're imported when they're needed.
+ENTRY_POINTS = [("report", "process_report"), ("posts", "process_posts")]
+LAZY_MODULES = ["boto3", "botocore", "urllib3", "openpyxl", "numpy", "sqlite3"]
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Benchmark process_report.py against synthetic WARN act data"
+    )
+    parser.add_argument('--sizes',
+                        help="Comma separated numbers of rows to run the benchmarks with",
+                        default="10000,100000")
+    parser.add_argument('--new',
+                        help="Number of rows in the spreadsheet that aren't in the history yet",
+                        type=int,
+                        default=100)
+    parser.add_argument('--seed',
+                        help="Seed for the random number generator",
+                        type=int,
+                        default=42)
+    parser.add_argument('--json',
+                        help="Write the results to this file as JSON ('-' for stdout)")
+    parser.add_argument('--full-load',
+                        help="Also time loading the spreadsheet the way it used to be done",
+                        action='store_true')
+    parser.add_argument('--no-memory',
+                        help="Skip the (slow) tracemalloc runs for the peak memory use",
+                        action='store_true')
+    parser.add_argument('--import-budget',
+                        help="Fail if importing a Lambda entry point takes longer than this "
+                        "many milliseconds (the best of --import-runs)",
+                        type=float,
+                        default=100)
+    parser.add_argument('--import-runs',
+                        help="Number of times to import each entry point",
+                        type=int,
+                        default=5)
+    opts = parser.parse_args()
+    try:
+        opts.sizes = [int(size) for size in opts.sizes.split(",")]
+    except ValueError:
+        print(f"Invalid --sizes value: {opts.sizes}")
+        sys.exit(1)
+    if min(opts.sizes) <= opts.new:
+        print("Every size has to be bigger than --new.")
+        sys.exit(1)
+    return opts
+
+
+def synthetic_rows(count, seed):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2023, 1, 1)
+    for i in range(count):
+        notice = start + datetime.timedelta(days=i * 3 // 25)
+        yield [
+            notice,
+            notice + datetime.timedelta(days=60),
+            notice + datetime.timedelta(days=rnd.randint(0, 5)),
+            rnd.choice(COMPANIES),
+            f"City {rnd.randint(1, 200)}",
+            rnd.choice(COUNTIES),
+            rnd.randint(1, 500),
+            rnd.choice(["Layoff Permanent", "Closure Permanent", "Layoff Temporary"]),
+            f"{rnd.randint(1, 9999)} Main St",
+            "Information"
+        ]
+
+
+# summary.csv style rows (all strings, dates as YYYY-MM-DD) and headers
+def synthetic_history(count, seed):
+    csv_headers = [process_report.normalize_header(header) for header in SHEET_HEADERS]
+    rows = [[str(process_report.normalize_value(value)) for value in row]
+            for row in synthetic_rows(count, seed)]
+    return csv_headers, rows
+
+
+# Write a workbook shaped like the EDD one: a title row, the header row,
+# the data rows, and a "Report Summary" section at the bottom.
+def write_workbook(fname, count, seed):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Detailed WARN Report ")
+    sheet.append(["WARN Report"])
+    sheet.append(SHEET_HEADERS)
+    for row in synthetic_rows(count, seed):
+        sheet.append(row)
+    sheet.append([])
+    sheet.append([None, None, None, None, None, "Report Summary"])
+    workbook.save(fname)
+
+
+# Run func(setup()), once for the time and once more (unless --no-memory)
+# for the peak memory use, because tracemalloc slows things down
+# considerably. Anything func prints is discarded. Returns the result,
+# which is also added to results.
+def measure(opts, results, size, label, func, setup=lambda: None):
+    with open(os.devnull, 'w', encoding="utf-8") as devnull:
+        arg = setup()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            rows = func(arg)
+        elapsed = time.perf_counter() - start
+        peak = None
+        if not opts.no_memory:
+            arg = setup()
+            tracemalloc.start()
+            with contextlib.redirect_stdout(devnull):
+                func(arg)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    result = {
+        'size': size,
+        'stage': label,
+        'rows': rows,
+        'seconds': round(elapsed, 6),
+        'us_per_row': round(elapsed / rows * 1e6, 3) if rows else None,
+        'peak_mb': round(peak / 1048576, 3) if peak is not None else None
+    }
+    results.append(result)
+    per_row = f"{result['us_per_row']:8.2f}us/row" if rows else " " * 14
+    memory = f"{result['peak_mb']:8.1f}MB peak" if peak is not None else ""
+    print(f"{label:24s}: {rows:8d} rows {elapsed:8.3f}s {per_row} {memory}")
+    return result
+
+
+# Import module in a fresh interpreter with -X importtime, runs times.
+# Returns the best cumulative import time (in ms), and the names of all
+# the modules it imported.
+def import_time(directory, module, runs):
+    best = None
+    imported = set()
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                cwd=directory, capture_output=True, text=True, check=True)
+        for line in result.stderr.splitlines():
+            # import time: <self us> | <cumulative us> | <module, indented>
+            fields = line.split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            name = fields[2].strip()
+            imported.add(name)
+            if name == module:
+                elapsed = int(fields[1]) / 1000
+                best = elapsed if best is None else min(best, elapsed)
+    return best, imported
+
+
+# How long it takes to import the entry points of the Lambdas, which is
+# most of what a cold start costs before the handler even runs. Returns
+# False if any of them is over the budget, or imports one of the
+# LAZY_MODULES.
+def bench_imports(opts, results):
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    within = True
+    for directory, module in ENTRY_POINTS:
+        elapsed, imported = import_time(os.path.join(src, directory), module, opts.import_runs)
+        eager = sorted(name for name in imported
+                       if name.split(".")[0] in LAZY_MODULES and "." not in name)
+        results.append({'module': module, 'ms': round(elapsed, 3), 'eager': eager})
+        print(f"import {module:18s}: {elapsed:8.1f}ms (budget {opts.import_budget:.0f}ms)")
+        if elapsed > opts.import_budget:
+            print(f"Importing {module} takes longer than the budget.")
+            within = False
+        if eager:
+            print(f"{module} imports {', '.join(eager)} when it starts.")
+            within = False
+    return within
+
+
+# The way load_report() used to work: load every cell of the workbook
+# and then look up the cells one at a time.
+def full_load(fname):
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        workbook = openpyxl.load_workbook(filename=fname, data_only=True)
+    o_sheet = workbook["Detailed WARN Report "]
+    columns = len(SHEET_HEADERS)
+    count = 0
+    for row in range(o_sheet.max_row - 2):
+        county = o_sheet.cell(row=row+3, column=6).value
+        if not county or county == "Report Summary":
+            break
+        for col in range(columns):
+            process_report.normalize_value(o_sheet.cell(row=row+3, column=col+1).value)
+        count += 1
+    return count
+
+
+def report_options(fname, cache=None):
+    return argparse.Namespace(excel=fname, debug=False, no_cache=cache is None,
+                              cache_dir=cache, cache_keep=1,
+                              state=process_report.CaliforniaAdapter())
+
+
+def streaming_load(fname):
+    _, _, report_rows = process_report.load_report(report_options(fname))
+    return sum(1 for _ in report_rows)
+
+
+def cached_load(fname, cache):
+    _, _, report_rows = process_report.load_report(report_options(fname, cache))
+    return sum(1 for _ in report_rows)
+
+
+def history_options(directory):
+    return argparse.Namespace(summary=os.path.join(directory, "summary.csv"), debug=False,
+                              verbose=False, post=False, search="Hooli", contains=None,
+                              county="Alameda County", city=None, since=None, until=None,
+                              min_employees=None, db=None)
+
+
+# Write the history the way do_update() leaves it: the base segment,
+# the manifest, and (unless indexed is False) the digest index.
+def write_history(directory, csv_headers, rows, indexed=True):
+    os.makedirs(directory)
+    opts = history_options(directory)
+    manifest = {'headers': csv_headers, 'segments': []}
+    warn_store.add_segment(opts, manifest, csv_headers, rows)
+    warn_store.save_manifest(opts, manifest)
+    if indexed:
+        natural_key = warn_diff.key_function(
+            csv_headers, process_report.company_normalizer(process_report.COMPANY_NORMALIZATION))
+        warn_index.write_digest_index(warn_index.index_name(opts), warn_store.signature(manifest),
+                                      [(warn_index.row_digest(row), natural_key(row))
+                                       for row in rows])
+
+
+# A scratch copy of a history, for a stage that changes it
+def scratch_history(source, tmpdir):
+    directory = os.path.join(tmpdir, "scratch")
+    shutil.rmtree(directory, ignore_errors=True)
+    shutil.copytree(source, directory)
+    return history_options(directory)
+
+
+def update(opts, report):
+    headers, useful_columns, report_rows = report
+    process_report.do_update(opts, headers, useful_columns, iter(report_rows))
+    return len(report_rows)
+
+
+# What process_report.py --update does, from the spreadsheet to the
+# new segment.
+def update_end_to_end(opts, fname, size):
+    headers, useful_columns, report_rows = process_report.load_report(report_options(fname))
+    process_report.do_update(opts, headers, useful_columns, report_rows)
+    return size
+
+
+# The whole history in memory, as the lists of strings the CSV reader
+# returns, or as records (see warn_record)
+def history_lists(opts):
+    rows = [row for _offset, row in warn_store.iter_rows(opts, warn_store.load_manifest(opts))]
+    return len(rows)
+
+
+def history_records(opts):
+    rows = list(warn_store.read_history(opts, warn_store.load_manifest(opts)))
+    return len(rows)
+
+
+# Per-row cost of turning the history into (grouped) thread entries
+def grouping(rows, csv_headers):
+    for _ in process_report.group_entries(rows, csv_headers):
+        pass
+    return len(rows)
+
+
+def dumping(rows, csv_headers):
+    process_report.dump_entries(rows, csv_headers)
+    return len(rows)
+
+
+# Returns the number of rows searched (all of the history, counted
+# beforehand, so that it isn't part of the time), not found
+def search(opts, history_size):
+    process_report.do_search(opts)
+    return history_size
+
+
+# All of the stages for one size: a spreadsheet with size rows, and a
+# history with all but the last opts.new of them.
+def bench_size(opts, results, size, tmpdir):
+    fname = os.path.join(tmpdir, "warn_report.xlsx")
+    write_workbook(fname, size, opts.seed)
+    csv_headers, rows = synthetic_history(size - opts.new, opts.seed)
+    indexed = os.path.join(tmpdir, "indexed")
+    write_history(indexed, csv_headers, rows)
+    unindexed = os.path.join(tmpdir, "unindexed")
+    write_history(unindexed, csv_headers, rows, indexed=False)
+    print(f"Synthetic workbook: {size} rows, {os.path.getsize(fname)} bytes; "
+          f"history: {len(rows)} rows")
+
+    if opts.full_load:
+        measure(opts, results, size, "full load", lambda _: full_load(fname))
+    measure(opts, results, size, "load_report", lambda _: streaming_load(fname))
+    cache = os.path.join(tmpdir, "cache")
+    # The first one fills the cache
+    cached_load(fname, cache)
+    measure(opts, results, size, "load_report cached", lambda _: cached_load(fname, cache))
+
+    headers, useful_columns, report_rows = process_report.load_report(report_options(fname))
+    report = (headers, useful_columns, list(report_rows))
+    measure(opts, results, size, "do_update", lambda arg: update(arg, report),
+            lambda: scratch_history(indexed, tmpdir))
+    measure(opts, results, size, "do_update rebuild", lambda arg: update(arg, report),
+            lambda: scratch_history(unindexed, tmpdir))
+    measure(opts, results, size, "update end to end",
+            lambda arg: update_end_to_end(arg, fname, size),
+            lambda: scratch_history(indexed, tmpdir))
+
+    history = history_options(indexed)
+    measure(opts, results, size, "history lists", lambda _: history_lists(history))
+    measure(opts, results, size, "history records", lambda _: history_records(history))
+
+    measure(opts, results, size, "group_entries",
+            lambda _: grouping(rows, csv_headers))
+    records = list(warn_store.read_history(history, warn_store.load_manifest(history)))
+    measure(opts, results, size, "group_entries records",
+            lambda _: grouping(records, csv_headers))
+    measure(opts, results, size, "dump_entries",
+            lambda _: dumping(rows, csv_headers))
+
+    # The first search builds the search index, the ones after that use it
+    measure(opts, results, size, "do_search build", lambda arg: search(arg, len(rows)),
+            lambda: scratch_history(indexed, tmpdir))
+    searched = scratch_history(indexed, tmpdir)
+    with open(os.devnull, 'w', encoding="utf-8") as devnull, contextlib.redirect_stdout(devnull):
+        search(searched, len(rows))
+    measure(opts, results, size, "do_search", lambda arg: search(arg, len(rows)),
+            lambda: searched)
+
+
+def main():
+    opts = parse_options()
+    imports = []
+    within = bench_imports(opts, imports)
+    results = []
+    for size in opts.sizes:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            bench_size(opts, results, size, tmpdir)
+    if opts.json:
+        report = {
+            'python': platform.python_version(),
+            'openpyxl': openpyxl.__version__,
+            'seed': opts.seed,
+            'new': opts.new,
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'imports': imports,
+            'results': results
+        }
+        if opts.json == "-":
+            print(json.dumps(report, indent=1))
+        else:
+            with open(opts.json, 'w', encoding="utf-8") as outfile:
+                json.dump(report, outfile, indent=1)
+    if not within:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+import mock_mastodon
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "report"))
+# pylint: disable=wrong-import-position
+import warn_metrics
+import warn_post
+
+# Post a thread with warn_post.send_to_api() (process_report.py --post
+# --token ...) to mock_mastodon.py, with failures and a rate limit low
+# enough to run into, and check that every item got posted once, each
+# in reply to the one before it. Then post it again, as a rerun after a
+# failure would, and check that the Idempotency-Key kept that from
+# posting anything twice. Exits with an error if any of that fails.
+#
+# This runs in real time: keep --statuses and --window small, and
+# --backoff (the base of the exponential backoff) short.
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Check the posting to Mastodon against the mock server"
+    )
+    parser.add_argument('--statuses',
+                        help="Number of statuses in the thread",
+                        type=int,
+                        default=30)
+    parser.add_argument('--limit',
+                        help="Mastodon rate limit: requests per window",
+                        type=int,
+                        default=10)
+    parser.add_argument('--window',
+                        help="Mastodon rate limit window, in seconds",
+                        type=float,
+                        default=3)
+    parser.add_argument('--fail-rate',
+                        help="Fraction of the Mastodon requests to fail with a 503",
+                        type=float,
+                        default=0.2)
+    parser.add_argument('--pacing',
+                        help="Seconds between the posts (--pacing of process_report.py)",
+                        type=float,
+                        default=0)
+    parser.add_argument('--backoff',
+                        help="Base of the exponential backoff of the retries, in seconds",
+                        type=float,
+                        default=0.1)
+    parser.add_argument('--seed',
+                        help="Seed for the random number generators",
+                        type=int,
+                        default=42)
+    parser.add_argument('-v', '--verbose',
+                        help="Show the output of the posting",
+                        action='store_true')
+    return parser.parse_args()
+
+
+def post_thread(opts, post_opts, statuses):
+    output = io.StringIO()
+    start = time.monotonic()
+    with contextlib.redirect_stdout(sys.stdout if opts.verbose else output):
+        warn_post.send_to_api(post_opts, statuses)
+    return time.monotonic() - start
+
+
+# Returns what's wrong with the statuses the server has, if anything
+def check_thread(posted, statuses):
+    if len(posted) != len(statuses):
+        return f"{len(posted)} statuses posted for {len(statuses)} items"
+    for i, (status, content) in enumerate(zip(posted, statuses)):
+        if status['content'] != content:
+            return f"status {status['id']} is not item {i + 1}"
+        parent = posted[i - 1]['id'] if i > 0 else None
+        if status['in_reply_to_id'] != parent:
+            return f"status {status['id']} replies to {status['in_reply_to_id']}, not {parent}"
+    return None
+
+
+def main():
+    opts = parse_options()
+    random.seed(opts.seed)
+    warn_post.BACKOFF = opts.backoff
+    warn_metrics.reset()
+    mastodon = mock_mastodon.MockMastodon(("localhost", 0), opts.limit, opts.window,
+                                          opts.fail_rate, opts.seed)
+    threading.Thread(target=mastodon.serve_forever, daemon=True).start()
+    post_opts = types.SimpleNamespace(server=f"http://localhost:{mastodon.server_address[1]}",
+                                      token="check", pacing=opts.pacing)
+    statuses = [f"Item {i + 1} of {opts.statuses}" for i in range(opts.statuses)]
+
+    problems = []
+    try:
+        seconds = post_thread(opts, post_opts, statuses)
+    except SystemExit:
+        problems.append("send_to_api() gave up")
+        seconds = None
+    problem = check_thread(mastodon.statuses, statuses)
+    if problem:
+        problems.append(problem)
+    requests = mastodon.requests
+
+    # Again, as if rerun after a failure: nothing new gets posted
+    try:
+        post_thread(opts, post_opts, statuses)
+    except SystemExit:
+        problems.append("send_to_api() gave up the second time")
+    if len(mastodon.statuses) != len(statuses):
+        problems.append(f"{len(mastodon.statuses) - len(statuses)} statuses posted twice")
+    mastodon.shutdown()
+
+    counts = warn_metrics.METRICS['counts']
+    print(f"statuses : {len(mastodon.statuses)} of {len(statuses)}")
+    print(f"requests : {requests} ({counts.get('retries', 0)} retries over both runs)")
+    if seconds is not None:
+        print(f"seconds  : {seconds:.3f}")
+    for problem in problems:
+        print(f"FAILED: {problem}")
+    if problems:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+#!/usr/bin/env python3
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from botocore.exceptions import ClientError
+from botocore.response import StreamingBody
+import urllib3
+
+import bench_report
+import mock_mastodon
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "posts"))
+# pylint: disable=wrong-import-position
+import process_report
+import warn_post
+import warn_resources
+
+# Run the whole chain offline: report_handler() against a replayed day
+# of notices, then posts_handler() for every message it (and then each
+# posts Lambda) sends to SQS, until the event source mapping gets
+# disabled. With --fanout, more threads (standing in for other states)
+# are posted along with the day's one. S3, SQS, SSM and the Lambda API
+# are in-process stand-ins, handed to both Lambdas through their
+# RESOURCES, and the statuses go to mock_mastodon.py.
+#
+# SQS goes by a simulated clock: DelaySeconds and the visibility timeout
+# (with messages that fail going to the dead letter queue after
+# MAX_RECEIVE receives, like the posts queue) are simulated time, as
+# are the pauses of the posts Lambda itself, and --speedup compresses all
+# of those in real time (0 skips them). The work the Lambdas do takes
+# the time it takes. What comes out is the simulated duration of every
+# invocation, and so the Lambda-seconds and throughput of the day.
+#
+# The report Lambda works in a temporary directory of its own (see
+# process_report.LAMBDA_TMP) rather than in /tmp, which may hold real
+# data. It starts out empty, as a cold start would find /tmp.
+S3_NAME = "warn"
+SQS_URL = "https://sqs.local/posts"
+ESM_UUID = "posts-esm"
+# As in terraform/basis.tf and terraform/lambda.tf
+POSTS_TIMEOUT = 30
+VISIBILITY_TIMEOUT = 6 * POSTS_TIMEOUT
+MAX_RECEIVE = 1
+THREADS = f"s3://{S3_NAME}/threads"
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Replay a day of WARN act notices through both Lambdas, offline"
+    )
+    parser.add_argument('--notices',
+                        help="Number of new notices in the day's spreadsheet",
+                        type=int,
+                        default=200)
+    parser.add_argument('--history',
+                        help="Number of notices already in the history",
+                        type=int,
+                        default=10000)
+    parser.add_argument('--seed',
+                        help="Seed for the random number generator",
+                        type=int,
+                        default=42)
+    parser.add_argument('--speedup',
+                        help="How much faster than real time simulated time passes "
+                        "(0: as fast as possible)",
+                        type=float,
+                        default=100)
+    parser.add_argument('--fanout',
+                        help="Number of threads to post at the same time: the day's one, "
+                        "and shorter copies of it",
+                        type=int,
+                        default=1)
+    parser.add_argument('--esm-batch',
+                        help="Batch size of the event source mapping: how many messages "
+                        "one posts Lambda invocation gets at most",
+                        type=int,
+                        default=10)
+    parser.add_argument('--stale-marker',
+                        help="Leave the active marker of an earlier thread that failed "
+                        "in S3, which must not keep the event source mapping enabled",
+                        action='store_true')
+    parser.add_argument('--batch',
+                        help="Run the posts Lambda with POST_BATCH",
+                        action='store_true')
+    parser.add_argument('--pacing',
+                        help="POST_PACING for the posts Lambda, in seconds",
+                        type=float,
+                        default=1)
+    parser.add_argument('--db',
+                        help="Run the report Lambda with HISTORY_BACKEND=sqlite",
+                        action='store_true')
+    parser.add_argument('--limit',
+                        help="Mastodon rate limit: requests per window",
+                        type=int,
+                        default=300)
+    parser.add_argument('--window',
+                        help="Mastodon rate limit window, in (simulated) seconds",
+                        type=float,
+                        default=300)
+    parser.add_argument('--fail-rate',
+                        help="Fraction of the Mastodon requests to fail with a 503",
+                        type=float,
+                        default=0)
+    parser.add_argument('--visibility-timeout',
+                        help="Visibility timeout of the posts queue, in (simulated) seconds",
+                        type=float,
+                        default=VISIBILITY_TIMEOUT)
+    parser.add_argument('--max-invocations',
+                        help="Give up after this many posts Lambda invocations",
+                        type=int,
+                        default=10000)
+    parser.add_argument('--json',
+                        help="Write the results to this file as JSON ('-' for stdout)")
+    parser.add_argument('-v', '--verbose',
+                        help="Show the output of the Lambdas",
+                        action='store_true')
+    return parser.parse_args()
+
+
+class Clock:
+    def __init__(self, speedup):
+        self.speedup = speedup
+        # How far simulated time is ahead of real time
+        self.offset = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return time.time() + self.offset
+
+    def monotonic(self):
+        return time.monotonic() + self.offset
+
+    # When more than one thread sleeps at the same time, simulated time
+    # only moves ahead as far as the one that sleeps the longest.
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        until = self.monotonic() + seconds
+        time.sleep(seconds / self.speedup if self.speedup else 0)
+        with self.lock:
+            self.offset = max(self.offset, until - time.monotonic())
+
+
+# Stands in for the time module in process_posts, so that its pauses
+# and its idea of the time go by the simulated clock
+class SimulatedTime:
+    def __init__(self, clock):
+        self.clock = clock
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        self.clock.sleep(seconds)
+
+    def monotonic(self):
+        return self.clock.monotonic()
+
+    def time(self):
+        return self.clock.time()
+
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+
+    def download_file(self, bucket, key, fname):
+        if (bucket, key) not in self.objects:
+            raise ClientError({'Error': {'Code': "404", 'Message': "Not Found"}}, "HeadObject")
+        with open(fname, 'wb') as outfile:
+            outfile.write(self.objects[(bucket, key)])
+
+    def upload_file(self, fname, bucket, key):
+        with open(fname, 'rb') as infile:
+            self.objects[(bucket, key)] = infile.read()
+
+    def put_object(self, Bucket, Key, Body, **_kwargs): # pylint: disable=invalid-name
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key): # pylint: disable=invalid-name
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': "NoSuchKey", 'Message': "Not Found"}},
+                              "GetObject")
+        data = self.objects[(Bucket, Key)]
+        return {'Body': StreamingBody(io.BytesIO(data), len(data))}
+
+    def delete_object(self, Bucket, Key): # pylint: disable=invalid-name
+        self.objects.pop((Bucket, Key), None)
+
+    def list_objects_v2(self, Bucket, Prefix): # pylint: disable=invalid-name
+        keys = sorted(key for bucket, key in list(self.objects)
+                      if bucket == Bucket and key.startswith(Prefix))
+        return {'Contents': [{'Key': key} for key in keys]} if keys else {}
+
+
+class FakeSQS:
+    def __init__(self, clock, visibility_timeout):
+        self.clock = clock
+        self.visibility_timeout = visibility_timeout
+        self.messages = []
+        self.dead = []
+        self.sent = 0
+
+    # pylint: disable-next=invalid-name
+    def send_message(self, QueueUrl, MessageBody, MessageAttributes=None, DelaySeconds=0):
+        self.sent += 1
+        message = {
+            'messageId': f"message-{self.sent}",
+            'queue': QueueUrl,
+            'body': MessageBody,
+            'messageAttributes': {
+                name: {'dataType': value['DataType'], 'stringValue': value['StringValue']}
+                for name, value in (MessageAttributes or {}).items()
+            },
+            'visible_at': self.clock.monotonic() + DelaySeconds,
+            'receives': 0
+        }
+        self.messages.append(message)
+        return {'MessageId': message['messageId']}
+
+    # What the event source mapping gets when it polls: up to count
+    # visible messages, which stay invisible for the visibility timeout
+    def receive(self, count):
+        now = self.clock.monotonic()
+        received = []
+        for message in self.messages:
+            if message['visible_at'] <= now and len(received) < count:
+                message['receives'] += 1
+                message['visible_at'] = now + self.visibility_timeout
+                received.append(message)
+        return received
+
+    def delete(self, message):
+        self.messages.remove(message)
+
+    # A failed invocation: the message comes back after the visibility
+    # timeout, or goes to the dead letter queue
+    def failed(self, message):
+        if message['receives'] >= MAX_RECEIVE:
+            self.messages.remove(message)
+            self.dead.append(message)
+
+    # The visibility timeout ran out while an invocation still had the
+    # message, so the event source mapping receives it again (or it goes
+    # to the dead letter queue), however that invocation ends
+    def redelivered(self, message):
+        if message['receives'] >= MAX_RECEIVE:
+            self.messages.remove(message)
+            self.dead.append(message)
+
+    def next_visible(self):
+        return min((message['visible_at'] for message in self.messages), default=None)
+
+
+class FakeLambda:
+    def __init__(self):
+        self.enabled = False
+        self.toggles = 0
+
+    def mapping(self, uuid):
+        return {'UUID': uuid, 'State': "Enabled" if self.enabled else "Disabled"}
+
+    def update_event_source_mapping(self, UUID, Enabled): # pylint: disable=invalid-name
+        self.enabled = Enabled
+        self.toggles += 1
+        return self.mapping(UUID)
+
+    def get_event_source_mapping(self, UUID): # pylint: disable=invalid-name
+        return self.mapping(UUID)
+
+
+class FakeSSM:
+    def __init__(self, parameters):
+        self.parameters = parameters
+
+    def get_parameter(self, Name, WithDecryption=False): # pylint: disable=invalid-name,unused-argument
+        return {'Parameter': {'Name': Name, 'Value': self.parameters[Name]}}
+
+
+# The HTTP connection pool of both Lambdas: the spreadsheet comes from
+# memory, and the Mastodon requests go to the mock server (over plain
+# HTTP).
+class LocalHttp:
+    def __init__(self, url, spreadsheet):
+        self.url = url
+        self.spreadsheet = spreadsheet
+        self.etag = f'"{hashlib.sha256(spreadsheet).hexdigest()}"'
+        self.pool = urllib3.PoolManager()
+
+    def request(self, method, url, headers=None, **kwargs):
+        if url == self.url:
+            if (headers or {}).get('If-None-Match') == self.etag:
+                return types.SimpleNamespace(status=304, headers={}, data=b"")
+            return types.SimpleNamespace(status=200, data=self.spreadsheet, encoding=None,
+                                         headers={'content-type': process_report.XLSX_TYPE,
+                                                  'etag': self.etag})
+        return self.pool.request(method, url.replace("https://", "http://", 1),
+                                 headers=headers, **kwargs)
+
+
+class LambdaContext:
+    def __init__(self, clock, timeout):
+        self.clock = clock
+        self.deadline = clock.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0.0, self.deadline - self.clock.monotonic()) * 1000)
+
+
+# The day's spreadsheet (the history plus opts.notices new notices), and
+# the history in S3 as an earlier report run would have left it.
+def replay_day(opts, s3_client, tmpdir):
+    fname = os.path.join(tmpdir, "warn_report.xlsx")
+    bench_report.write_workbook(fname, opts.history + opts.notices, opts.seed)
+    csv_headers, rows = bench_report.synthetic_history(opts.history, opts.seed)
+    directory = os.path.join(tmpdir, "history")
+    bench_report.write_history(directory, csv_headers, rows)
+    for name in os.listdir(directory):
+        s3_client.upload_file(os.path.join(directory, name), S3_NAME, f"CA/{name}")
+    with open(fname, 'rb') as infile:
+        return infile.read()
+
+
+# Run a handler, timing it on the simulated clock. Returns the duration
+# and whether it succeeded.
+def invoke(opts, clock, handler, *args):
+    start = clock.monotonic()
+    succeeded = True
+    with open(os.devnull, 'w', encoding="utf-8") as devnull, \
+         contextlib.redirect_stdout(sys.stdout if opts.verbose else devnull):
+        try:
+            handler(*args)
+        except (Exception, SystemExit) as error: # pylint: disable=broad-except
+            print(f"Invocation failed: {error!r}", file=sys.stderr)
+            succeeded = False
+    return clock.monotonic() - start, succeeded
+
+
+# Post the day's thread again, as opts.fanout - 1 more threads, the way
+# the report Lambda would for other states. They're shorter (the first
+# part of it), so they're done first, and the mapping has to stay
+# enabled for the rest. Returns the number of statuses in all of them.
+def fan_out(opts, s3_client, sqs):
+    run_id = sqs.messages[0]['messageAttributes']['run_id']['stringValue']
+    prefix = f"{THREADS[5:].partition('/')[2]}/{run_id}/"
+    keys = s3_client.list_objects_v2(Bucket=S3_NAME, Prefix=prefix)['Contents']
+    statuses = [s3_client.objects[(S3_NAME, entry['Key'])].decode("utf-8") for entry in keys]
+    thread_opts = types.SimpleNamespace(threads=THREADS, sqs=SQS_URL, debug=False,
+                                        state=process_report.CaliforniaAdapter())
+    total = len(statuses)
+    for number in range(1, opts.fanout):
+        size = max(1, len(statuses) * number // opts.fanout)
+        warn_post.send_to_sqs(thread_opts, statuses[:size])
+        total += size
+    return total
+
+
+# What the event source mapping does for as long as it's enabled: hand
+# the messages that become visible to the posts Lambda, up to
+# opts.esm_batch at a time. The invocations run one after another, but
+# a message that became visible again before the invocation that got
+# it was done is received again, as it would have been by another
+# invocation in the meantime.
+def drain_queue(opts, clock, sqs, esm, posts_handler):
+    invocations = []
+    while esm.enabled and len(invocations) < opts.max_invocations:
+        messages = sqs.receive(opts.esm_batch)
+        if not messages:
+            next_visible = sqs.next_visible()
+            if next_visible is None:
+                break
+            clock.sleep(next_visible - clock.monotonic())
+            continue
+        event = {'Records': messages}
+        duration, succeeded = invoke(opts, clock, posts_handler, event,
+                                     LambdaContext(clock, POSTS_TIMEOUT))
+        now = clock.monotonic()
+        redelivered = 0
+        for message in messages:
+            if message['visible_at'] <= now:
+                sqs.redelivered(message)
+                redelivered += 1
+            elif succeeded:
+                sqs.delete(message)
+            else:
+                sqs.failed(message)
+        invocations.append({'seconds': duration, 'succeeded': succeeded,
+                            'records': len(messages), 'redelivered': redelivered})
+    return invocations
+
+
+# Does every status reply to the one before it in its thread? The first
+# one of every thread replies to nothing, and every other one to a
+# status posted before it that nothing else replies to.
+def chains_intact(statuses, threads):
+    posted = set()
+    replied = set()
+    first = 0
+    for status in statuses:
+        parent = status['in_reply_to_id']
+        if parent is None:
+            first += 1
+        elif parent not in posted or parent in replied:
+            return False
+        replied.add(parent)
+        posted.add(status['id'])
+    return first == threads
+
+
+def print_results(results):
+    width = max(len(name) for name in results)
+    for name, value in results.items():
+        print(f"{name:{width}s} : {value}")
+
+
+def main():
+    opts = parse_options()
+    os.environ.update({
+        'S3_NAME': S3_NAME, 'SQS_URL': SQS_URL, 'ESM_UUID': ESM_UUID, 'STATES': "CA",
+        'HISTORY_BACKEND': "sqlite" if opts.db else "csv",
+        'POST_BATCH': "true" if opts.batch else "false", 'POST_PACING': str(opts.pacing)
+    })
+    # It reads POST_BATCH and POST_PACING when it's imported
+    import process_posts # pylint: disable=import-outside-toplevel
+
+    clock = Clock(opts.speedup)
+    process_posts.time = SimulatedTime(clock)
+    mastodon = mock_mastodon.MockMastodon(("localhost", 0), opts.limit, opts.window,
+                                          opts.fail_rate, opts.seed, clock.time)
+    threading.Thread(target=mastodon.serve_forever, daemon=True).start()
+
+    s3_client = FakeS3()
+    sqs = FakeSQS(clock, opts.visibility_timeout)
+    esm = FakeLambda()
+    ssm = FakeSSM({'/WARN/api_server': f"localhost:{mastodon.server_address[1]}",
+                   '/WARN/api_token': "emulated"})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        process_report.LAMBDA_TMP = tempfile.mkdtemp(dir=tmpdir)
+        spreadsheet = replay_day(opts, s3_client, tmpdir)
+        if opts.stale_marker:
+            prefix = THREADS[5:].partition('/')[2]
+            s3_client.put_object(Bucket=S3_NAME,
+                                 Key=warn_post.active_marker_key(prefix, "CA-failed"),
+                                 Body=f"{clock.time() - 1:.0f}".encode("utf-8"))
+        http = LocalHttp(process_report.CaliforniaAdapter.url, spreadsheet)
+        for resources in [warn_resources.RESOURCES, process_posts.RESOURCES]:
+            resources.update({'s3': s3_client, 'sqs': sqs, 'lambda': esm, 'ssm': ssm,
+                              'http': http})
+
+        cwd = os.getcwd()
+        argv = sys.argv
+        # report_handler() parses the (empty) command line of a Lambda
+        sys.argv = argv[:1]
+        wall_start = time.monotonic()
+        sim_start = clock.monotonic()
+        try:
+            report_seconds, report_ok = invoke(opts, clock, process_report.report_handler,
+                                               {}, None)
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+        with open(os.devnull, 'w', encoding="utf-8") as devnull, \
+             contextlib.redirect_stdout(sys.stdout if opts.verbose else devnull):
+            expected = fan_out(opts, s3_client, sqs) if report_ok else 0
+        invocations = drain_queue(opts, clock, sqs, esm, process_posts.posts_handler)
+        sim_seconds = clock.monotonic() - sim_start
+        wall_seconds = time.monotonic() - wall_start
+    mastodon.shutdown()
+
+    posted = len(mastodon.statuses)
+    lambda_seconds = report_seconds + sum(entry['seconds'] for entry in invocations)
+    results = {
+        'notices': opts.notices,
+        'report_ok': report_ok,
+        'report_seconds': round(report_seconds, 3),
+        'threads': opts.fanout,
+        'posts_invocations': len(invocations),
+        'max_records': max((entry['records'] for entry in invocations), default=0),
+        'posts_failures': sum(1 for entry in invocations if not entry['succeeded']),
+        'posts_max_seconds': round(max((entry['seconds'] for entry in invocations),
+                                       default=0), 3),
+        'statuses_posted': posted,
+        'statuses_expected': expected,
+        'mastodon_requests': mastodon.requests,
+        'chain_intact': chains_intact(mastodon.statuses, opts.fanout),
+        'redeliveries': sum(entry['redelivered'] for entry in invocations),
+        'messages_left': len(sqs.messages),
+        'dead_letters': len(sqs.dead),
+        'esm_enabled': esm.enabled,
+        'esm_toggles': esm.toggles,
+        'lambda_seconds': round(lambda_seconds, 3),
+        'simulated_seconds': round(sim_seconds, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        'statuses_per_minute': round(posted / sim_seconds * 60, 2) if sim_seconds else None
+    }
+    print_results(results)
+    if opts.json:
+        if opts.json == "-":
+            print(json.dumps(results, indent=1))
+        else:
+            with open(opts.json, 'w', encoding="utf-8") as outfile:
+                json.dump(results, outfile, indent=1)
+    if (not report_ok or results['dead_letters'] or results['messages_left'] or
+            results['redeliveries']):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import argparse
+import datetime
+import email.parser
+import http.server
+import json
+import random
+import threading
+import time
+
+# Just enough of the Mastodon API (POST /api/v1/statuses) to try
+# process_report.py --post --token ... against, without posting anything
+# for real: rate limit headers, 429 once they run out, Idempotency-Key
+# handling, and (optionally) random 5xx failures. Point --server at it:
+#
+#   mock_mastodon.py --port 8000 &
+#   process_report.py --update --post --token x --server http://localhost:8000
+
+
+def parse_options():
+    parser = argparse.ArgumentParser(
+        description="Mock Mastodon server for trying out the posting code"
+    )
+    parser.add_argument('--port',
+                        help="Port to listen on",
+                        type=int,
+                        default=8000)
+    parser.add_argument('--limit',
+                        help="Number of requests allowed per rate limit window",
+                        type=int,
+                        default=300)
+    parser.add_argument('--window',
+                        help="Length of the rate limit window, in seconds",
+                        type=float,
+                        default=300)
+    parser.add_argument('--fail-rate',
+                        help="Fraction of the requests to fail with a 503",
+                        type=float,
+                        default=0)
+    parser.add_argument('--seed',
+                        help="Seed for the random number generator",
+                        type=int,
+                        default=42)
+    return parser.parse_args()
+
+
+class MockMastodon(http.server.ThreadingHTTPServer):
+    # clock is what the rate limit windows go by (emulate_lambdas.py
+    # passes its simulated one)
+    def __init__(self, address, limit=300, window=300, fail_rate=0, seed=42, clock=time.time):
+        super().__init__(address, MockHandler)
+        self.clock = clock
+        self.limit = limit
+        self.window = window
+        self.fail_rate = fail_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = clock()
+        self.used = 0
+        # The statuses posted, and the ones seen per Idempotency-Key
+        self.statuses = []
+        self.keys = {}
+        self.requests = 0
+
+    # Returns the number of requests left in this window, and when it
+    # ends, after counting this one.
+    def rate_limit(self):
+        now = self.clock()
+        if now - self.window_start >= self.window:
+            self.window_start = now
+            self.used = 0
+        self.used += 1
+        return self.limit - self.used, self.window_start + self.window
+
+
+class MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and the body go out separately; without this every
+    # response waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+    def reply(self, status, body, remaining, reset):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-RateLimit-Limit", str(self.server.limit))
+        self.send_header("X-RateLimit-Remaining", str(max(0, remaining)))
+        reset_at = datetime.datetime.fromtimestamp(reset, datetime.timezone.utc)
+        self.send_header("X-RateLimit-Reset", reset_at.isoformat(timespec='milliseconds'))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        message = email.parser.BytesParser().parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + data)
+        fields = {}
+        if message.is_multipart():
+            for part in message.get_payload():
+                name = part.get_param('name', header='content-disposition')
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+        return fields
+
+    def do_POST(self): # pylint: disable=invalid-name
+        fields = self.form()
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            remaining, reset = server.rate_limit()
+            if self.path != "/api/v1/statuses":
+                self.reply(404, {'error': "Record not found"}, remaining, reset)
+                return
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                self.reply(401, {'error': "The access token is invalid"}, remaining, reset)
+                return
+            if remaining < 0:
+                self.reply(429, {'error': "Too many requests"}, remaining, reset)
+                return
+            if server.random.random() < server.fail_rate:
+                self.reply(503, {'error': "Service unavailable"}, remaining, reset)
+                return
+            key = self.headers.get("Idempotency-Key")
+            if key in server.keys:
+                self.reply(200, server.keys[key], remaining, reset)
+                return
+            status = {
+                'id': str(len(server.statuses) + 1),
+                'content': fields.get('status', ""),
+                'in_reply_to_id': fields.get('in_reply_to_id')
+            }
+            server.statuses.append(status)
+            if key:
+                server.keys[key] = status
+            self.reply(200, status, remaining, reset)
+
+
+def main():
+    opts = parse_options()
+    server = MockMastodon(("localhost", opts.port), opts.limit, opts.window,
+                          opts.fail_rate, opts.seed)
+    print(f"Listening on http://localhost:{opts.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"{server.requests} requests, {len(server.statuses)} statuses posted.")
+
+
+if __name__ == "__main__":
+    main()
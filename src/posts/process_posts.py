@@ -1,109 +1,487 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
 import json
+import os
+import random
+import resource
 import sys
-import urllib3
+import threading
+import time
 
-import boto3
+# Batch mode: post as many items of a thread as fit in the time this
+# invocation has left, instead of one per invocation, pausing
+# POST_PACING seconds between them. Only what's left of the thread gets
+# sent on to the queue, for the next invocation.
+POST_BATCH = os.environ.get('POST_BATCH', 'false').lower() in ('1', 'true', 'yes')
+POST_PACING = float(os.environ.get('POST_PACING', '1'))
+# How much time (in ms) to leave unused, for the SQS/Lambda calls at the end
+POST_SAFETY_MARGIN = int(os.environ.get('POST_SAFETY_MARGIN', '5000'))
+# How long (in seconds) to hold on to the parameters from the parameter store
+PARAMETER_TTL = int(os.environ.get('PARAMETER_TTL', '900'))
+# Retries for 429 (rate limited) and 5xx responses, and connection
+# failures, with exponential backoff (in seconds), as in warn_post.py,
+# for as long as the invocation has the time for them. That part of it
+# is copied, since this file is all there is to the posts Lambda (see
+# the Makefile).
+# pylint: disable=duplicate-code
+POST_RETRIES = 5
+BACKOFF = 2
+BACKOFF_MAX = 120
 
-def record_handler(server, token, record):
+# These survive between invocations for as long as the Lambda stays
+# warm: the boto3 clients, the HTTP connection pool (keeping the
+# connection to the Mastodon server alive), and the parameters (along
+# with the time we fetched them).
+#
+# boto3 and urllib3 are imported along with the first client or the
+# connection pool rather than when the Lambda starts, which keeps them
+# out of the INIT phase of a cold start.
+RESOURCES = {}
+PARAMETERS = {}
+
+# Where the time of an invocation goes (spans, in milliseconds) and how
+# much got done (counts), emitted by posts_handler() as one CloudWatch
+# embedded metric format (EMF) line per invocation, like the report
+# Lambda does (see warn_metrics.py there). The records of an event are
+# handled at the same time, hence the lock.
+METRICS = {'spans': {}, 'counts': {}}
+LOCK = threading.Lock()
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        with LOCK:
+            METRICS['spans'][name] = METRICS['spans'].get(name, 0.0) + elapsed
+
+
+def count(name, value=1):
+    with LOCK:
+        METRICS['counts'][name] = METRICS['counts'].get(name, 0) + value
+
+
+def emf_line(function):
+    values = {f"{name}_ms": round(value, 3) for name, value in METRICS['spans'].items()}
+    values.update(METRICS['counts'])
+    # The peak of all the invocations of this (warm) Lambda so far
+    values['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3)
+    metrics = [{'Name': name, 'Unit': "Count"} for name in sorted(values)]
+    for metric in metrics:
+        if metric['Name'].endswith("_ms"):
+            metric['Unit'] = "Milliseconds"
+        elif metric['Name'].endswith("_mb"):
+            metric['Unit'] = "Megabytes"
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': "WARN",
+                'Dimensions': [["Function"]],
+                'Metrics': metrics
+            }]
+        },
+        'Function': function
+    }
+    document.update(values)
+    return json.dumps(document)
+
+
+# The boto3 default session isn't thread safe, so the clients are
+# created under the lock (the clients themselves are).
+def get_client(service):
+    with LOCK:
+        if service not in RESOURCES:
+            import boto3 # pylint: disable=import-outside-toplevel
+            RESOURCES[service] = boto3.client(service)
+    return RESOURCES[service]
+
+
+def get_http():
+    with LOCK:
+        if 'http' not in RESOURCES:
+            import urllib3 # pylint: disable=import-outside-toplevel
+            RESOURCES['http'] = urllib3.PoolManager()
+    return RESOURCES['http']
+
+
+def get_parameter(name, decrypt=False):
+    if name in PARAMETERS:
+        value, fetched = PARAMETERS[name]
+        if time.monotonic() - fetched < PARAMETER_TTL:
+            return value
+    with span("ssm"):
+        result = get_client("ssm").get_parameter(Name=name, WithDecryption=decrypt)
+    if not result or 'Parameter' not in result:
+        print(f"Error: Unable to fetch {name} from parameter store")
+        sys.exit(1)
+    value = result['Parameter']['Value']
+    PARAMETERS[name] = (value, time.monotonic())
+    return value
+
+
+def invalidate_parameters():
+    PARAMETERS.clear()
+
+
+# Seconds until the rate limit resets, according to the headers, or
+# None if they don't say.
+def rate_limit_reset(headers):
+    reset = headers.get('X-RateLimit-Reset')
+    if not reset:
+        return None
+    try:
+        reset_at = datetime.datetime.fromisoformat(reset.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def retry_delay(attempt, result):
+    delay = min(BACKOFF_MAX, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+    if result is not None and result.status == 429:
+        seconds = rate_limit_reset(result.headers)
+        if seconds is not None:
+            delay = max(delay, seconds)
+    return delay
+
+
+# The Idempotency-Key of an item of a thread: the same every time that
+# item gets posted, so that Mastodon returns the status it already
+# created for it (within the hour it keeps the keys), rather than
+# posting it again, when a message is received a second time, or the
+# rest of a batch gets retried.
+def idempotency_key(run_id, index, status):
+    if run_id:
+        return f"{run_id}-{index:04d}"
+    return hashlib.sha256(f"{index}\n{status}".encode("utf-8")).hexdigest()
+
+
+# Post one status, retrying where that might help (see warn_post.py).
+# Returns the ID of the status, or None if it didn't work out.
+def post_status(server, token, status, in_reply_to, key, lambda_context=None):
+    params = {
+        'status': status
+    }
+    if in_reply_to:
+        params['in_reply_to_id'] = in_reply_to
+    http = get_http()
+    # Imported by get_http() already
+    import urllib3 # pylint: disable=import-outside-toplevel
+
+    refreshed = False
+    attempt = 0
+    while True:
+        headers = {
+            'Authorization': f"Bearer {token}",
+            'Idempotency-Key': key
+        }
+        try:
+            with span("post"):
+                result = http.request('POST', f"https://{server}/api/v1/statuses",
+                                      headers=headers,
+                                      fields=params,
+                                      retries=False)
+        except urllib3.exceptions.HTTPError as error:
+            print(f"Posting failed: {error}")
+            result = None
+        if result is not None:
+            print(result.status)
+            print(result.headers)
+            print(result.data)
+            if result.status == 200:
+                count("posts")
+                return json.loads(result.data)['id']
+            print(f"Posting failed: {result.status}")
+            if result.status == 401 and not refreshed:
+                # The token may have been changed since we fetched it
+                print("Unauthorized, fetching the token again.")
+                count("retries")
+                invalidate_parameters()
+                token = get_parameter('/WARN/api_token', decrypt=True)
+                refreshed = True
+                continue
+            if result.status != 429 and result.status < 500:
+                # Retrying won't change anything
+                return None
+        if attempt == POST_RETRIES:
+            return None
+        delay = retry_delay(attempt, result)
+        if (lambda_context is not None and
+                lambda_context.get_remaining_time_in_millis() < delay * 1000 + POST_SAFETY_MARGIN):
+            print("No time left to retry.")
+            return None
+        print(f"Retrying in {delay:.1f} seconds.")
+        count("retries")
+        with span("backoff"):
+            time.sleep(delay)
+        attempt += 1
+
+
+# Fetch one item of a thread stored by process_report.py, from S3
+# (s3://<bucket>/<prefix>) or a local directory.
+def load_thread_item(threads, run_id, index):
+    if threads.startswith("s3://"):
+        bucket_name, _, prefix = threads[5:].partition("/")
+        key = f"{prefix.rstrip('/')}/{run_id}/{index:04d}.txt"
+        with span("s3"):
+            result = get_client("s3").get_object(Bucket=bucket_name, Key=key)
+            return result['Body'].read().decode("utf-8")
+    with open(f"{threads}/{run_id}/{index:04d}.txt", encoding="utf-8") as item:
+        return item.read()
+
+
+# Is the marker of a thread past the time by which the thread should
+# have been done? Markers from before they had one never are.
+def marker_expired(expires):
+    try:
+        return float(expires) < time.time()
+    except ValueError:
+        return False
+
+
+# The run IDs of the threads that are still being posted: the ones with
+# a marker under active/ (see mark_active() in warn_post.py), that
+# hasn't expired. Expired ones are left over from threads that failed,
+# and get removed.
+def active_threads(threads):
+    markers = []
+    if threads.startswith("s3://"):
+        bucket_name, _, prefix = threads[5:].partition("/")
+        s3_client = get_client("s3")
+        # Imported along with boto3, by get_client()
+        from botocore.exceptions import ClientError # pylint: disable=import-outside-toplevel
+        with span("s3"):
+            result = s3_client.list_objects_v2(Bucket=bucket_name,
+                                               Prefix=f"{prefix.rstrip('/')}/active/")
+            for entry in result.get('Contents', []):
+                try:
+                    marker = s3_client.get_object(Bucket=bucket_name, Key=entry['Key'])
+                except ClientError:
+                    # Done in the meantime
+                    continue
+                markers.append((entry['Key'].rsplit("/", 1)[1],
+                                marker['Body'].read().decode("utf-8")))
+    else:
+        directory = f"{threads}/active"
+        for run_id in os.listdir(directory) if os.path.isdir(directory) else []:
+            with contextlib.suppress(FileNotFoundError), \
+                 open(f"{directory}/{run_id}", encoding="utf-8") as marker:
+                markers.append((run_id, marker.read()))
+    active = []
+    for run_id, expires in markers:
+        if marker_expired(expires):
+            print(f"Thread {run_id} should have been done by now, forgetting about it.")
+            clear_active(threads, run_id)
+        else:
+            active.append(run_id)
+    return active
+
+
+def clear_active(threads, run_id):
+    if threads.startswith("s3://"):
+        bucket_name, _, prefix = threads[5:].partition("/")
+        with span("s3"):
+            get_client("s3").delete_object(Bucket=bucket_name,
+                                           Key=f"{prefix.rstrip('/')}/active/{run_id}")
+        return
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(f"{threads}/active/{run_id}")
+
+
+def enable_mapping(esm_uuid, enabled):
+    with span("esm"):
+        result = get_client("lambda").update_event_source_mapping(
+            UUID=esm_uuid,
+            Enabled=enabled
+        )
+    print(f"result = {result}")
+
+
+# Done with a thread: time to disable the event source mapping, unless
+# other threads are still being posted. The report Lambda marks a new
+# thread active before it enables the mapping, so if one shows up
+# while we're disabling it, the mapping gets enabled again. Threads
+# from before there were markers (without a run ID) disable it as is.
+def thread_done(esm_uuid, threads, run_id):
+    if run_id:
+        clear_active(threads, run_id)
+        active = active_threads(threads)
+        if active:
+            print(f"Still posting {', '.join(active)}, leaving the event source mapping enabled.")
+            return
+    enable_mapping(esm_uuid, False)
+    if run_id and active_threads(threads):
+        enable_mapping(esm_uuid, True)
+
+
+# Is there enough time left for another post (going by the slowest one
+# so far), plus the pause before it?
+def time_for_another(lambda_context, slowest):
+    if not POST_BATCH or lambda_context is None:
+        return False
+    needed = POST_PACING * 1000 + slowest + POST_SAFETY_MARGIN
+    return lambda_context.get_remaining_time_in_millis() > needed
+
+
+def record_handler(server, token, record, lambda_context=None):
     state_abbr = record['messageAttributes']['state_abbr']['stringValue']
     state_name = record['messageAttributes']['state_name']['stringValue']
     sqs_url = record['messageAttributes']['sqs_url']['stringValue']
     index = int(record['messageAttributes']['index']['stringValue'])
     total = int(record['messageAttributes']['total']['stringValue'])
-    auth = {'Authorization': f"Bearer {token}"}
     esm_uuid = record['messageAttributes']['esm_uuid']['stringValue']
+    run_id = None
+    threads = None
+    if 'run_id' in record['messageAttributes']:
+        # The thread is stored elsewhere, fetch the items one at a time
+        run_id = record['messageAttributes']['run_id']['stringValue']
+        threads = record['messageAttributes']['threads']['stringValue']
 
-    output_list = json.loads(record['body'])
-    body = output_list[index - 1]
+        def thread_item(index):
+            return load_thread_item(threads, run_id, index)
+    else:
+        # The (rest of the) thread is in the message body. Which item
+        # of the thread it starts with:
+        base = 1
+        if 'base' in record['messageAttributes']:
+            base = int(record['messageAttributes']['base']['stringValue'])
+        output_list = json.loads(record['body'])
 
-    params = {
-        'status': f"{body}\n#Warn #Act #WarnAct #{state_abbr} #{state_name} ({index}/{total})"
-    }
+        def thread_item(index):
+            return output_list[index - base]
+
+    # Threads from before the report Lambda rendered the statuses itself
+    # still need the tags and numbering added.
+    rendered = 'rendered' in record['messageAttributes']
+
+    in_reply_to = None
     if 'in_reply_to' in record['messageAttributes']:
         in_reply_to = record['messageAttributes']['in_reply_to']['stringValue']
-        params['in_reply_to_id'] = in_reply_to
 
-    http = urllib3.PoolManager()
-    result = http.request('POST', f"https://{server}/api/v1/statuses",
-                          headers=auth,
-                          fields=params)
-    print(result.status)
-    print(result.headers)
-    print(result.data)
-    in_reply_to = json.loads(result.data)['id']
-
-    if index == total:
-        # We're done, time to disable the event source mapping
-        aws_lambda = boto3.client("lambda")
-        result = aws_lambda.update_event_source_mapping(
-            UUID=esm_uuid,
-            Enabled=False
-        )
-        print(f"result = {result}")
-        return True
-
-    sqs = boto3.resource('sqs')
-    queue = sqs.Queue(sqs_url)
-    queue.send_message(
-        MessageBody=record['body'],
-        MessageAttributes={
-            'sqs_url': {
-                'DataType': 'String',
-                'StringValue': sqs_url
-            },
-            'in_reply_to': {
-                'DataType': 'String',
-                'StringValue': in_reply_to
-            },
-            'index': {
-                'DataType': 'Number',
-                'StringValue': str(index + 1)
-            },
-            'total': {
-                'DataType': 'Number',
-                'StringValue': str(total)
-            },
-            'state_abbr': {
-                'DataType': 'String',
-                'StringValue': state_abbr
-            },
-            'state_name': {
-                'DataType': 'String',
-                'StringValue': state_name
-            },
-            'esm_uuid': {
-                'DataType': 'String',
-                'StringValue': esm_uuid
-            }
-        },
-        DelaySeconds=10
-    )
-    return True
+    first = index
+    slowest = 0
+    while True:
+        status = thread_item(index)
+        if not rendered:
+            status = f"{status}\n#Warn #Act #WarnAct #{state_abbr} #{state_name} ({index}/{total})"
+        start = time.monotonic()
+        posted = post_status(server, token, status, in_reply_to,
+                             idempotency_key(run_id, index, status), lambda_context)
+        slowest = max(slowest, (time.monotonic() - start) * 1000)
+        if posted is None:
+            print(f"Giving up on {index}/{total}.")
+            if index == first:
+                # Nothing posted: fail, so SQS gets the message retried
+                # (or sent to the dead letter queue)
+                return False
+            # Hand the rest on, from this item, so that what did get
+            # posted isn't posted again
+            break
+        in_reply_to = posted
 
-# We know that lambda_context is unused; '_' prefix avoids complaint
-def posts_handler(event, _lambda_context):
-    ssm = boto3.client("ssm")
+        if index == total:
+            # We're done with this thread
+            thread_done(esm_uuid, threads, run_id)
+            return True
 
-    server_result = ssm.get_parameter(Name='/WARN/api_server')
-    if server_result and 'Parameter' in server_result:
-        server = server_result['Parameter']['Value']
-    else:
-        print("Error: Unable to fetch /WARN/api_server from parameter store")
-        sys.exit(1)
+        index += 1
+        if not time_for_another(lambda_context, slowest):
+            break
+        with span("pacing"):
+            time.sleep(POST_PACING)
 
-    token_result = ssm.get_parameter(Name='/WARN/api_token', WithDecryption=True)
-    if token_result and 'Parameter' in token_result:
-        token = token_result['Parameter']['Value']
+    message_attributes = {
+        'sqs_url': {
+            'DataType': 'String',
+            'StringValue': sqs_url
+        },
+        'in_reply_to': {
+            'DataType': 'String',
+            'StringValue': in_reply_to
+        },
+        'index': {
+            'DataType': 'Number',
+            'StringValue': str(index)
+        },
+        'total': {
+            'DataType': 'Number',
+            'StringValue': str(total)
+        },
+        'state_abbr': {
+            'DataType': 'String',
+            'StringValue': state_abbr
+        },
+        'state_name': {
+            'DataType': 'String',
+            'StringValue': state_name
+        },
+        'esm_uuid': {
+            'DataType': 'String',
+            'StringValue': esm_uuid
+        }
+    }
+    if rendered:
+        message_attributes['rendered'] = {
+            'DataType': 'String',
+            'StringValue': 'true'
+        }
+    if run_id:
+        message_body = run_id
+        message_attributes['run_id'] = {
+            'DataType': 'String',
+            'StringValue': run_id
+        }
+        message_attributes['threads'] = {
+            'DataType': 'String',
+            'StringValue': threads
+        }
     else:
-        print("Error: Unable to fetch /WARN/api_token from parameter store")
-        sys.exit(1)
+        message_body = json.dumps(output_list[index - base:])
+        message_attributes['base'] = {
+            'DataType': 'Number',
+            'StringValue': str(index)
+        }
+    with span("sqs"):
+        get_client("sqs").send_message(
+            QueueUrl=sqs_url,
+            MessageBody=message_body,
+            MessageAttributes=message_attributes,
+            DelaySeconds=10
+        )
+    return True
+
+def posts_handler(event, lambda_context):
+    METRICS['spans'].clear()
+    METRICS['counts'].clear()
+    try:
+        with span("invocation"):
+            server = get_parameter('/WARN/api_server')
+            token = get_parameter('/WARN/api_token', decrypt=True)
 
-    # There should be only one record, but just in case:
-    for record in event['Records']:
-        if not record_handler(server, token, record):
-            sys.exit(1)
+            # Every record is (the next message of) a different thread,
+            # since a thread only ever has one message in the queue, so
+            # with more than one they're posted at the same time, each
+            # in its own order.
+            records = event['Records']
+            workers = max(len(records), 1)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                handled = list(executor.map(
+                    lambda record: record_handler(server, token, record, lambda_context),
+                    records
+                ))
+            if not all(handled):
+                sys.exit(1)
+    finally:
+        # One line with all the metrics of this invocation, for CloudWatch
+        print(emf_line("post"))
 
 def main():
     print("This is a Lambda handler, not a regular script.")
@@ -2,24 +2,39 @@
 # -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
 
 import argparse
-import csv
+import collections
+import concurrent.futures
+import copy
 import datetime
+import functools
+import glob
 import hashlib
+import itertools
 import json
 from operator import itemgetter
 import os
 import re
 import sys
-import time
 import warnings
 
-import boto3
-import openpyxl
-import urllib3
+import warn_cache
+import warn_diff
+import warn_index
+import warn_metrics
+import warn_post
+import warn_record
+import warn_render
+import warn_resources
+import warn_store
+import warn_watch
 
 # WARN_URL  = 'https://edd.ca.gov/siteassets/files/jobs_and_training/warn/warn_report.xlsx'
 WARN_URL  = 'https://edd.ca.gov/siteassets/files/jobs_and_training/warn/warn_report1.xlsx'
 XLSX_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# The size of the chunks the history segments are streamed from S3 in
+STREAM_CHUNK = 1048576
+# Where the report Lambda keeps its files (emulate_lambdas.py moves it)
+LAMBDA_TMP = "/tmp"
 
 
 def parse_options():
@@ -48,17 +63,55 @@ https://edd.ca.gov/en/jobs_and_training/Layoff_Services_WARN
     parser.add_argument("--excel",
                         help="Specify an alternative name for 'warn_report.xlsx'",
                         default="warn_report.xlsx")
+    parser.add_argument("--state",
+                        help="The state whose WARN act notices to process (default: CA)",
+                        choices=sorted(STATES),
+                        default="CA")
+    parser.add_argument("--db",
+                        help="Keep the history in this SQLite database instead of summary.csv "
+                        "(filled from summary.csv the first time)")
+    parser.add_argument("--cache-dir",
+                        help="Directory for the parsed spreadsheet cache "
+                        "(default: .warn_cache next to the spreadsheet)")
+    parser.add_argument("--cache-keep",
+                        help="Number of spreadsheet versions to keep in the cache",
+                        type=int,
+                        default=3)
+    parser.add_argument("--no-cache",
+                        help="Don't use the parsed spreadsheet cache",
+                        default=False,
+                        action='store_true')
     parser.add_argument("--server",
-                        help="Specify an alternative Mastodon server",
+                        help="Specify an alternative Mastodon server "
+                        "(or http://localhost:<port> for a mock one)",
                         default="botsin.space")
     parser.add_argument("--token",
                         help="Specify the authorization token. Required for --post option.")
+    parser.add_argument("--pacing",
+                        help="Minimum number of seconds between posts with --token (default: 10)",
+                        type=float,
+                        default=10)
+    parser.add_argument("--char-limit",
+                        help="Character limit of the statuses on the Mastodon server",
+                        type=int,
+                        default=warn_render.CHAR_LIMIT)
     parser.add_argument("--post",
                         help="Post this to Mastodon? Only use with --update.",
                         default=False,
                         action='store_true')
+    parser.add_argument("--post-updates",
+                        help="With --post, also post the corrections to earlier notices",
+                        default=False,
+                        action='store_true')
     parser.add_argument("--sqs",
                         help="Specify the SQS queue to which to post the updates, if any.")
+    parser.add_argument("--profile",
+                        help="Print how long each stage took, row counts, and memory use",
+                        default=False,
+                        action='store_true')
+    parser.add_argument("--threads",
+                        help="Where to store the threads for --sqs: s3://<bucket>/<prefix> "
+                        "or a local directory.")
 
     # The possible actions:
     parser.add_argument('--dump',
@@ -69,54 +122,172 @@ https://edd.ca.gov/en/jobs_and_training/Layoff_Services_WARN
                         help="Fetch the latest version of the WARN act spreadsheet from its source",
                         default=False,
                         action='store_true')
+    parser.add_argument('--force',
+                        help="Fetch the spreadsheet even if it doesn't appear to have changed",
+                        default=False,
+                        action='store_true')
     parser.add_argument('--update',
                         help="Update the extracted data with this WARN act spreadsheet",
                         default=False,
                         action="store_true")
+    parser.add_argument('--watch',
+                        help="Keep running, and --update with the WARN act spreadsheet whenever "
+                        "there is a new version of it",
+                        default=False,
+                        action="store_true")
+    parser.add_argument('--interval',
+                        help="Number of seconds between the checks for a new version with "
+                        "--watch",
+                        type=int,
+                        default=900)
+    parser.add_argument('--replay',
+                        help="Update the extracted data with all of the (archived) WARN act "
+                        "spreadsheets in this directory, in the order of their names")
+    parser.add_argument('--workers',
+                        help="Number of processes parsing the spreadsheets for --replay "
+                        "(default: one per CPU)",
+                        type=int)
     parser.add_argument('--search',
                         help="Search entries matching a company in the summary.csv file")
+    parser.add_argument('--stats',
+                        help="Statistics over all of the entries in the summary.csv file "
+                        "(needs numpy)",
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--top',
+                        help="Number of companies and counties to list with --stats",
+                        type=int,
+                        default=10)
+    parser.add_argument('--format',
+                        help="Output format for --stats",
+                        choices=["json", "csv"],
+                        default="json")
+
+    # Additional search criteria, which can also be used without --search:
+    parser.add_argument('--contains',
+                        help="Search entries with a company name containing this (any case)")
+    parser.add_argument('--county',
+                        help="Search entries in this county")
+    parser.add_argument('--city',
+                        help="Search entries in this city")
+    parser.add_argument('--since',
+                        help="Search entries with a notice date on or after this (YYYY-MM-DD)")
+    parser.add_argument('--until',
+                        help="Search entries with a notice date on or before this (YYYY-MM-DD)")
+    parser.add_argument('--min-employees',
+                        help="Search entries affecting at least this many employees",
+                        type=int)
 
     opts = parser.parse_args()
+    opts.state = STATES[opts.state]()
+    opts.searching = any(value is not None for value in [
+        opts.search, opts.contains, opts.county, opts.city,
+        opts.since, opts.until, opts.min_employees
+    ])
     excl = 0
     if opts.dump:
         excl += 1
     if opts.fetch:
         excl += 1
-    if opts.search:
+    if opts.searching:
+        excl += 1
+    if opts.stats:
         excl += 1
     if opts.update:
         excl += 1
+    if opts.replay:
+        excl += 1
+    if opts.watch:
+        excl += 1
     if excl > 1:
-        print("The options --dump, --fetch, --search, and --update are mutually exclusive.")
+        print("The options --dump, --fetch, --replay, --search, --stats, --update, and --watch "
+              "are mutually exclusive.")
         sys.exit(1)
     if excl == 0:
         opts.dump = True
-    if opts.post and not opts.update:
-        print("The option --post can only be used in combination with --update.")
+    if opts.post and not opts.update and not opts.watch:
+        print("The option --post can only be used in combination with --update or --watch.")
         sys.exit(1)
-    if opts.post and not opts.token:
+    if opts.post and not opts.token and not opts.sqs:
         print("The option --post requires that you also use the --token option.")
         sys.exit(1)
+    if opts.char_limit < warn_render.min_char_limit(opts.state):
+        print(f"The option --char-limit has to be at least "
+              f"{warn_render.min_char_limit(opts.state)}.")
+        sys.exit(1)
+    if opts.sqs and not opts.threads:
+        print("The option --sqs requires that you also use the --threads option.")
+        sys.exit(1)
     return opts
 
 
+def normalize_header(header):
+    header = header.replace("\n", " ")
+    header = header.replace("/ ", "/")
+    header = header.replace("  ", " ")
+    return header
+
+
+# Cell values are passed on as-is (numbers stay numbers, empty cells
+# stay None), except for dates, which get normalized to YYYY-MM-DD.
+def normalize_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+# Stream the data rows of the sheet, one list of (normalized) values
+# per row, stopping at the "Report Summary" section or the first row
+# without a county. The workbook is closed once we're done with it.
+def iter_report(workbook, o_sheet, headers, offset, useful_columns):
+    county_col = headers["County/Parish"]
+    try:
+        with warnings.catch_warnings():
+            # In read-only mode the sheet is only parsed while we iterate
+            # over it, so the warnings show up here instead of at load time.
+            warnings.filterwarnings("ignore", category=UserWarning)
+            for values in o_sheet.iter_rows(min_row=2+offset, max_col=useful_columns,
+                                            values_only=True):
+                county = values[county_col]
+                if not county or county == "Report Summary":
+                    break
+                yield [normalize_value(value) for value in values]
+    finally:
+        workbook.close()
+
+
+# Open the spreadsheet in read-only mode, which streams the sheet row by
+# row rather than loading every cell into memory up front. Returns the
+# (0-based) column index per header, the number of useful columns, and
+# an iterator over the data rows.
 def load_report(opts):
+    digest = None
+    if not opts.no_cache:
+        digest = warn_cache.file_digest(opts.excel)
+        cached = warn_cache.load_cached_report(opts, digest)
+        if cached:
+            return cached
+
+    # Only imported when there's a spreadsheet to load, as it takes a
+    # while; a cached spreadsheet doesn't need it.
+    import openpyxl # pylint: disable=import-outside-toplevel
     with warnings.catch_warnings():
         # This is just to suppress this (irrelevant to me) warnings
         # .../openpyxl/worksheet/_reader.py:329:
         #     UserWarning: Data Validation extension is not supported and will be removed
         warnings.filterwarnings("ignore", category=UserWarning)
-        workbook = openpyxl.load_workbook(filename=opts.excel, data_only=True)
+        workbook = openpyxl.load_workbook(filename=opts.excel, read_only=True, data_only=True)
 
     # Get All Sheets
     a_sheet_names = workbook.sheetnames
 
-    # Look for "Detailed WARN Report" sheet (actual sheet has an extra space).
+    # Look for the sheet with the details (for California, the "Detailed
+    # WARN Report" sheet; actual sheet has an extra space).
     # If none found, use the first sheet and hope for the best.
     offset = 0
     sheet_name = a_sheet_names[0]
     for name in a_sheet_names:
-        if re.match(r"(?i)detailed warn report", name):
+        if re.match(opts.state.sheet_pattern, name):
             sheet_name = name
             offset = 1
     if opts.debug:
@@ -124,17 +295,17 @@ def load_report(opts):
 
     o_sheet = workbook[sheet_name]
     headers = {}
-    for col in range(o_sheet.max_column):
-        o_cell = o_sheet.cell(row=1+offset, column=col+1)
-        header = o_cell.value
+    useful_columns = 0
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=UserWarning)
+        header_row = next(o_sheet.iter_rows(min_row=1+offset, max_row=1+offset,
+                                            values_only=True), ())
+    for col, header in enumerate(header_row):
         if header is None or len(header) == 0:
             # Break out of the loop if we get a header without content
             # or empty content
             break
-        header = header.replace("\n", " ")
-        header = header.replace("/ ", "/")
-        header = header.replace("  ", " ")
-        headers[header] = col + 1
+        headers[normalize_header(header)] = col
         useful_columns = col + 1
     if opts.debug:
         print(json.dumps(headers))
@@ -142,52 +313,73 @@ def load_report(opts):
     # Sanity check a few of the expected headers:
     if "No. Of Employees" not in headers:
         print("Missing No. Of Employees column, aborting.")
+        workbook.close()
         sys.exit(1)
     if "Notice Date" not in headers:
         print("Missing Notice Date column, aborting.")
+        workbook.close()
         sys.exit(1)
 
-    return o_sheet, headers, offset, useful_columns
-
-
-def update_row_summary(row,
-                       last_company,
-                       last_companies, last_counties, last_addresses, last_effective,
-                       company_col, county_col, address_col, effective_col):
-    if len(last_counties) > 1:
-        row[county_col] = ", ".join(last_counties.keys())
-        row[address_col] = f"[Multiple ({len(last_addresses)})]"
-    else:
-        if len(last_addresses) > 1:
-            row[address_col] = f"[Multiple ({len(last_addresses)})]"
-    if len(last_effective) > 1:
-        dates = list(last_effective.keys())
-        dates.sort()
-        row[effective_col] = f"{dates[0]} - {dates[-1]}"
-    if len(last_companies) > 1:
-        row[company_col] = f"{last_company} [Multiple variations ({len(last_companies)})]"
+    rows = iter_report(workbook, o_sheet, headers, offset, useful_columns)
+    if digest:
+        rows = warn_cache.cache_report(opts, digest, headers, useful_columns, rows)
+    return headers, useful_columns, rows
 
 
-# Sort (first by Notice Date and then by Company name) and group the
-# rows by company (or variations thereof), grouping things like
-# multiple different addresses, counties/parishes, and effective
-# dates, # while showing the total number of employees affected.
-#
-# The company name simpification is to handle things like:
+# The company name simplification is to handle things like:
 #
 #   "<name> - <#> Building"
 #   "<name> - Layoff <#>"
 #
 # These may or may not be legally distinct units, but they're typically
-# clearly related.
-def group_entries(rows, csv_headers):
-    output_list = []
-
+# clearly related. Each (pattern, replacement) pair is applied in turn.
+COMPANY_NORMALIZATION = [
+    (re.compile(r"^Google US-(.*)"), "Google US"),
+    (re.compile(r"^(.*) - (.*)$"), r"\1")
+]
+
+# One (combined) entry in a thread: the first of the rows it combines,
+# and the values that replace those of that first row, if any.
+EntryGroup = collections.namedtuple(
+    "EntryGroup", ["row", "company", "county", "address", "effective", "employees"]
+)
+
+
+def company_normalizer(normalization):
+    seen = {}
+
+    def normalize(company):
+        if company not in seen:
+            eff_company = company
+            for pattern, replacement in normalization:
+                eff_company = pattern.sub(replacement, eff_company, count=1)
+            seen[company] = (eff_company, eff_company.lower())
+        return seen[company]
+    return normalize
+
+
+# Called for every thread entry (dump_updates() dumps them one at a
+# time), so the headers are only looked up once per set of them.
+@functools.lru_cache(maxsize=16)
+def column_indexes(csv_headers):
     headers = {}
     for col, header in enumerate(csv_headers):
         header = header.replace("  ", " ")
         headers[header] = col
+    return headers
 
+
+# Sort (first by Notice Date and then by Company name) and group the
+# rows by company (or variations thereof), grouping things like
+# multiple different addresses, counties/parishes, and effective
+# dates, while showing the total number of employees affected.
+#
+# The rows can be lists or records (see warn_record); the rows of the
+# entries are records either way.
+def group_entries(rows, csv_headers, normalization=None):
+    if normalization is None:
+        normalization = COMPANY_NORMALIZATION
+    headers = column_indexes(tuple(csv_headers))
     notice_col    = headers["Notice Date"]
     company_col   = headers["Company"]
     county_col    = headers["County/Parish"]
@@ -196,108 +388,111 @@ def group_entries(rows, csv_headers):
     layoff_col    = headers["Layoff/Closure"]
     address_col   = headers['Address']
     employees_col = headers["No. Of Employees"]
-
-    last_row = {}
-    last_company = None
-    last_companies = {}
-    last_counties = {}
-    last_addresses = {}
-    last_effective = {}
-    for row in sorted(rows, key=itemgetter(notice_col, company_col)):
-        eff_company = row[company_col]
-        match_google = re.match(r"^Google US-(.*)", eff_company)
-        if match_google:
-            eff_company = "Google US"
-        match_company = re.match(r"^(.*) - (.*)$", eff_company)
-        if match_company:
-            eff_company = match_company.group(1)
-
-        if len(last_row) > 0 and (row[notice_col]     != last_row[notice_col] or
-                                  eff_company.lower() != last_company.lower() or
-                                  row[processed_col]  != last_row[processed_col] or
-                                  row[layoff_col]     != last_row[layoff_col]):
-            # We cannot combine this row into the previous one
-            update_row_summary(last_row,
-                               last_company,
-                               last_companies, last_counties, last_addresses, last_effective,
-                               company_col, county_col, address_col, effective_col)
-
-            output_list.append(last_row)
-            last_row = {}
-            # Fall through
-
-        if len(last_row) == 0:
-            # Either because this is the first row, or we cannot combine
-            # this row into the previous one
-            last_row       = row[:] # Copy the content, not the reference
-            last_company   = eff_company
-            last_companies = {last_row[company_col]:   True}
-            last_counties  = {last_row[county_col]:    True}
-            last_addresses = {last_row[address_col]:   True}
-            last_effective = {last_row[effective_col]: True}
-            continue
-
-        # Fold row into last_row
-        last_row[employees_col] = int(last_row[employees_col]) + int(row[employees_col])
-        last_companies[row[company_col]] = True
-        last_counties[row[county_col]] = True
-        last_addresses[row[address_col]] = True
-        last_effective[row[effective_col]] = True
-
-    if last_row:
-        update_row_summary(last_row,
-                           last_company,
-                           last_companies, last_counties, last_addresses, last_effective,
-                           company_col, county_col, address_col, effective_col)
-        output_list.append(last_row)
-
-    return output_list
+    normalize = company_normalizer(normalization)
+
+    def group_key(row):
+        return (row[notice_col], normalize(row[company_col])[1],
+                row[processed_col], row[layoff_col])
+
+    rows = sorted(map(warn_record.record_builder(csv_headers), rows),
+                  key=itemgetter(notice_col, company_col))
+    for _, group in itertools.groupby(rows, key=group_key):
+        first = next(group, None)
+        companies = {first[company_col]: True}
+        counties  = {first[county_col]: True}
+        addresses = {first[address_col]: True}
+        effective = {first[effective_col]: True}
+        employees = first[employees_col]
+        total = first.employees
+        for row in group:
+            # Fold row into the first one
+            total += row.employees
+            employees = total
+            companies[row[company_col]] = True
+            counties[row[county_col]] = True
+            addresses[row[address_col]] = True
+            effective[row[effective_col]] = True
+
+        company = county = address = effective_range = None
+        if len(counties) > 1:
+            county = ", ".join(counties.keys())
+            address = f"[Multiple ({len(addresses)})]"
+        elif len(addresses) > 1:
+            address = f"[Multiple ({len(addresses)})]"
+        if len(effective) > 1:
+            dates = sorted(effective.keys())
+            effective_range = f"{dates[0]} - {dates[-1]}"
+        if len(companies) > 1:
+            company = f"{normalize(first[company_col])[0]} [Multiple variations ({len(companies)})]"
+        yield EntryGroup(first, company, county, address, effective_range, employees)
 
 
 def dump_entries(rows, csv_headers, align=True):
     output_list = []
-    output = ""
     headers = {}
     for col, header in enumerate(csv_headers):
         headers[header] = col
     notice_col = headers["Notice Date"]
+    group_headers = column_indexes(tuple(csv_headers))
+    replaced = {
+        group_headers["Company"]: EntryGroup._fields.index("company"),
+        group_headers["County/Parish"]: EntryGroup._fields.index("county"),
+        group_headers["Address"]: EntryGroup._fields.index("address"),
+        group_headers["Effective Date"]: EntryGroup._fields.index("effective"),
+        group_headers["No. Of Employees"]: EntryGroup._fields.index("employees")
+    }
+    if align:
+        labels = [f"  {normalize_header(header):16s} : " for header in csv_headers]
+    else:
+        labels = [f"{normalize_header(header)}: " for header in csv_headers]
+    columns = [(col, labels[col], replaced.get(col)) for col in range(len(csv_headers))
+               if col != notice_col]
     last_notice = None
-    for row in group_entries(rows, csv_headers):
+    for group in group_entries(rows, csv_headers):
+        row = group.row
+        output = []
         notice = row[notice_col]
         if not last_notice or last_notice != notice:
-            output += f"NOTICE DATE: {notice}\n\n"
+            output.append(f"NOTICE DATE: {notice}\n\n")
             last_notice = notice
-        for col, header in enumerate(csv_headers):
-            if col == notice_col:
-                continue
-            value  = row[col]
-            header = header.replace("\n", " ")
-            header = header.replace("/ ", "/")
-            header = header.replace("  ", " ")
-            if align:
-                output += f"  {header:16s} : {value}\n"
-            else:
-                output += f"{header}: {value}\n"
-        output_list.append(output)
-        output = ""
+        for col, label, field in columns:
+            value = group[field] if field is not None else None
+            if value is None:
+                value = row[col]
+            output.append(f"{label}{value}\n")
+        output_list.append("".join(output))
+    return output_list
+
+
+# Corrected notices: the entry as it is now, after what changed
+def dump_updates(updates, csv_headers, align=True):
+    output_list = []
+    for old, new in updates:
+        changed = "; ".join(f"{normalize_header(header)}: {old_value} -> {new_value}"
+                            for header, old_value, new_value
+                            in warn_diff.changes(csv_headers, old, new))
+        entry = dump_entries([new], csv_headers, align)[0]
+        output_list.append(f"UPDATED NOTICE ({changed})\n\n{entry}")
     return output_list
 
 
-def do_dump(o_sheet, headers, offset):
+def do_dump(headers, rows):
     counties = {}
     companies = {}
-    for row in range(o_sheet.max_row - 1 - offset):
-        county = o_sheet.cell(row=row+2+offset, column=headers["County/Parish"]).value
-        if not county or county == "Report Summary":
-            break
+    county_col    = headers["County/Parish"]
+    company_col   = headers["Company"]
+    action_col    = headers["Layoff/Closure"]
+    employees_col = headers["No. Of Employees"]
+    for row in rows:
+        county = row[county_col]
         if county not in counties:
             counties[county] = 0
         counties[county] += 1
-        company = o_sheet.cell(row=row+2+offset, column=headers["Company"]).value
+        company = row[company_col]
         if company not in companies:
             companies[company] = {}
-        action = o_sheet.cell(row=row+2+offset, column=headers["Layoff/Closure"]).value
-        employees = o_sheet.cell(row=row+2+offset, column=headers["No. Of Employees"]).value
+        action = row[action_col]
+        employees = row[employees_col]
         if action not in companies[company]:
             companies[company][action] = 0
         companies[company][action] += employees
@@ -305,15 +500,64 @@ def do_dump(o_sheet, headers, offset):
     print(json.dumps(companies))
 
 
+# What we know about the last version of the spreadsheet we fetched:
+# its ETag and Last-Modified headers, and the SHA-256 of its content.
+def fetch_meta_name(opts):
+    return f"{opts.excel}.json"
+
+
+def load_fetch_meta(opts):
+    try:
+        with open(fetch_meta_name(opts), encoding="utf-8") as metafile:
+            return json.load(metafile)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_fetch_meta(opts, meta):
+    fname = fetch_meta_name(opts)
+    tmp_fname = f"{fname}.{os.getpid()}"
+    with open(tmp_fname, 'w', encoding="utf-8") as metafile:
+        json.dump(meta, metafile)
+    os.rename(tmp_fname, fname)
+
+
+# Returns True if a new version of the spreadsheet was saved, False if
+# it hasn't changed since the last fetch, and None if the fetch failed
+# (an error, or something else than a spreadsheet), which --fetch and
+# the Lambda exit on, and --watch tries again later.
 def do_fetch(opts):
-    http = urllib3.PoolManager()
-    result = http.request('GET', WARN_URL)
+    meta = {} if opts.force else load_fetch_meta(opts)
+    request_headers = {}
+    if meta.get('etag'):
+        request_headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        request_headers['If-Modified-Since'] = meta['last_modified']
+    with warn_metrics.span("fetch"):
+        result = warn_resources.get_http().request('GET', opts.state.url,
+                                                  headers=request_headers)
+    if result.status == 304:
+        if opts.debug:
+            print("Spreadsheet not modified since the last fetch.")
+        return False
     if result.status != 200:
         print(f"Unexpected HTTP status code: {result.status}")
-        sys.exit(1)
-    if result.headers['content-type'] != XLSX_TYPE:
-        print(f"Unexpect content received: {result.headers['content-type']}; {result.encoding}")
-        sys.exit(1)
+        return None
+    if result.headers.get('content-type') != opts.state.content_type:
+        print(f"Unexpected content received: {result.headers.get('content-type')}")
+        return None
+    new_meta = {
+        'etag': result.headers.get('etag'),
+        'last_modified': result.headers.get('last-modified'),
+        'sha256': hashlib.sha256(result.data).hexdigest()
+    }
+    if new_meta['sha256'] == meta.get('sha256'):
+        # Same content, but hold on to the (possibly) new headers
+        if opts.debug:
+            print("Spreadsheet content identical to the last fetch.")
+        if new_meta != meta:
+            save_fetch_meta(opts, new_meta)
+        return False
     fname = opts.excel
     tmp_fname = f"{fname}.{os.getpid()}"
     if opts.debug:
@@ -324,235 +568,339 @@ def do_fetch(opts):
     if opts.debug:
         print(f"Renaming {tmp_fname} to {fname}")
     os.rename(tmp_fname, fname)
+    save_fetch_meta(opts, new_meta)
+    return True
 
 
 def do_search(opts):
+    if opts.db:
+        import warn_sqlite # pylint: disable=import-outside-toplevel
+        with warn_metrics.span("query"):
+            found = warn_sqlite.search_rows(opts)
+        if found is None:
+            print(f"No data in {opts.db} yet.")
+            sys.exit(1)
+        csv_headers, rows_found = found
+        if opts.debug:
+            print(f"Found {len(rows_found)} rows of data.")
+        if len(rows_found) > 0:
+            print("\n".join(dump_entries(rows_found, csv_headers)))
+        else:
+            print("No matching companies found.")
+        return
+
     fname = opts.summary
-    csv_headers = None
-    rows = []
+    search_fname = warn_index.search_index_name(opts)
 
-    try:
-        with open(fname, newline='', encoding="utf-8") as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if csv_headers is None:
-                    csv_headers = row
-                else:
-                    rows.append(row)
-    except IOError:
-        print(f"File {csv} does not exist.")
+    manifest = warn_store.load_manifest(opts)
+    if manifest['headers'] is None:
+        print(f"No data in {fname} yet.")
         sys.exit(1)
-
-    headers = {}
-    for col, header in enumerate(csv_headers):
-        headers[header] = col
+    signature = warn_store.signature(manifest)
+    index = warn_index.load_search_index(search_fname, signature)
+    if index is None or len(index['delta']) > warn_index.SEARCH_DELTA_LIMIT:
+        if opts.debug:
+            print(f"Building search index {search_fname}.")
+        with warn_metrics.span("index"):
+            warn_store.ensure_segments(opts, manifest)
+            index = warn_index.build_search_index(search_fname, signature, manifest['headers'],
+                                                  warn_store.iter_rows(opts, manifest))
+
+    with warn_metrics.span("query"):
+        offsets = warn_index.query_search_index(index, opts)
     if opts.debug:
-        print(f"Searching for {opts.search} among {len(rows)} rows of data.")
-    rows_found = []
-    for row in rows:
-        company = row[headers["Company"]]
-        if re.match(opts.search, company):
-            rows_found.append(row)
-    if len(rows_found) > 0:
-        print("\n".join(dump_entries(rows_found, csv_headers)))
+        print(f"Found {len(offsets)} of {len(index['rows']) + len(index['delta'])} rows of data.")
+    if len(offsets) > 0:
+        rows_found = warn_store.read_rows_at(opts, manifest, offsets)
+        print("\n".join(dump_entries(rows_found, index['headers'])))
     else:
         print("No matching companies found.")
 
 
-def send_to_sqs(opts, output_list, list_size):
-    # Reenable the event source mapping, first:
-    aws_lambda = boto3.client("lambda")
-    esm_uuid = os.environ['ESM_UUID']
-    result = aws_lambda.update_event_source_mapping(
-        UUID=esm_uuid,
-        Enabled=True
-    )
-    print(f"result = {result}")
-
-    sqs = boto3.resource('sqs')
-    queue = sqs.Queue(opts.sqs)
-    queue.send_message(
-        MessageBody=json.dumps(output_list),
-        MessageAttributes={
-            'index': {
-                'DataType': 'Number',
-                'StringValue': '1'
-            },
-            'sqs_url': {
-                'DataType': 'String',
-                'StringValue': opts.sqs
-            },
-            'total': {
-                'DataType': 'Number',
-                'StringValue': str(list_size)
-            },
-            'state_abbr': {
-                'DataType': 'String',
-                'StringValue': 'CA'
-            },
-            'state_name': {
-                'DataType': 'String',
-                'StringValue': 'California'
-            },
-            'esm_uuid': {
-                'DataType': 'String',
-                'StringValue': esm_uuid
-            }
-        },
-        DelaySeconds=10
-    )
-
-
-def send_to_api(opts, output_list, list_size):
-    http = urllib3.PoolManager()
-    auth = {'Authorization': f"Bearer {opts.token}"}
-    in_reply_to = None
-    for i, output in enumerate(output_list):
-        params = {'status': f"{output}\n#Warn #Act #WarnAct #CA #California ({i+1}/{list_size})"}
-        if in_reply_to:
-            # Sleep a little, to avoid offending rate limiting rules?
-            time.sleep(10)
-            params['in_reply_to_id'] = in_reply_to
-        result = http.request('POST', f"https://{opts.server}/api/v1/statuses",
-                              headers=auth,
-                              fiels=params)
-        if result.status == 200:
-            print(f"Posted {i+1}/{list_size} successfully.")
-            in_reply_to = result.json()['id']
-        else:
-            print(f"Posting failed: {result.status}")
-            print(result.data)
-            sys.exit(1)
-
-
-def do_update(opts, o_sheet, headers, offset, useful_columns):
-    fname = opts.summary
-    csv_headers = None
-    rows = []
-    dupes = {}
-
-    # During the same run where we add the header, we need to ignore
-    # it for the duplicate checking because the new spreadsheet added
-    # it retroactively for rows we've already processed and posted
-    # previously.
-    #
-    # Afterward we do add that new information to the existing rows so
-    # that the next time, when the new column does exist already, our
-    # duplicate checking doesn't go haywire in spite of it all.
-    ri_added = False
-
+def do_stats(opts):
     try:
-        with open(fname, newline='', encoding="utf-8") as csvfile:
-            reader = csv.reader(csvfile)
-            for row in reader:
-                if csv_headers is None:
-                    ri_seen = False
-                    csv_headers = row
-                    for i, col in enumerate(row):
-                        if col == "Received Date":
-                            # Migrate from Received Date to Processed Date
-                            row[i] = "Processed Date"
-                        elif col == "Related Industry":
-                            ri_seen = True
-                    # Migration step, because the "Related Industry"
-                    # column did not exist when I started tracking
-                    # this in 2023.
-                    if "Related Industry" in headers and not ri_seen:
-                        print("Adding 'Related Industry' to CSV headers.")
-                        csv_headers.append("Related Industry")
-                        ri_added = True
-                else:
-                    rows.append(row)
-                    hashed = hashlib.sha256()
-                    for col in row:
-                        hashed.update(col.encode("utf-8"))
-                    dupes[hashed.digest()] = len(rows) - 1
-    except IOError:
-        print(f"File {csv} did not exist yet.")
+        import warn_stats # pylint: disable=import-outside-toplevel
+    except ImportError:
+        print("The --stats option needs numpy, which is not installed.")
+        sys.exit(1)
+    if opts.db:
+        import warn_sqlite # pylint: disable=import-outside-toplevel
+        csv_headers = warn_sqlite.history_headers(opts)
+        rows = warn_sqlite.iter_rows(opts)
+    else:
+        manifest = warn_store.load_manifest(opts)
+        csv_headers = manifest['headers']
+        rows = warn_store.read_history(opts, manifest)
     if csv_headers is None:
-        # No headers yet? Copy the ones from the spreadsheet
-        csv_headers = []
-        for col in range(useful_columns):
-            o_cell = o_sheet.cell(row=1+offset, column=col+1)
-            header = o_cell.value
-            header = header.replace("\n", " ")
-            header = header.replace("/ ", "/")
-            header = header.replace("  ", " ")
-            csv_headers.append(header)
-        print(f"<{csv_headers}>")
+        print(f"No data in {opts.db or opts.summary} yet.")
+        sys.exit(1)
+    stats = warn_stats.history_stats(rows, csv_headers,
+                                     company_normalizer(COMPANY_NORMALIZATION), opts.top)
+    if stats is None:
+        print(f"No entries with a notice date in {opts.summary}.")
+        sys.exit(1)
+    warn_stats.print_stats(stats, opts.format)
+
+
+def do_update(opts, headers, useful_columns, report_rows):
+    normalize = company_normalizer(COMPANY_NORMALIZATION)
+    if getattr(opts, 'db', None):
+        import warn_sqlite # pylint: disable=import-outside-toplevel
+        csv_headers, newrows, updates = warn_sqlite.update_history(opts, headers, useful_columns,
+                                                                   report_rows, normalize)
     else:
-        if len(csv_headers) != useful_columns:
-            print("Number of columns mismatch between existing data and new data.")
-            sys.exit(1)
-        for header in csv_headers:
-            if header not in headers:
-                print(f"Header '{header}' not present in new data.")
-                sys.exit(1)
-
-    newrows = []
-    dupes_total = 0
-    updates_total = 0
-    merged_total = 0
-    for row in range(o_sheet.max_row - 1 - offset):
-        newrow = []
-        hashed = hashlib.sha256()
-        # Pre-check, to abort if we've reached the end of useful data in the sheet
-        county = o_sheet.cell(row=row+2+offset, column=headers["County/Parish"]).value
-        if not county or county == "Report Summary":
-            break
-        for header in csv_headers:
-            value = o_sheet.cell(row=row+2+offset, column=headers[header]).value
-            if isinstance(value, datetime.datetime):
-                value = value.strftime("%Y-%m-%d")
-            else:
-                value = str(value)
-            newrow.append(value)
-            if not ri_added or header != "Related Industry":
-                hashed.update(value.encode("utf-8"))
-        digest = hashed.digest()
-        if digest in dupes:
-            if ri_added:
-                # Backfill this entry in the original CSV row, so that
-                # future duplicate checking will work
-                value = o_sheet.cell(row=row+2+offset, column=headers["Related Industry"]).value
-                rows[dupes[digest]].append(str(value))
-                merged_total += 1
-            dupes_total += 1
-        else:
-            if opts.debug:
-                print(f"New row: {newrow}")
-            rows.append(newrow)
-            dupes[digest] = len(rows) - 1
-            newrows.append(newrow)
-            updates_total += 1
-    if opts.debug:
-        print(f"{dupes_total} existing rows, {merged_total} merged rows, {updates_total} new rows.")
-    if updates_total > 0:
-        tmp_fname = f"{fname}.{os.getpid()}"
-        if opts.debug:
-            print(f"Creating temporary file {tmp_fname}.")
-        with open(tmp_fname, 'w', newline='', encoding="utf-8") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(csv_headers)
-            for row in rows:
-                writer.writerow(row)
-            csvfile.close()
-        if opts.debug:
-            print(f"Renaming {tmp_fname} to {fname}")
-        os.rename(tmp_fname, fname)
+        csv_headers, newrows, updates = warn_store.update_history(opts, headers, useful_columns,
+                                                                  report_rows, normalize)
     if opts.verbose:
         if len(newrows) > 0:
             print("New entries:")
             print("\n".join(dump_entries(newrows, csv_headers)))
         else:
             print("No new entries.")
-    if len(newrows) > 0 and opts.post:
-        output_list = dump_entries(newrows, csv_headers, False)
-        list_size = len(output_list)
+        if len(updates) > 0:
+            print("Updated entries:")
+            print("\n".join(dump_updates(updates, csv_headers)))
+    post_updates = updates if opts.post and opts.post_updates else []
+    if opts.post and (len(newrows) > 0 or len(post_updates) > 0):
+        with warn_metrics.span("render"):
+            output_list = (dump_entries(newrows, csv_headers, False) +
+                           dump_updates(post_updates, csv_headers, False))
+            statuses = warn_render.render_thread(opts, output_list, newrows, csv_headers)
         if opts.sqs:
-            send_to_sqs(opts, output_list, list_size)
+            warn_post.send_to_sqs(opts, statuses)
+        else:
+            warn_post.send_to_api(opts, statuses)
+
+
+# Parse one of the snapshots for --replay, in a worker process. The
+# rows are sent back as a list; the parsed spreadsheet cache is left
+# alone, as it only keeps the last few versions, and the workers would
+# be evicting each other's.
+def parse_snapshot(opts, fname):
+    snapshot_opts = copy.copy(opts)
+    snapshot_opts.excel = fname
+    snapshot_opts.no_cache = True
+    headers, useful_columns, rows = opts.state.load(snapshot_opts)
+    return fname, headers, useful_columns, list(rows)
+
+
+# Rebuild the history from archived versions of the spreadsheet: they
+# are parsed in parallel, and merged in order, as if --update had been
+# run on each of them, but with the history written only once.
+def do_replay(opts):
+    snapshots = sorted(glob.glob(os.path.join(opts.replay, "*.xlsx")))
+    if not snapshots:
+        print(f"No spreadsheets in {opts.replay}.")
+        sys.exit(1)
+    normalize = company_normalizer(COMPANY_NORMALIZATION)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=opts.workers) as executor:
+        # The results come back in order, each as soon as it (and the
+        # ones before it) are done, so the merging overlaps with the
+        # parsing.
+        parsed = executor.map(parse_snapshot, itertools.repeat(opts), snapshots)
+        parsed = warn_metrics.timed(parsed, "parse", "merge")
+        if opts.db:
+            import warn_sqlite # pylint: disable=import-outside-toplevel
+            new_total = 0
+            updated_total = 0
+            for _fname, headers, useful_columns, report_rows in parsed:
+                _, newrows, updates = warn_sqlite.update_history(opts, headers, useful_columns,
+                                                                 report_rows, normalize)
+                new_total += len(newrows)
+                updated_total += len(updates)
         else:
-            send_to_api(opts, output_list, list_size)
+            _, new_total, updated_total = warn_store.replay_history(opts, parsed, normalize)
+    print(f"Replayed {len(snapshots)} spreadsheets: {new_total} new rows, "
+          f"{updated_total} updated rows.")
+
+
+# Everything specific to the WARN notices of one state: where to get
+# them, how to parse them, and how to find the new ones. The methods of
+# this base class handle an Excel spreadsheet like the California one;
+# states that publish their notices differently override them.
+class StateAdapter:
+    abbr = None
+    name = None
+    url = None
+    content_type = XLSX_TYPE
+    sheet_pattern = None
+
+    # Returns True if there is a new version of the notices
+    def fetch(self, opts):
+        return do_fetch(opts)
+
+    def load(self, opts):
+        return load_report(opts)
+
+    def update(self, opts, headers, useful_columns, rows):
+        return do_update(opts, headers, useful_columns, rows)
+
+
+class CaliforniaAdapter(StateAdapter):
+    abbr = 'CA'
+    name = 'California'
+    url = WARN_URL
+    sheet_pattern = r"(?i)detailed warn report"
+
+
+STATES = {
+    adapter.abbr: adapter for adapter in [CaliforniaAdapter]
+}
+
+
+# The options for processing one state in the Lambda, with its own
+# directory in LAMBDA_TMP, since the states are processed at the same time.
+def state_options(opts, adapter):
+    state_opts = copy.copy(opts)
+    state_opts.state = adapter
+    directory = os.path.join(LAMBDA_TMP, adapter.abbr)
+    os.makedirs(directory, exist_ok=True)
+    state_opts.excel = os.path.join(directory, "warn_report.xlsx")
+    state_opts.summary = os.path.join(directory, "summary.csv")
+    if opts.db:
+        state_opts.db = os.path.join(directory, "summary.db")
+    return state_opts
+
+
+def download_optional(s3_name, key, fname):
+    s3_client = warn_resources.get_client("s3")
+    # Imported along with boto3, by get_client()
+    from botocore.exceptions import ClientError # pylint: disable=import-outside-toplevel
+    try:
+        s3_client.download_file(s3_name, key, fname)
+    except ClientError:
+        print(f"No {key} found.")
+
+
+# Download what do_update() needs of the history: the database (one
+# object) with --db, otherwise the manifest and the digest index. That's
+# all it needs to add a segment with the new rows; the segments
+# themselves are only read when it has to read the history (to rebuild
+# the index, migrate, update, or compact), and then they're streamed
+# from S3 straight into the CSV reader, rather than downloaded to
+# LAMBDA_TMP first. Returns the segments there are in S3.
+def download_history(opts, s3_name):
+    s3_client = warn_resources.get_client("s3")
+    prefix = f"{opts.state.abbr}/"
+
+    def stream_segment(name):
+        body = s3_client.get_object(Bucket=s3_name, Key=prefix + name)['Body']
+        return body.iter_chunks(STREAM_CHUNK)
+    opts.stream_segment = stream_segment
+
+    # Anything left over from an earlier invocation is outdated,
+    # including any segments (see warn_store.segment_lines())
+    stem = os.path.splitext(opts.summary)[0]
+    for fname in [opts.db, warn_store.manifest_name(opts)] + glob.glob(f"{stem}*.csv"):
+        if fname and os.path.exists(fname):
+            os.remove(fname)
+    with warn_metrics.span("download"):
+        if opts.db:
+            download_optional(s3_name, prefix + 'summary.db', opts.db)
+        if not opts.db or not os.path.exists(opts.db):
+            # Without a database yet, do_update() fills it from the CSV history
+            download_optional(s3_name, prefix + 'summary.json', warn_store.manifest_name(opts))
+            if not os.path.exists(warn_store.manifest_name(opts)):
+                # From before there were segments
+                download_optional(s3_name, prefix + 'summary.csv', opts.summary)
+        if not opts.db:
+            # No index yet? do_update() will (re)build it
+            download_optional(s3_name, prefix + 'summary.csv.idx', warn_index.index_name(opts))
+    # To tell which of them do_update() changed
+    opts.downloaded = {fname: file_state(fname)
+                       for fname in [opts.db, warn_store.manifest_name(opts),
+                                     warn_index.index_name(opts)]
+                       if fname and os.path.exists(fname)}
+    if opts.db and os.path.exists(opts.db):
+        return []
+    return warn_store.load_manifest(opts)['segments']
+
+
+def file_state(fname):
+    stat = os.stat(fname)
+    return stat.st_size, stat.st_mtime_ns
+
+
+# Upload the database, or the new segments, then the manifest (which
+# switches S3 over to them: segments are never overwritten) and the
+# digest index, if do_update() changed them, then the spreadsheet and
+# the fetch metadata, so that a failed run is retried, and only then
+# delete the segments no longer listed. upload_file() does it in parts.
+def upload_history(opts, s3_name, old_segments):
+    s3_client = warn_resources.get_client("s3")
+    prefix = f"{opts.state.abbr}/"
+    with warn_metrics.span("upload"):
+        if opts.db:
+            files = [(opts.db, 'summary.db')]
+        else:
+            manifest = warn_store.load_manifest(opts)
+            for segment in manifest['segments']:
+                if segment not in old_segments:
+                    s3_client.upload_file(warn_store.segment_path(opts, segment['name']),
+                                          s3_name, prefix + segment['name'])
+            files = [
+                (warn_store.manifest_name(opts), 'summary.json'),
+                (warn_index.index_name(opts), 'summary.csv.idx')
+            ]
+        files = [(fname, key) for fname, key in files
+                 if os.path.exists(fname) and opts.downloaded.get(fname) != file_state(fname)]
+        files.extend([
+            (opts.excel, 'warn_report.xlsx'),
+            (fetch_meta_name(opts), 'warn_report.xlsx.json')
+        ])
+        for fname, key in files:
+            if os.path.exists(fname):
+                s3_client.upload_file(fname, s3_name, prefix + key)
+                warn_metrics.count("uploads")
+        if not opts.db:
+            # Segments that were compacted away
+            names = {segment['name'] for segment in manifest['segments']}
+            for segment in old_segments:
+                if segment['name'] not in names:
+                    s3_client.delete_object(Bucket=s3_name, Key=prefix + segment['name'])
+
+
+# Fetch, and if anything changed, process one state (S3 under <abbr>/)
+def process_state(opts, s3_name):
+    adapter = opts.state
+    prefix = f"{adapter.abbr}/"
+
+    # All we need to find out whether the spreadsheet changed is what we
+    # know about the version we fetched last time.
+    meta_fname = fetch_meta_name(opts)
+    with warn_metrics.span("download"):
+        download_optional(s3_name, prefix + 'warn_report.xlsx.json', meta_fname)
+    meta_state = file_state(meta_fname) if os.path.exists(meta_fname) else None
+
+    # process_report.py --fetch --debug
+    opts.debug = True
+    changed = adapter.fetch(opts)
+    if changed is None:
+        sys.exit(1)
+    if not changed:
+        # Nothing changed, so there's nothing to download, parse, or upload,
+        # other than new ETag and Last-Modified headers for the same
+        # content (see do_fetch()), without which every next run would
+        # fetch all of it again.
+        if os.path.exists(meta_fname) and file_state(meta_fname) != meta_state:
+            with warn_metrics.span("upload"):
+                warn_resources.get_client("s3").upload_file(meta_fname, s3_name,
+                                                            prefix + 'warn_report.xlsx.json')
+            warn_metrics.count("uploads")
+        print(f"{adapter.abbr}: No changes to the spreadsheet.")
+        return False
+
+    # We already have the new spreadsheet, so no need for the previous
+    # one, only the history.
+    old_segments = download_history(opts, s3_name)
+
+    # process_report.py --update --sqs <sqs_url>
+    opts.debug = False
+    headers, useful_columns, report_rows = adapter.load(opts)
+    adapter.update(opts, headers, useful_columns, report_rows)
+
+    upload_history(opts, s3_name, old_segments)
+    return True
 
 
 # Call from EventBridge, to replace this cron job:
@@ -560,59 +908,90 @@ def do_update(opts, o_sheet, headers, offset, useful_columns):
 #  process_report.py --fetch --debug
 #  process_report.py --verbose --update --post --server <server> --token <token>
 #
+# for each of the states in $STATES (by default only CA), all at the
+# same time, so the run takes as long as the slowest state, rather than
+# all of them added up.
+#
 # We know that event & lambda_context are unused; '_' prefix avoids complaint
 def report_handler(_event, _lambda_context):
+    warn_metrics.reset()
+    try:
+        with warn_metrics.span("invocation"):
+            report_states()
+    finally:
+        # One line with all the metrics of this invocation, for CloudWatch
+        print(warn_metrics.emf_line("report"))
+
+
+def report_states():
     s3_name = os.environ['S3_NAME']
     sqs_url = os.environ['SQS_URL']
-
     esm_uuid = os.environ['ESM_UUID']
+    states = os.environ.get('STATES', 'CA').split(",")
 
-    # Testing:
-    aws_lambda = boto3.client("lambda")
-    result = aws_lambda.get_event_source_mapping(UUID=esm_uuid)
-    print(f"result = {result}")
     opts = parse_options()
-
-    os.chdir("/tmp")
-    # Download the most recent spreadsheet and CSV file from S3
-    # This should be okay as long as we stay under 512MB in /tmp
-    #
-    # https://docs.aws.amazon.com/lambda/latest/dg/gettingstarted-limits.html
-    s3_resource = boto3.resource("s3")
-    bucket = s3_resource.Bucket(s3_name)
-    bucket.download_file('CA/warn_report.xlsx', 'warn_report.xlsx')
-    bucket.download_file('CA/summary.csv', 'summary.csv')
-
-    # process_report.py --fetch --debug
-    opts.debug = True
-    do_fetch(opts)
-
-    # process_report.py --update --sqs <sqs_url>
-    opts.debug = False
     opts.verbose = True
     opts.post = True
+    opts.post_updates = os.environ.get('POST_UPDATES', 'false').lower() in ('1', 'true', 'yes')
     opts.sqs = sqs_url
-    o_sheet, headers, offset, useful_columns = load_report(opts)
-    do_update(opts, o_sheet, headers, offset, useful_columns)
-
-    # Upload the (potentially) updated spreadsheet and CSV file to S3
-    bucket.upload_file('warn_report.xlsx', 'CA/warn_report.xlsx')
-    bucket.upload_file('summary.csv', 'CA/summary.csv')
+    opts.threads = f"s3://{s3_name}/threads"
+    if os.environ.get('HISTORY_BACKEND', 'csv') == 'sqlite':
+        # Set for real per state, by state_options()
+        opts.db = "summary.db"
+    os.chdir(LAMBDA_TMP)
+
+    adapters = []
+    for abbr in states:
+        if abbr.strip() not in STATES:
+            print(f"Unknown state {abbr}, skipping it.")
+            continue
+        adapters.append(STATES[abbr.strip()]())
+    if not adapters:
+        return
+    warn_metrics.count("states", len(adapters))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(adapters)) as executor:
+        changed = list(executor.map(lambda adapter: process_state(state_options(opts, adapter),
+                                                                  s3_name),
+                                    adapters))
+    if any(changed):
+        # Testing:
+        with warn_metrics.span("esm"):
+            result = warn_resources.get_client("lambda").get_event_source_mapping(UUID=esm_uuid)
+        print(f"result = {result}")
 
 
 def main():
     opts = parse_options()
+    if not opts.profile:
+        return do_action(opts)
+    warn_metrics.reset(tracing=True)
+    try:
+        return do_action(opts)
+    finally:
+        warn_metrics.print_profile()
+
 
+def do_action(opts):
     if opts.dump:
-        o_sheet, headers, offset, _ = load_report(opts)
-        return do_dump(o_sheet, headers, offset)
+        headers, _, report_rows = opts.state.load(opts)
+        return do_dump(headers, report_rows)
     if opts.fetch:
-        return do_fetch(opts)
-    if opts.search:
+        changed = opts.state.fetch(opts)
+        if changed is None:
+            sys.exit(1)
+        return changed
+    if opts.searching:
         return do_search(opts)
+    if opts.stats:
+        return do_stats(opts)
     if opts.update:
-        o_sheet, headers, offset, useful_columns = load_report(opts)
-        return do_update(opts, o_sheet, headers, offset, useful_columns)
+        headers, useful_columns, report_rows = opts.state.load(opts)
+        return opts.state.update(opts, headers, useful_columns, report_rows)
+    if opts.replay:
+        return do_replay(opts)
+    if opts.watch:
+        return warn_watch.watch(opts)
     print("Not Yet Implemented.")
     return False
 
@@ -0,0 +1,130 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import array
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+# Parsing the spreadsheet is the most expensive part of a run, so the
+# parsed rows are cached, once per version of the spreadsheet (by the
+# SHA-256 of its content), in a columnar file in the cache directory:
+#
+#   magic (8 bytes) | metadata length (4 bytes) | JSON metadata | column codes
+#
+# Each column is dictionary encoded: the metadata holds the distinct
+# values of the column, and the column codes (4 bytes per cell) index
+# into those. Counties, actions, dates and the like repeat a lot, so
+# this is compact, and the codes can be used straight from a memory
+# map without reading the whole file.
+CACHE_MAGIC = b"WARNCOL1"
+CACHE_HEADER = struct.Struct("<8sI")
+CACHE_SUFFIX = ".cols"
+
+
+def file_digest(fname):
+    hashed = hashlib.sha256()
+    with open(fname, 'rb') as infile:
+        for block in iter(lambda: infile.read(1048576), b""):
+            hashed.update(block)
+    return hashed.hexdigest()
+
+
+def cache_dir(opts):
+    if opts.cache_dir:
+        return opts.cache_dir
+    return os.path.join(os.path.dirname(os.path.abspath(opts.excel)), ".warn_cache")
+
+
+# The views of the codes have to be released before the mmap can be
+# closed, also when the rows aren't read to the end.
+def iter_cached_report(cache_file, cache_map, meta, codes_offset):
+    codes = []
+    try:
+        offset = codes_offset
+        for _ in meta['columns']:
+            codes.append(memoryview(cache_map)[offset:offset + 4 * meta['rows']].cast('I'))
+            offset += 4 * meta['rows']
+        columns = list(zip(meta['columns'], codes))
+        for i in range(meta['rows']):
+            yield [values[col_codes[i]] for values, col_codes in columns]
+    finally:
+        for col_codes in codes:
+            col_codes.release()
+        cache_map.close()
+        cache_file.close()
+
+
+# Returns the same as load_report() if this version of the spreadsheet
+# is in the cache, None if it isn't.
+def load_cached_report(opts, digest):
+    fname = os.path.join(cache_dir(opts), digest + CACHE_SUFFIX)
+    try:
+        cache_file = open(fname, 'rb') # pylint: disable=consider-using-with
+    except IOError:
+        return None
+    try:
+        cache_map = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, meta_size = CACHE_HEADER.unpack_from(cache_map)
+        meta = json.loads(cache_map[CACHE_HEADER.size:CACHE_HEADER.size + meta_size])
+    except (ValueError, struct.error):
+        print(f"Ignoring damaged cache file {fname}.")
+        cache_file.close()
+        return None
+    if magic != CACHE_MAGIC or meta['byteorder'] != sys.byteorder:
+        cache_map.close()
+        cache_file.close()
+        return None
+    if opts.debug:
+        print(f"Using cached rows from {fname}")
+    # Mark it as recently used, for the eviction
+    os.utime(fname)
+    rows = iter_cached_report(cache_file, cache_map, meta, CACHE_HEADER.size + meta_size)
+    return meta['headers'], meta['useful_columns'], rows
+
+
+def write_cache(opts, digest, headers, useful_columns, columns, codes, count):
+    directory = cache_dir(opts)
+    os.makedirs(directory, exist_ok=True)
+    fname = os.path.join(directory, digest + CACHE_SUFFIX)
+    meta = json.dumps({
+        'byteorder': sys.byteorder,
+        'headers': headers,
+        'useful_columns': useful_columns,
+        'rows': count,
+        'columns': [list(values) for values in columns]
+    }, default=str).encode("utf-8")
+    tmp_fname = f"{fname}.{os.getpid()}"
+    with open(tmp_fname, 'wb') as cache_file:
+        cache_file.write(CACHE_HEADER.pack(CACHE_MAGIC, len(meta)))
+        cache_file.write(meta)
+        for col_codes in codes:
+            col_codes.tofile(cache_file)
+    os.rename(tmp_fname, fname)
+    if opts.debug:
+        print(f"Cached {count} rows in {fname}")
+
+    # Only keep the most recently used versions around
+    cached = [os.path.join(directory, name) for name in os.listdir(directory)
+              if name.endswith(CACHE_SUFFIX)]
+    cached.sort(key=os.path.getmtime, reverse=True)
+    for old_fname in cached[opts.cache_keep:]:
+        if opts.debug:
+            print(f"Evicting {old_fname} from the cache")
+        os.remove(old_fname)
+
+
+# Pass the rows through while building up the columns, and write them
+# to the cache once we've seen all of them.
+def cache_report(opts, digest, headers, useful_columns, rows):
+    columns = [{} for _ in range(useful_columns)]
+    codes = [array.array('I') for _ in range(useful_columns)]
+    count = 0
+    for row in rows:
+        for values, col_codes, value in zip(columns, codes, row):
+            col_codes.append(values.setdefault(value, len(values)))
+        count += 1
+        yield row
+    write_cache(opts, digest, headers, useful_columns, columns, codes, count)
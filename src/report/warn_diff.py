@@ -0,0 +1,82 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import hashlib
+
+# The digest of a row (warn_index.row_digest()) covers all of its
+# values, so when EDD corrects a notice (the number of employees, the
+# effective date) the corrected row looks like a new one. To tell the
+# two apart, every row also gets a natural key: the normalized company
+# name, the address, and the notice date, which a correction normally
+# leaves alone.
+#
+# A row of the report whose digest isn't in the history is then either
+# an update of a row in the history with the same key, or a new row.
+# It's an update only if that row (the stale one) is no longer in the
+# report itself, since there can be more than one notice with the same
+# key (a layoff and a closure, for instance), and each stale row can
+# only be updated once.
+KEY_COLUMNS = ["Company", "Address", "Notice Date"]
+
+
+def key_columns(csv_headers):
+    return [csv_headers.index(header) if header in csv_headers else None
+            for header in KEY_COLUMNS]
+
+
+# Returns a function that returns the natural key of a row, a SHA-256
+# digest like the row digest. The company is normalized the way
+# group_entries() does it (ignoring case), the address only for
+# whitespace and case.
+def key_function(csv_headers, normalize):
+    company_col, address_col, notice_col = key_columns(csv_headers)
+
+    def value(row, col):
+        return row[col] if col is not None and col < len(row) else ""
+
+    def natural_key(row):
+        hashed = hashlib.sha256()
+        hashed.update(normalize(value(row, company_col))[1].encode("utf-8"))
+        hashed.update(b"\0")
+        hashed.update(" ".join(value(row, address_col).split()).lower().encode("utf-8"))
+        hashed.update(b"\0")
+        hashed.update(value(row, notice_col).encode("utf-8"))
+        return hashed.digest()
+    return natural_key
+
+
+# The history rows per natural key, as (reference, digest) pairs, from
+# the digest of every row in the history and its key. The reference
+# is the digest itself.
+def keyed_history(known):
+    by_key = {}
+    for digest, key in known.items():
+        by_key.setdefault(key, []).append((digest, digest))
+    return by_key
+
+
+# The hash join: fresh are the (row, digest) pairs of the rows of the
+# report that aren't in the history, in order, seen the digests of all
+# of the rows in the report, and keyed() returns the (reference,
+# digest) pairs of the rows in the history with a given natural key.
+# Returns the new rows and the updates, the former as (row, digest, key)
+# and the latter as (reference of the stale row, row, digest, key).
+def classify(fresh, seen, keyed, natural_key):
+    newrows = []
+    updates = []
+    claimed = set()
+    for row, digest in fresh:
+        key = natural_key(row)
+        stale = [ref for ref, old in keyed(key) if old not in seen and ref not in claimed]
+        if stale:
+            claimed.add(stale[0])
+            updates.append((stale[0], row, digest, key))
+        else:
+            newrows.append((row, digest, key))
+    return newrows, updates
+
+
+# The (header, old value, new value) of every column an update changed
+def changes(csv_headers, old, new):
+    return [(header, old[col] if col < len(old) else "", new[col])
+            for col, header in enumerate(csv_headers)
+            if col >= len(old) or old[col] != new[col]]
@@ -0,0 +1,452 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+
+# The digest index is a sidecar file next to summary.csv, holding the
+# SHA-256 digest of every row in the history, along with its natural key
+# (see warn_diff), so that we don't have to read and rehash all of the
+# history to find out which rows are new or updated. Layout:
+#
+#   magic (8 bytes) | history size (8 bytes) | history digest (32 bytes) |
+#   digest and key (32 + 32 bytes) per row
+#
+# The size and digest (see warn_store.signature()) tie the index to the
+# version of the history it was built from. (The mtime isn't useful
+# for this, since every download from S3 resets it.) When they don't
+# match, the index is considered stale and rebuilt from the history.
+INDEX_MAGIC = b"WARNIDX2"
+INDEX_HEADER = struct.Struct(">8sQ32s")
+DIGEST_SIZE = 32
+ENTRY_SIZE = 2 * DIGEST_SIZE
+
+
+def index_name(opts):
+    return f"{opts.summary}.idx"
+
+
+def row_digest(row):
+    hashed = hashlib.sha256()
+    for col in row:
+        hashed.update(col.encode("utf-8"))
+    return hashed.digest()
+
+
+# Returns the natural key per digest in the index (in the order of the
+# history), or None if the index is missing, damaged, or doesn't match
+# the current history.
+def load_digest_index(fname, signature):
+    try:
+        with open(fname, 'rb') as idxfile:
+            data = idxfile.read()
+    except IOError:
+        return None
+    if len(data) < INDEX_HEADER.size or (len(data) - INDEX_HEADER.size) % ENTRY_SIZE:
+        return None
+    magic, size, tail = INDEX_HEADER.unpack_from(data)
+    if magic != INDEX_MAGIC or (size, tail) != signature:
+        return None
+    return {data[i:i+DIGEST_SIZE]: data[i+DIGEST_SIZE:i+ENTRY_SIZE]
+            for i in range(INDEX_HEADER.size, len(data), ENTRY_SIZE)}
+
+
+# entries are (digest, natural key) pairs
+def write_digest_index(fname, signature, entries):
+    size, tail = signature
+    tmp_fname = f"{fname}.{os.getpid()}"
+    with open(tmp_fname, 'wb') as idxfile:
+        idxfile.write(INDEX_HEADER.pack(INDEX_MAGIC, size, tail))
+        idxfile.write(b"".join(digest + key for digest, key in entries))
+    os.rename(tmp_fname, fname)
+
+
+# Add the entries for rows that were just added to the history.
+# The header is rewritten last; if we don't get that far, the index
+# no longer matches the history and will be rebuilt next time.
+def append_digest_index(fname, signature, entries):
+    size, tail = signature
+    with open(fname, 'r+b') as idxfile:
+        idxfile.seek(0, os.SEEK_END)
+        idxfile.write(b"".join(digest + key for digest, key in entries))
+        idxfile.seek(0)
+        idxfile.write(INDEX_HEADER.pack(INDEX_MAGIC, size, tail))
+
+
+# The search index is another sidecar file next to summary.csv, used by
+# --search to find rows without scanning (and regex matching) every row
+# in the history. A search only reads the parts of it that it needs:
+# the file is mapped into memory, and everything in the base is found
+# by offset or by binary search, without parsing the rest.
+#
+#   - The base: a header (magic, and where the directory is), the row
+#     table, with a fixed size record per row (see SEARCH_ROW), and the
+#     lookup tables, each a sorted list of keys with the row IDs (the
+#     position in the row table) for every key: the distinct company
+#     names (for prefix searches), trigrams of those names (with the
+#     names they occur in, for substring searches), the counties and the
+#     cities (lowercase), and the notice dates. Last, the directory: a
+#     JSON object with the CSV headers and where all of that is.
+#   - After the base, a line with the signature of the history (see
+#     warn_store.signature()) as of then.
+#   - Rows appended by do_update() since the base was built, as JSON,
+#     one per line, each batch of them followed by a signature line.
+#     There are only a few of these, so they are simply checked one by
+#     one, until there are enough of them to rebuild the base.
+#
+# The last signature line has to match for the index to be used.
+SEARCH_DELTA_LIMIT = 5000
+SEARCH_COLUMNS = ["Company", "County/Parish", "City", "Notice Date", "No. Of Employees"]
+REGEX_SPECIAL = ".^$*+?{}[]\\|()"
+SEARCH_MAGIC = b"WARNSRC2"
+# Magic, offset and size of the directory
+SEARCH_HEADER = struct.Struct("<8sQQ")
+# Offset in the history, number of employees, and the position of the
+# company name, county, city and notice date in their lookup tables
+SEARCH_ROW = struct.Struct("<QqIIII")
+SEARCH_TABLES = ["names", "trigrams", "counties", "cities", "notices"]
+
+# Offsets into each row (as JSON) of the search index
+ROW_OFFSET = 0
+ROW_COMPANY = 1
+ROW_COUNTY = 2
+ROW_CITY = 3
+ROW_NOTICE = 4
+ROW_EMPLOYEES = 5
+
+
+def search_index_name(opts):
+    return f"{opts.summary}.search"
+
+
+def search_entry(offset, row, columns):
+    entry = [offset]
+    for col in columns:
+        entry.append(row[col] if col is not None else "")
+    try:
+        entry[ROW_EMPLOYEES] = int(entry[ROW_EMPLOYEES])
+    except ValueError:
+        entry[ROW_EMPLOYEES] = 0
+    return entry
+
+
+def search_columns(csv_headers):
+    return [csv_headers.index(header) if header in csv_headers else None
+            for header in SEARCH_COLUMNS]
+
+
+def trigrams(text):
+    text = text.lower()
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+def signature_line(signature):
+    size, tail = signature
+    return json.dumps({'signature': [size, tail.hex()]}) + "\n"
+
+
+# A lookup table in the base of the search index: the offsets of the
+# keys (n + 1 of them, from the start of the keys), the offsets of the
+# lists of IDs (n + 1, in IDs from the start of the IDs), the keys (in
+# UTF-8), and the IDs (4 bytes each). Writes it to the file, and
+# returns where it is, for the directory.
+def write_lookup_table(outfile, keys, ids):
+    encoded = [key.encode("utf-8") for key in keys]
+    key_offsets = [0]
+    for key in encoded:
+        key_offsets.append(key_offsets[-1] + len(key))
+    id_offsets = [0]
+    for key_ids in ids:
+        id_offsets.append(id_offsets[-1] + len(key_ids))
+    table = {'count': len(keys), 'key_offsets': outfile.tell()}
+    outfile.write(struct.pack(f"<{len(key_offsets)}Q", *key_offsets))
+    table['id_offsets'] = outfile.tell()
+    outfile.write(struct.pack(f"<{len(id_offsets)}Q", *id_offsets))
+    table['keys'] = outfile.tell()
+    outfile.write(b"".join(encoded))
+    table['ids'] = outfile.tell()
+    for key_ids in ids:
+        outfile.write(struct.pack(f"<{len(key_ids)}I", *key_ids))
+    return table
+
+
+# A lookup table as a sorted sequence of its keys, for bisect, which
+# reads (and decodes) only the keys it looks at.
+class LookupTable:
+    def __init__(self, data, table):
+        self.data = data
+        self.count = table['count']
+        self.key_offsets = table['key_offsets']
+        self.id_offsets = table['id_offsets']
+        self.keys = table['keys']
+        self.ids_start = table['ids']
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        start, end = struct.unpack_from("<QQ", self.data, self.key_offsets + 8 * position)
+        return self.data[self.keys + start:self.keys + end].decode("utf-8")
+
+    # The IDs for the key at this position
+    def ids(self, position):
+        start, end = struct.unpack_from("<QQ", self.data, self.id_offsets + 8 * position)
+        return struct.unpack_from(f"<{end - start}I", self.data, self.ids_start + 4 * start)
+
+    def get(self, key):
+        position = bisect.bisect_left(self, key)
+        if position < self.count and self[position] == key:
+            return self.ids(position)
+        return ()
+
+
+# The row table, as a sequence of (offset, number of employees)
+class RowTable:
+    def __init__(self, data, table):
+        self.data = data
+        self.count = table['count']
+        self.start = table['start']
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, rowid):
+        if not 0 <= rowid < self.count:
+            raise IndexError(rowid)
+        return SEARCH_ROW.unpack_from(self.data, self.start + SEARCH_ROW.size * rowid)[:2]
+
+    def __iter__(self):
+        end = self.start + SEARCH_ROW.size * self.count
+        for row in SEARCH_ROW.iter_unpack(self.data[self.start:end]):
+            yield row[:2]
+
+
+# The keys of a lookup table, sorted, with the row IDs for each
+def grouped(rowids_by_key):
+    keys = sorted(rowids_by_key)
+    return keys, [rowids_by_key[key] for key in keys]
+
+
+# Build the index from the rows (with their offsets) of the history.
+# Returns the index the way query_search_index() wants it.
+def build_search_index(fname, signature, csv_headers, rows_with_offsets):
+    columns = search_columns(csv_headers)
+    rows = [search_entry(offset, row, columns) for offset, row in rows_with_offsets]
+
+    by_key = {table: {} for table in SEARCH_TABLES if table != "trigrams"}
+    for rowid, entry in enumerate(rows):
+        by_key['names'].setdefault(entry[ROW_COMPANY], []).append(rowid)
+        by_key['counties'].setdefault(entry[ROW_COUNTY].lower(), []).append(rowid)
+        by_key['cities'].setdefault(entry[ROW_CITY].lower(), []).append(rowid)
+        by_key['notices'].setdefault(entry[ROW_NOTICE], []).append(rowid)
+    lookups = {table: grouped(rowids) for table, rowids in by_key.items()}
+    name_trigrams = {}
+    for nameid, name in enumerate(lookups['names'][0]):
+        for trigram in trigrams(name):
+            name_trigrams.setdefault(trigram, []).append(nameid)
+    lookups['trigrams'] = grouped(name_trigrams)
+    positions = {table: {key: position for position, key in enumerate(keys)}
+                 for table, (keys, _ids) in lookups.items()}
+
+    tmp_fname = f"{fname}.{os.getpid()}"
+    with open(tmp_fname, 'wb') as idxfile:
+        idxfile.write(SEARCH_HEADER.pack(SEARCH_MAGIC, 0, 0))
+        directory = {'headers': csv_headers,
+                     'rows': {'count': len(rows), 'start': idxfile.tell()}}
+        idxfile.write(b"".join(
+            SEARCH_ROW.pack(entry[ROW_OFFSET], entry[ROW_EMPLOYEES],
+                            positions['names'][entry[ROW_COMPANY]],
+                            positions['counties'][entry[ROW_COUNTY].lower()],
+                            positions['cities'][entry[ROW_CITY].lower()],
+                            positions['notices'][entry[ROW_NOTICE]])
+            for entry in rows))
+        for table in SEARCH_TABLES:
+            directory[table] = write_lookup_table(idxfile, *lookups[table])
+        directory_start = idxfile.tell()
+        idxfile.write(json.dumps(directory, separators=(',', ':')).encode("utf-8"))
+        directory_end = idxfile.tell()
+        idxfile.write(b"\n" + signature_line(signature).encode("utf-8"))
+        idxfile.seek(0)
+        idxfile.write(SEARCH_HEADER.pack(SEARCH_MAGIC, directory_start,
+                                         directory_end - directory_start))
+    os.rename(tmp_fname, fname)
+    return load_search_index(fname, signature)
+
+
+def last_signature(fname):
+    try:
+        with open(fname, 'rb') as idxfile:
+            idxfile.seek(0, os.SEEK_END)
+            idxfile.seek(max(0, idxfile.tell() - 4096))
+            lines = idxfile.read().splitlines()
+    except IOError:
+        return None
+    try:
+        return json.loads(lines[-1])['signature']
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+# Cheap check (only the end of the file is read) whether the search
+# index is in sync with the history.
+def search_index_current(fname, signature):
+    size, tail = signature
+    return last_signature(fname) == [size, tail.hex()]
+
+
+# Returns the index, or None if it's missing, out of sync with the
+# history, or from before it had this layout. Only the directory and
+# the rows appended since the base was built are read right away.
+def load_search_index(fname, signature):
+    if not search_index_current(fname, signature):
+        return None
+    with open(fname, 'rb') as idxfile:
+        data = mmap.mmap(idxfile.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data) < SEARCH_HEADER.size:
+        return None
+    magic, directory_start, directory_size = SEARCH_HEADER.unpack_from(data)
+    if magic != SEARCH_MAGIC:
+        return None
+    base_end = directory_start + directory_size
+    directory = json.loads(data[directory_start:base_end])
+    delta = []
+    for line in data[base_end:].splitlines():
+        if line:
+            entry = json.loads(line)
+            if 'row' in entry:
+                delta.append(entry['row'])
+    index = {'headers': directory['headers'],
+             'rows': RowTable(data, directory['rows']),
+             'delta': delta}
+    for table in SEARCH_TABLES:
+        index[table] = LookupTable(data, directory[table])
+    return index
+
+
+# Add the rows (with their offsets) that do_update() added to the
+# history. Only call this if the index was in sync with the history
+# before the rows got added.
+def append_search_index(fname, signature, csv_headers, rows_with_offsets):
+    columns = search_columns(csv_headers)
+    with open(fname, 'a', encoding="utf-8") as idxfile:
+        for offset, row in rows_with_offsets:
+            idxfile.write(json.dumps({'row': search_entry(offset, row, columns)}) + "\n")
+        idxfile.write(signature_line(signature))
+
+
+# The part of a regular expression that any match has to start with
+def literal_prefix(pattern):
+    if "|" in pattern:
+        return ""
+    prefix = []
+    for char in pattern:
+        if char in REGEX_SPECIAL:
+            if char in "*?{" and prefix:
+                # The previous character is optional
+                prefix.pop()
+            break
+        prefix.append(char)
+    return "".join(prefix)
+
+
+# The lookups below return the rows that match that one option exactly,
+# so all that's left to check per row is the number of employees.
+def pattern_rows(index, search, pattern):
+    names = index['names']
+    prefix = literal_prefix(search)
+    rowids = []
+    nameid = bisect.bisect_left(names, prefix) if prefix else 0
+    while nameid < len(names):
+        name = names[nameid]
+        if not name.startswith(prefix):
+            break
+        if pattern.match(name):
+            rowids.extend(names.ids(nameid))
+        nameid += 1
+    return rowids
+
+
+def contains_rows(index, text):
+    names = index['names']
+    nameids = None
+    for trigram in trigrams(text):
+        found = set(index['trigrams'].get(trigram))
+        nameids = found if nameids is None else nameids & found
+    if nameids is None:
+        # Too short for trigrams, check all the names
+        nameids = range(len(names))
+    rowids = []
+    for nameid in nameids:
+        if text.lower() in names[nameid].lower():
+            rowids.extend(names.ids(nameid))
+    return rowids
+
+
+def date_rows(index, since, until):
+    notices = index['notices']
+    first = bisect.bisect_left(notices, since) if since else 0
+    last = bisect.bisect_right(notices, until) if until else len(notices)
+    rowids = []
+    for position in range(first, last):
+        rowids.extend(notices.ids(position))
+    return rowids
+
+
+def entry_matches(entry, opts, pattern):
+    if pattern and not pattern.match(entry[ROW_COMPANY]):
+        return False
+    if opts.contains and opts.contains.lower() not in entry[ROW_COMPANY].lower():
+        return False
+    if opts.county and opts.county.lower() != entry[ROW_COUNTY].lower():
+        return False
+    if opts.city and opts.city.lower() != entry[ROW_CITY].lower():
+        return False
+    if opts.since and entry[ROW_NOTICE] < opts.since:
+        return False
+    if opts.until and entry[ROW_NOTICE] > opts.until:
+        return False
+    if opts.min_employees and entry[ROW_EMPLOYEES] < opts.min_employees:
+        return False
+    return True
+
+
+# Returns the CSV file offsets of the rows matching all of the search
+# options. Every option but the number of employees has a lookup, which
+# gives the rows matching it; the rows matching all of them are the
+# intersection, and only those get read from the row table. Without
+# any of those options, that's all the rows. The rows appended since the
+# base was built get checked against all of the options.
+def query_search_index(index, opts):
+    pattern = re.compile(opts.search) if opts.search else None
+    candidates = []
+    if pattern:
+        candidates.append(pattern_rows(index, opts.search, pattern))
+    if opts.contains:
+        candidates.append(contains_rows(index, opts.contains))
+    if opts.county:
+        candidates.append(index['counties'].get(opts.county.lower()))
+    if opts.city:
+        candidates.append(index['cities'].get(opts.city.lower()))
+    if opts.since or opts.until:
+        candidates.append(date_rows(index, opts.since, opts.until))
+
+    rows = index['rows']
+    if candidates:
+        candidates.sort(key=len)
+        rowids = set(candidates[0])
+        for other in candidates[1:]:
+            rowids.intersection_update(other)
+        found = (rows[rowid] for rowid in rowids)
+    else:
+        found = iter(rows)
+    offsets = [offset for offset, employees in found
+               if not opts.min_employees or employees >= opts.min_employees]
+    offsets.extend(entry[ROW_OFFSET] for entry in index['delta']
+                   if entry_matches(entry, opts, pattern))
+    return offsets
@@ -0,0 +1,138 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+# Where the time of an invocation goes (spans, in milliseconds, added up
+# if a stage runs more than once, or for more than one state at the
+# same time), how much got done (counts), and how much memory it took.
+# report_handler() emits all of it as one CloudWatch embedded metric
+# format (EMF) line per invocation, process_report.py --profile prints
+# it instead.
+#
+# Setting METRICS_TRACEMALLOC to "true" in the environment (--profile
+# always does) also traces the Python allocations, which is a lot more
+# detailed than the peak RSS, but slows everything down.
+NAMESPACE = "WARN"
+METRICS = {'spans': {}, 'counts': {}, 'traced': {}}
+LOCK = threading.Lock()
+
+
+def reset(tracing=None):
+    if tracing is None:
+        tracing = os.environ.get('METRICS_TRACEMALLOC', 'false').lower() in ('1', 'true', 'yes')
+    with LOCK:
+        for values in METRICS.values():
+            values.clear()
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    if tracing:
+        tracemalloc.start()
+
+
+def add_time(name, seconds):
+    with LOCK:
+        METRICS['spans'][name] = METRICS['spans'].get(name, 0.0) + seconds * 1000
+        if tracemalloc.is_tracing():
+            # The high-water mark as of the end of this stage
+            METRICS['traced'][name] = tracemalloc.get_traced_memory()[1]
+
+
+def count(name, value=1):
+    with LOCK:
+        METRICS['counts'][name] = METRICS['counts'].get(name, 0) + value
+
+
+@contextlib.contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+# Pass the items of iterable through, counting them, and adding the time
+# it takes to produce them to name, and (if set) the time the consumer
+# spends on them in between to consumer.
+def timed(iterable, name, consumer=None):
+    produced = 0.0
+    consumed = 0.0
+    items = 0
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                produced += time.perf_counter() - start
+                break
+            resumed = time.perf_counter()
+            produced += resumed - start
+            items += 1
+            yield item
+            consumed += time.perf_counter() - resumed
+    finally:
+        add_time(name, produced)
+        count(f"{name}_rows", items)
+        if consumer:
+            add_time(consumer, consumed)
+
+
+# The peak resident set size of the process, in MB. In a warm Lambda
+# that's the peak of all its invocations so far.
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def collect():
+    with LOCK:
+        values = {f"{name}_ms": round(value, 3) for name, value in METRICS['spans'].items()}
+        values.update(METRICS['counts'])
+        values.update({f"{name}_traced_mb": round(value / 1048576, 3)
+                       for name, value in METRICS['traced'].items()})
+    values['peak_rss_mb'] = round(peak_rss(), 3)
+    if tracemalloc.is_tracing():
+        values['traced_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 1048576, 3)
+    return values
+
+
+def unit(name):
+    if name.endswith("_ms"):
+        return "Milliseconds"
+    if name.endswith("_mb"):
+        return "Megabytes"
+    return "Count"
+
+
+# One line of JSON in the CloudWatch embedded metric format, which
+# CloudWatch turns into metrics with the function as their dimension.
+def emf_line(function):
+    values = collect()
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': NAMESPACE,
+                'Dimensions': [["Function"]],
+                'Metrics': [{'Name': name, 'Unit': unit(name)} for name in sorted(values)]
+            }]
+        },
+        'Function': function
+    }
+    document.update(values)
+    return json.dumps(document)
+
+
+def print_profile():
+    values = collect()
+    width = max(len(name) for name in values)
+    print("Profile:")
+    for name in sorted(values):
+        print(f"  {name:{width}s} : {values[name]}")
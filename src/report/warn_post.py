@@ -0,0 +1,260 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import datetime
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+import warn_metrics
+import warn_resources
+
+# Threads are stored once, one object (or file) per item, so that the
+# SQS messages only need to say which thread (the run ID) and which item
+# of it to post next, and the posts Lambda only needs to fetch that item.
+def thread_item_key(prefix, run_id, index):
+    return f"{prefix}/{run_id}/{index:04d}.txt"
+
+
+def store_thread(opts, output_list):
+    timestamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    run_id = f"{opts.state.abbr}-{timestamp}-{os.urandom(4).hex()}"
+    if opts.threads.startswith("s3://"):
+        bucket_name, _, prefix = opts.threads[5:].partition("/")
+        s3_client = warn_resources.get_client("s3")
+        for i, output in enumerate(output_list):
+            s3_client.put_object(Bucket=bucket_name,
+                                 Key=thread_item_key(prefix.rstrip("/"), run_id, i + 1),
+                                 Body=output.encode("utf-8"),
+                                 ContentType="text/plain; charset=utf-8")
+    else:
+        os.makedirs(os.path.join(opts.threads, run_id))
+        for i, output in enumerate(output_list):
+            fname = thread_item_key(opts.threads, run_id, i + 1)
+            with open(fname, 'w', encoding="utf-8") as item:
+                item.write(output)
+    if opts.debug:
+        print(f"Stored thread {run_id} ({len(output_list)} items) in {opts.threads}")
+    return run_id
+
+
+# More than one thread (of different states, say) can be posted at the
+# same time, each by its own chain of SQS messages, so the posts Lambda
+# can't just disable the event source mapping when it's done with a
+# thread. Instead, every thread that is being posted has a marker (an
+# empty object, or file) under active/ next to the threads, which the
+# posts Lambda removes when it's done with it, and the mapping only
+# gets disabled once there are none left.
+#
+# A thread that fails (and goes to the dead letter queue) never gets
+# done, so the marker holds the time (time.time()) by which the thread
+# should be done at the latest: the posts Lambda ignores (and removes)
+# markers past it. That's the DelaySeconds between the items plus a
+# posts Lambda running into its timeout, per item, and then some for
+# the event source mapping and the rate limits.
+ACTIVE_SECONDS_PER_ITEM = 60
+ACTIVE_MARGIN = 3600
+
+
+def active_marker_key(prefix, run_id):
+    return f"{prefix}/active/{run_id}"
+
+
+def mark_active(opts, run_id, list_size):
+    expires = f"{time.time() + list_size * ACTIVE_SECONDS_PER_ITEM + ACTIVE_MARGIN:.0f}"
+    if opts.threads.startswith("s3://"):
+        bucket_name, _, prefix = opts.threads[5:].partition("/")
+        warn_resources.get_client("s3").put_object(
+            Bucket=bucket_name,
+            Key=active_marker_key(prefix.rstrip("/"), run_id),
+            Body=expires.encode("utf-8")
+        )
+    else:
+        os.makedirs(os.path.join(opts.threads, "active"), exist_ok=True)
+        with open(active_marker_key(opts.threads, run_id), 'w', encoding="utf-8") as marker:
+            marker.write(expires)
+
+
+def send_to_sqs(opts, statuses):
+    with warn_metrics.span("store_thread"):
+        run_id = store_thread(opts, statuses)
+        # Before the mapping gets enabled, so that a posts Lambda
+        # finishing another thread doesn't disable it under this one.
+        mark_active(opts, run_id, len(statuses))
+
+    # Reenable the event source mapping, first:
+    esm_uuid = os.environ['ESM_UUID']
+    with warn_metrics.span("esm"):
+        result = warn_resources.get_client("lambda").update_event_source_mapping(
+            UUID=esm_uuid,
+            Enabled=True
+        )
+    print(f"result = {result}")
+
+    with warn_metrics.span("sqs"):
+        send_message(opts, run_id, len(statuses), esm_uuid)
+
+
+def send_message(opts, run_id, list_size, esm_uuid):
+    warn_resources.get_client("sqs").send_message(
+        QueueUrl=opts.sqs,
+        MessageBody=run_id,
+        MessageAttributes={
+            'run_id': {
+                'DataType': 'String',
+                'StringValue': run_id
+            },
+            'threads': {
+                'DataType': 'String',
+                'StringValue': opts.threads
+            },
+            'index': {
+                'DataType': 'Number',
+                'StringValue': '1'
+            },
+            'sqs_url': {
+                'DataType': 'String',
+                'StringValue': opts.sqs
+            },
+            'total': {
+                'DataType': 'Number',
+                'StringValue': str(list_size)
+            },
+            'state_abbr': {
+                'DataType': 'String',
+                'StringValue': opts.state.abbr
+            },
+            'state_name': {
+                'DataType': 'String',
+                'StringValue': opts.state.name
+            },
+            'esm_uuid': {
+                'DataType': 'String',
+                'StringValue': esm_uuid
+            },
+            # The thread holds the statuses as they are to be posted
+            'rendered': {
+                'DataType': 'String',
+                'StringValue': 'true'
+            }
+        },
+        DelaySeconds=10
+    )
+
+
+# Mastodon tells us how many requests we have left until when, in the
+# X-RateLimit-Remaining and X-RateLimit-Reset headers. As long as there
+# are plenty left, there's no need to wait (beyond opts.pacing); once
+# they run low, what's left is spread out over the time until the reset.
+RATE_LIMIT_LOW = 5
+# Retries for 429 (rate limited) and 5xx responses, and connection
+# failures, with exponential backoff (in seconds).
+POST_RETRIES = 5
+BACKOFF = 2
+BACKOFF_MAX = 120
+
+
+def api_url(server):
+    if "://" in server:
+        # For a local (mock) server: http://localhost:<port>
+        return f"{server.rstrip('/')}/api/v1/statuses"
+    return f"https://{server}/api/v1/statuses"
+
+
+# Seconds until the rate limit resets, according to the headers, or
+# None if they don't say.
+def rate_limit_reset(headers):
+    reset = headers.get('X-RateLimit-Reset')
+    if not reset:
+        return None
+    try:
+        reset_at = datetime.datetime.fromisoformat(reset.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, (reset_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def rate_limit_pause(headers):
+    seconds = rate_limit_reset(headers)
+    try:
+        remaining = int(headers.get('X-RateLimit-Remaining'))
+    except (TypeError, ValueError):
+        return 0
+    if seconds is None or remaining > RATE_LIMIT_LOW:
+        return 0
+    if remaining <= 0:
+        return seconds
+    return seconds / remaining
+
+
+def retry_delay(attempt, result):
+    delay = min(BACKOFF_MAX, BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+    if result is not None and result.status == 429:
+        seconds = rate_limit_reset(result.headers)
+        if seconds is not None:
+            delay = max(delay, seconds)
+    return delay
+
+
+# Post one status. The Idempotency-Key makes Mastodon return the status
+# it already created for a request it has seen before, instead of
+# posting it again, so retrying (or rerunning after a failure, within
+# the hour Mastodon keeps the keys) can't post anything twice. Returns
+# the response, or None if it didn't work out even after retrying.
+def post_status(opts, params, idempotency_key):
+    http = warn_resources.get_http()
+    # Imported by get_http() already
+    import urllib3 # pylint: disable=import-outside-toplevel
+    headers = {
+        'Authorization': f"Bearer {opts.token}",
+        'Idempotency-Key': idempotency_key
+    }
+    for attempt in range(POST_RETRIES + 1):
+        try:
+            with warn_metrics.span("post"):
+                result = http.request('POST', api_url(opts.server),
+                                      headers=headers,
+                                      fields=params,
+                                      retries=False)
+        except urllib3.exceptions.HTTPError as error:
+            print(f"Posting failed: {error}")
+            result = None
+        if result is not None:
+            if result.status == 200:
+                return result
+            print(f"Posting failed: {result.status}")
+            print(result.data)
+            if result.status != 429 and result.status < 500:
+                # Retrying won't change anything
+                return None
+        if attempt == POST_RETRIES:
+            break
+        delay = retry_delay(attempt, result)
+        print(f"Retrying in {delay:.1f} seconds.")
+        warn_metrics.count("retries")
+        time.sleep(delay)
+    return None
+
+
+def send_to_api(opts, statuses):
+    list_size = len(statuses)
+    in_reply_to = None
+    pause = 0
+    for i, status in enumerate(statuses):
+        params = {'status': status}
+        if in_reply_to:
+            # Pace the posts, to be kind to the server and the folks
+            # following the account, and to stay within the rate limit.
+            time.sleep(max(opts.pacing, pause))
+            params['in_reply_to_id'] = in_reply_to
+        key = hashlib.sha256(f"{i+1}\n{params['status']}".encode("utf-8")).hexdigest()
+        result = post_status(opts, params, key)
+        if result is None:
+            print(f"Giving up after posting {i}/{list_size}.")
+            sys.exit(1)
+        print(f"Posted {i+1}/{list_size} successfully.")
+        warn_metrics.count("posts")
+        in_reply_to = json.loads(result.data)['id']
+        pause = rate_limit_pause(result.headers)
@@ -0,0 +1,113 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import datetime
+
+# The rows of the history in memory. As read from the CSV segments, a
+# row is a list of strings, one per column, and a big history is mostly
+# copies of the same few strings: the dates, the counties and cities,
+# the kinds of layoff. A Record is a tuple of the same strings, but
+# shared by all of the records built by the same record_builder(), so
+# that every county (and date, and city) is in memory once.
+#
+# A Record reads like the list of strings it replaces (record[col],
+# len(), iteration), so the CSV writer, the digests and the natural
+# keys see no difference. On top of that, it has the notice, effective
+# and processed dates as day numbers (date.toordinal()), and the number
+# of employees as an int. These are parsed once per distinct value,
+# rather than once per row (or once per use). A date that isn't
+# YYYY-MM-DD, or a number of employees that isn't a number, is None;
+# the strings are what counts.
+#
+# The typed fields, and their columns (under any of their names)
+TYPED_COLUMNS = [
+    ("notice", ["Notice Date"]),
+    ("effective", ["Effective Date"]),
+    ("processed", ["Processed Date", "Received Date"]),
+    ("employees", ["No. Of Employees"])
+]
+
+
+# record_builder() makes a subclass with the typed fields for its
+# columns, which typed_cols tells.
+class Record(tuple):
+    __slots__ = ()
+    typed_cols = ()
+
+    # Equal to a list of the same strings, like the row it replaces
+    def __eq__(self, other):
+        if isinstance(other, list):
+            return list(self) == other
+        return tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = tuple.__hash__
+
+    def __repr__(self):
+        return repr(list(self))
+
+    # The same record with one more value (backfilling a column that
+    # got added to the history)
+    def appended(self, value):
+        return type(self)(self + (value,))
+
+
+# The parsed value per string, parsed the first time it's looked up
+class Parsed(dict):
+    def __init__(self, parse):
+        super().__init__()
+        self.parse = parse
+
+    def __missing__(self, value):
+        try:
+            parsed = self.parse(value)
+        except ValueError:
+            parsed = None
+        self[value] = parsed
+        return parsed
+
+
+def day_number(value):
+    parsed = datetime.date.fromisoformat(value)
+    return parsed.toordinal() if parsed.isoformat() == value else None
+
+
+def find_column(csv_headers, names):
+    for name in names:
+        if name in csv_headers:
+            return csv_headers.index(name)
+    return None
+
+
+def typed_field(col, parsed):
+    def value(record):
+        if col is None or col >= len(record):
+            return None
+        return parsed[record[col]]
+    return property(value)
+
+
+# Returns a function that turns a row (a list of strings, in the order
+# of csv_headers) into a Record, and passes the records of a builder
+# for the same columns through as they are.
+def record_builder(csv_headers):
+    csv_headers = [header.replace("  ", " ") for header in csv_headers]
+    typed_cols = tuple(find_column(csv_headers, names) for _field, names in TYPED_COLUMNS)
+    days = Parsed(day_number)
+    counts = Parsed(int)
+    fields = {field: typed_field(col, counts if field == "employees" else days)
+              for (field, _names), col in zip(TYPED_COLUMNS, typed_cols)}
+    record_class = type("Record", (Record,), dict(fields, __slots__=(), typed_cols=typed_cols))
+    shared = {}
+    share = shared.setdefault
+
+    def build(row):
+        if isinstance(row, Record) and row.typed_cols == typed_cols:
+            return row
+        return record_class(map(share, row, row))
+    return build
+
+
+def records(rows, csv_headers):
+    return map(record_builder(csv_headers), rows)
@@ -0,0 +1,107 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import collections
+import textwrap
+
+# Turning the new entries into the statuses of a thread happens once,
+# here, when the report is processed: the posts (whether from the posts
+# Lambda or send_to_api()) go out exactly as stored. Every status ends
+# with the tags and its place in the thread, and has to fit in the
+# character limit of the server; entries that don't fit are split into
+# continuation posts.
+CHAR_LIMIT = 500
+CONTINUED = "(continued)\n"
+# Room for the place in the thread, " (<index>/<total>)"
+POSITION_SIZE = len(" (9999/9999)")
+# How many counties/companies to name at most in the summary
+SUMMARY_TOP = 5
+# The least room for text a status needs to have, next to the tags,
+# the place in the thread and "(continued)"
+MIN_TEXT_SIZE = 40
+
+
+def tags(state):
+    return f"#Warn #Act #WarnAct #{state.abbr} #{state.name}"
+
+
+def suffix_size(state):
+    return len(f"\n\n{tags(state)}") + POSITION_SIZE + len(CONTINUED)
+
+
+# The lowest character limit that leaves MIN_TEXT_SIZE characters for
+# the text of every status of a thread of this state
+def min_char_limit(state):
+    return suffix_size(state) + MIN_TEXT_SIZE
+
+
+def employees(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+def top_counts(counter):
+    return ", ".join(f"{name} ({total})" for name, total in counter.most_common(SUMMARY_TOP))
+
+
+# A header for the thread with the totals for the day, if there's more
+# than one entry. Returns None otherwise.
+def summary_header(state, newrows, csv_headers):
+    if len(newrows) < 2:
+        return None
+    county_col = csv_headers.index("County/Parish")
+    company_col = csv_headers.index("Company")
+    employees_col = csv_headers.index("No. Of Employees")
+    counties = collections.Counter()
+    companies = collections.Counter()
+    total = 0
+    for row in newrows:
+        count = employees(row[employees_col])
+        counties[row[county_col]] += count
+        companies[row[company_col]] += count
+        total += count
+    return (f"{len(newrows)} new {state.name} WARN notices, affecting {total} employees.\n\n"
+            f"By county: {top_counts(counties)}\n\n"
+            f"By company: {top_counts(companies)}\n")
+
+
+# Split text into pieces of at most size characters: between
+# paragraphs if possible, between lines otherwise, and between words
+# as a last resort.
+def split_text(text, size):
+    if len(text) <= size:
+        return [text]
+    pieces = []
+    current = ""
+    for paragraph in text.split("\n\n"):
+        paragraph = paragraph.rstrip("\n")
+        lines = [paragraph] if len(paragraph) <= size else [
+            part for line in paragraph.split("\n")
+            for part in (textwrap.wrap(line, size) if len(line) > size else [line])
+        ]
+        for i, line in enumerate(lines):
+            separator = "" if not current else ("\n\n" if i == 0 else "\n")
+            if len(current) + len(separator) + len(line) <= size:
+                current += separator + line
+            else:
+                pieces.append(current)
+                current = line
+    pieces.append(current)
+    return [piece for piece in pieces if piece]
+
+
+def render_thread(opts, output_list, newrows, csv_headers):
+    char_limit = getattr(opts, 'char_limit', None) or CHAR_LIMIT
+    suffix = f"\n\n{tags(opts.state)}"
+    size = char_limit - suffix_size(opts.state)
+    header = summary_header(opts.state, newrows, csv_headers)
+    if header:
+        output_list = [header] + output_list
+    bodies = []
+    for output in output_list:
+        pieces = split_text(output.rstrip("\n"), size)
+        bodies.append(pieces[0])
+        bodies.extend(CONTINUED + piece for piece in pieces[1:])
+    total = len(bodies)
+    return [f"{body}{suffix} ({i}/{total})" for i, body in enumerate(bodies, 1)]
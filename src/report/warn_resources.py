@@ -0,0 +1,35 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+# pylint: disable=import-outside-toplevel
+
+import threading
+
+# Things worth holding on to between invocations of a warm Lambda.
+#
+# boto3 and urllib3 are only imported the first time they're needed:
+# together they take a good few hundred milliseconds to import, which
+# every cold start (and every --search, --dump or --stats run, which
+# need neither) would pay for otherwise.
+#
+# The report Lambda processes its states in threads, which all ask for
+# their clients at the same time, and boto3's default session isn't
+# safe to create clients from in more than one thread at once, hence
+# the lock.
+RESOURCES = {}
+LOCK = threading.Lock()
+
+
+def get_http():
+    with LOCK:
+        if 'http' not in RESOURCES:
+            import urllib3
+            RESOURCES['http'] = urllib3.PoolManager()
+    return RESOURCES['http']
+
+
+def get_client(service):
+    with LOCK:
+        if service not in RESOURCES:
+            import boto3
+            RESOURCES[service] = boto3.client(service)
+    return RESOURCES[service]
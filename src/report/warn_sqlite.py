@@ -0,0 +1,325 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+
+import warn_diff
+import warn_index
+import warn_metrics
+import warn_store
+
+# The history in an SQLite database (--db), instead of the CSV segments.
+# Every row of the history is kept as is (as JSON, since the rows from
+# before the "Related Industry" column are shorter), along with its
+# digest, which has a unique index for the duplicate checking, its
+# natural key (see warn_diff), and the columns --search looks at, with
+# B-tree indexes on most of them and an FTS5 trigram index on the
+# company names for --contains. The headers live in the meta table.
+#
+# The first time, the database is filled from the CSV history, if any.
+# process_report.py only imports this module with --db.
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    """CREATE TABLE IF NOT EXISTS notices (
+           id INTEGER PRIMARY KEY,
+           digest BLOB NOT NULL,
+           notice_date TEXT NOT NULL,
+           company TEXT NOT NULL,
+           company_normalized TEXT NOT NULL,
+           county TEXT NOT NULL,
+           city TEXT NOT NULL,
+           employees INTEGER NOT NULL,
+           row TEXT NOT NULL,
+           natural_key BLOB
+       )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS notices_digest ON notices (digest)",
+    "CREATE INDEX IF NOT EXISTS notices_notice_date ON notices (notice_date)",
+    "CREATE INDEX IF NOT EXISTS notices_company ON notices (company)",
+    "CREATE INDEX IF NOT EXISTS notices_company_normalized ON notices (company_normalized)",
+    "CREATE INDEX IF NOT EXISTS notices_county ON notices (county COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS notices_city ON notices (city COLLATE NOCASE)"
+]
+# Databases from before the natural keys get the column added (and
+# filled by update_history()) first.
+KEY_SCHEMA = [
+    "ALTER TABLE notices ADD COLUMN natural_key BLOB",
+    "CREATE INDEX IF NOT EXISTS notices_natural_key ON notices (natural_key)"
+]
+# Not every SQLite has FTS5 (or its trigram tokenizer, 3.34 and up);
+# without it --contains looks at every company name.
+FTS_SCHEMA = ("CREATE VIRTUAL TABLE IF NOT EXISTS notices_fts "
+              "USING fts5(company, content='notices', content_rowid='id', tokenize='trigram')")
+
+
+def regexp(pattern, value):
+    return re.match(pattern, value) is not None
+
+
+def connect(opts):
+    conn = sqlite3.connect(opts.db)
+    # deterministic=True needs SQLite 3.8.3 or later, and the one of the
+    # Lambda runtime (Amazon Linux 2) is 3.7.17
+    if sqlite3.sqlite_version_info >= (3, 8, 3):
+        conn.create_function("REGEXP", 2, regexp, deterministic=True)
+    else:
+        conn.create_function("REGEXP", 2, regexp)
+    for statement in SCHEMA:
+        conn.execute(statement)
+    if "natural_key" in [info[1] for info in conn.execute("PRAGMA table_info(notices)")]:
+        conn.execute(KEY_SCHEMA[1])
+    else:
+        for statement in KEY_SCHEMA:
+            conn.execute(statement)
+    try:
+        conn.execute(FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        pass
+    return conn
+
+
+def has_fts(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'notices_fts'").fetchone()
+
+
+def load_headers(conn):
+    found = conn.execute("SELECT value FROM meta WHERE key = 'headers'").fetchone()
+    return json.loads(found[0]) if found else None
+
+
+def save_headers(conn, csv_headers):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('headers', ?)",
+                 (json.dumps(csv_headers),))
+
+
+def row_values(row, digest, key, columns, normalize):
+    entry = warn_index.search_entry(None, row, columns)
+    company = entry[warn_index.ROW_COMPANY]
+    return (digest, entry[warn_index.ROW_NOTICE], company, normalize(company)[0],
+            entry[warn_index.ROW_COUNTY], entry[warn_index.ROW_CITY],
+            entry[warn_index.ROW_EMPLOYEES], json.dumps(row), key)
+
+
+# Returns True if the row is new
+def insert_row(conn, fts, row, digest, key, columns, normalize):
+    values = row_values(row, digest, key, columns, normalize)
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO notices (digest, notice_date, company, company_normalized, "
+        "county, city, employees, row, natural_key) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        values
+    )
+    if cursor.rowcount != 1:
+        return False
+    if fts:
+        conn.execute("INSERT INTO notices_fts (rowid, company) VALUES (?, ?)",
+                     (cursor.lastrowid, values[2]))
+    return True
+
+
+# Replace the (stale) row with the given id by its update, in place, so
+# that the rows stay in the same order as in the CSV history. Returns
+# the old row.
+def update_row(conn, fts, row_id, row, digest, key, columns, normalize):
+    old_row, old_company = conn.execute("SELECT row, company FROM notices WHERE id = ?",
+                                        (row_id,)).fetchone()
+    values = row_values(row, digest, key, columns, normalize)
+    conn.execute(
+        "UPDATE notices SET digest = ?, notice_date = ?, company = ?, company_normalized = ?, "
+        "county = ?, city = ?, employees = ?, row = ?, natural_key = ? WHERE id = ?",
+        values + (row_id,)
+    )
+    if fts:
+        conn.execute("INSERT INTO notices_fts (notices_fts, rowid, company) "
+                     "VALUES ('delete', ?, ?)", (row_id, old_company))
+        conn.execute("INSERT INTO notices_fts (rowid, company) VALUES (?, ?)",
+                     (row_id, values[2]))
+    return json.loads(old_row)
+
+
+# Fill in the natural keys the database doesn't have yet
+def fill_keys(conn, natural_key):
+    missing = conn.execute("SELECT id, row FROM notices WHERE natural_key IS NULL").fetchall()
+    for row_id, row in missing:
+        conn.execute("UPDATE notices SET natural_key = ? WHERE id = ?",
+                     (natural_key(json.loads(row)), row_id))
+
+
+# Fill the (empty) database from the CSV history, as it is; the header
+# migrations are up to update_history(). Returns the CSV headers, or
+# None if there is no CSV history.
+def migrate_from_csv(opts, conn, normalize):
+    manifest = warn_store.load_manifest(opts)
+    if manifest['headers'] is None:
+        return None
+    print(f"Migrating the history in {opts.summary} to {opts.db}.")
+    warn_store.ensure_segments(opts, manifest)
+    columns = warn_index.search_columns(manifest['headers'])
+    natural_key = warn_diff.key_function(manifest['headers'], normalize)
+    fts = has_fts(conn)
+    with conn:
+        for _offset, row in warn_store.iter_rows(opts, manifest):
+            insert_row(conn, fts, row, warn_index.row_digest(row), natural_key(row), columns,
+                       normalize)
+        save_headers(conn, manifest['headers'])
+    return manifest['headers']
+
+
+# Add the new rows of the report to the history in the database, and
+# replace the rows EDD has corrected since (see warn_diff), all in one
+# transaction. Returns the CSV headers, the new rows, and the updates,
+# as (old row, new row) pairs.
+def update_history(opts, headers, useful_columns, report_rows, normalize):
+    conn = connect(opts)
+    csv_headers = load_headers(conn)
+    if csv_headers is None:
+        csv_headers = migrate_from_csv(opts, conn, normalize)
+    csv_headers, migrate, ri_added = warn_store.migrate_headers(csv_headers, headers)
+    if csv_headers is None:
+        # No headers yet? Copy the ones from the spreadsheet
+        csv_headers = list(headers)
+        print(f"<{csv_headers}>")
+        migrate = True
+    else:
+        warn_store.check_headers(csv_headers, headers, useful_columns)
+
+    fresh = []
+    seen = set()
+    dupes_total = 0
+    merged_total = 0
+    columns = [headers[header] for header in csv_headers]
+    hashed_columns = [not ri_added or header != "Related Industry" for header in csv_headers]
+    search_columns = warn_index.search_columns(csv_headers)
+    natural_key = warn_diff.key_function(csv_headers, normalize)
+    fts = has_fts(conn)
+    with conn:
+        fill_keys(conn, natural_key)
+        for report_row in warn_metrics.timed(report_rows, "parse", "insert"):
+            newrow = []
+            hashed = hashlib.sha256()
+            for col, use_hash in zip(columns, hashed_columns):
+                value = str(report_row[col])
+                newrow.append(value)
+                if use_hash:
+                    hashed.update(value.encode("utf-8"))
+            digest = hashed.digest()
+            if ri_added:
+                seen.add(digest)
+                # The rows from before "Related Industry" have the digest
+                # of everything else. Backfill the column in those, so
+                # that they match the rows of the spreadsheet from now on.
+                found = conn.execute("SELECT id, row FROM notices WHERE digest = ?",
+                                     (digest,)).fetchone()
+                if found:
+                    row = json.loads(found[1])
+                    row.append(str(report_row[headers["Related Industry"]]))
+                    conn.execute("UPDATE notices SET digest = ?, row = ? WHERE id = ?",
+                                 (warn_index.row_digest(row), json.dumps(row), found[0]))
+                    seen.add(warn_index.row_digest(row))
+                    merged_total += 1
+                    dupes_total += 1
+                    continue
+                digest = warn_index.row_digest(newrow)
+            if digest in seen or conn.execute("SELECT 1 FROM notices WHERE digest = ?",
+                                              (digest,)).fetchone():
+                dupes_total += 1
+            else:
+                fresh.append((newrow, digest))
+            seen.add(digest)
+
+        def keyed(key):
+            return conn.execute("SELECT id, digest FROM notices WHERE natural_key = ?",
+                                (key,)).fetchall()
+        newrows, updates = warn_diff.classify(fresh, seen, keyed, natural_key)
+        changed = []
+        for row_id, newrow, digest, key in updates:
+            changed.append((update_row(conn, fts, row_id, newrow, digest, key, search_columns,
+                                       normalize), newrow))
+            if opts.debug:
+                print(f"Updated row: {changed[-1][0]} -> {newrow}")
+        for newrow, digest, key in newrows:
+            insert_row(conn, fts, newrow, digest, key, search_columns, normalize)
+            if opts.debug:
+                print(f"New row: {newrow}")
+        if migrate:
+            save_headers(conn, csv_headers)
+    conn.close()
+    if opts.debug:
+        print(f"{dupes_total} existing rows, {merged_total} merged rows, "
+              f"{len(updates)} updated rows, {len(newrows)} new rows.")
+    warn_metrics.count("existing_rows", dupes_total)
+    warn_metrics.count("updated_rows", len(updates))
+    warn_metrics.count("new_rows", len(newrows))
+    return csv_headers, [newrow for newrow, _digest, _key in newrows], changed
+
+
+# Returns the CSV headers and the rows (in the order they were added)
+# matching all of the search options, or None if there's no history.
+def search_rows(opts):
+    if not os.path.exists(opts.db):
+        return None
+    conn = connect(opts)
+    csv_headers = load_headers(conn)
+    if csv_headers is None:
+        return None
+    where = []
+    params = []
+    if opts.search:
+        prefix = warn_index.literal_prefix(opts.search)
+        if prefix:
+            # Lets the company index narrow things down
+            where.append("company >= ? AND company < ?")
+            params.extend([prefix, prefix + "\U0010ffff"])
+        where.append("company REGEXP ?")
+        params.append(opts.search)
+    if opts.contains:
+        if len(opts.contains) >= 3 and has_fts(conn):
+            where.append("id IN (SELECT rowid FROM notices_fts WHERE notices_fts MATCH ?)")
+            params.append('"' + opts.contains.replace('"', '""') + '"')
+        else:
+            where.append("instr(lower(company), lower(?)) > 0")
+            params.append(opts.contains)
+    if opts.county:
+        where.append("county = ? COLLATE NOCASE")
+        params.append(opts.county)
+    if opts.city:
+        where.append("city = ? COLLATE NOCASE")
+        params.append(opts.city)
+    if opts.since:
+        where.append("notice_date >= ?")
+        params.append(opts.since)
+    if opts.until:
+        where.append("notice_date <= ?")
+        params.append(opts.until)
+    if opts.min_employees:
+        where.append("employees >= ?")
+        params.append(opts.min_employees)
+    query = "SELECT row FROM notices"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    query += " ORDER BY id"
+    if opts.debug:
+        print(f"Query: {query} {params}")
+    rows = [json.loads(row) for row, in conn.execute(query, params)]
+    conn.close()
+    return csv_headers, rows
+
+
+# All of the rows of the history, in the order they were added
+def iter_rows(opts):
+    conn = connect(opts)
+    try:
+        for row, in conn.execute("SELECT row FROM notices ORDER BY id"):
+            yield json.loads(row)
+    finally:
+        conn.close()
+
+
+def history_headers(opts):
+    if not os.path.exists(opts.db):
+        return None
+    conn = connect(opts)
+    csv_headers = load_headers(conn)
+    conn.close()
+    return csv_headers
@@ -0,0 +1,173 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import csv
+import datetime
+import json
+import sys
+
+import numpy # pylint: disable=import-error
+
+import warn_record
+
+# --stats: numbers over all of the history. The history is loaded into
+# one array per column (the companies and counties as codes into a list
+# of names), after which everything is a matter of numpy.bincount(),
+# cumsum() and friends, rather than Python loops over the rows.
+#
+# numpy is optional: only --stats needs it, and process_report.py only
+# imports this module for --stats.
+ROLLING_WINDOWS = [7, 30, 365]
+# The day number (see warn_record) of numpy's day 0
+EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+# Returns the names, and for every value the index of its name
+def categorical(values):
+    names, codes = numpy.unique(numpy.array(values, dtype=str), return_inverse=True)
+    return names, codes.reshape(-1)
+
+
+# Load the columns we need, from the dates and numbers of employees of
+# the records (see warn_record). Rows without a proper notice date are
+# left out; there's no telling where they belong.
+def load_history(rows, csv_headers, normalize):
+    company_col = csv_headers.index("Company")
+    county_col = csv_headers.index("County/Parish")
+    action_col = csv_headers.index("Layoff/Closure")
+    days = []
+    employees = []
+    companies = []
+    counties = []
+    closures = []
+    for record in warn_record.records(rows, csv_headers):
+        if record.notice is None:
+            continue
+        days.append(record.notice)
+        employees.append(record.employees or 0)
+        companies.append(normalize(record[company_col])[0])
+        counties.append(record[county_col])
+        closures.append("closure" in record[action_col].lower())
+    return {
+        'day': (numpy.array(days, dtype=numpy.int64) - EPOCH).astype('datetime64[D]'),
+        'employees': numpy.array(employees, dtype=numpy.int64),
+        'company': categorical(companies),
+        'county': categorical(counties),
+        'closure': numpy.array(closures, dtype=bool)
+    }
+
+
+# The number of employees affected by notices in the last 7, 30 and 365
+# days, as of every day from the first notice to the last.
+def rolling_totals(history):
+    first = history['day'].min()
+    offsets = (history['day'] - first).astype(numpy.int64)
+    daily = numpy.bincount(offsets, weights=history['employees'])
+    cumulative = numpy.concatenate(([0], numpy.cumsum(daily))).astype(numpy.int64)
+    ends = numpy.arange(1, len(daily) + 1)
+    dates = first + numpy.arange(len(daily))
+    columns = [cumulative[ends] - cumulative[numpy.maximum(ends - window, 0)]
+               for window in ROLLING_WINDOWS]
+    return [
+        dict([('date', str(date))] +
+             [(f"days_{window}", int(column[i])) for window, column in zip(ROLLING_WINDOWS,
+                                                                          columns)])
+        for i, date in enumerate(dates)
+    ]
+
+
+def top_totals(history, column, top):
+    names, codes = history[column]
+    employees = numpy.bincount(codes, weights=history['employees'], minlength=len(names))
+    notices = numpy.bincount(codes, minlength=len(names))
+    order = numpy.argsort(-employees, kind='stable')[:top]
+    return [{column: str(names[i]), 'employees': int(employees[i]), 'notices': int(notices[i])}
+            for i in order]
+
+
+def change_pct(value, previous):
+    if not previous:
+        return None
+    return round((value - previous) / previous * 100, 1)
+
+
+def ratio(value, other):
+    if not other:
+        return None
+    return round(value / other, 3)
+
+
+# Per year: the totals, the change from the year before, the same for
+# the part of the year up to the day of the last notice (year to date),
+# and closures versus layoffs.
+def yearly_totals(history):
+    day = history['day']
+    employees = history['employees']
+    year_start = day.astype('datetime64[Y]')
+    years = year_start.astype(numpy.int64) + 1970
+    first_year = years.min()
+    offsets = years - first_year
+    count = offsets.max() + 1
+    day_of_year = (day - year_start.astype('datetime64[D]')).astype(numpy.int64)
+    last = day.max()
+    last_day_of_year = int((last - last.astype('datetime64[Y]').astype('datetime64[D]'))
+                           .astype(numpy.int64))
+    to_date = day_of_year <= last_day_of_year
+
+    totals = numpy.bincount(offsets, weights=employees, minlength=count).astype(numpy.int64)
+    notices = numpy.bincount(offsets, minlength=count)
+    ytd = numpy.bincount(offsets[to_date], weights=employees[to_date],
+                         minlength=count).astype(numpy.int64)
+    closed = numpy.bincount(offsets, weights=employees * history['closure'],
+                            minlength=count).astype(numpy.int64)
+    closure_notices = numpy.bincount(offsets, weights=history['closure'],
+                                     minlength=count).astype(numpy.int64)
+    result = []
+    for i in range(count):
+        previous = i - 1 if i > 0 else None
+        result.append({
+            'year': int(first_year + i),
+            'notices': int(notices[i]),
+            'employees': int(totals[i]),
+            'change_pct': change_pct(totals[i], totals[previous]) if previous is not None else None,
+            'ytd_employees': int(ytd[i]),
+            'ytd_change_pct': change_pct(ytd[i], ytd[previous]) if previous is not None else None,
+            'closure_employees': int(closed[i]),
+            'layoff_employees': int(totals[i] - closed[i]),
+            'closure_notices': int(closure_notices[i]),
+            'closure_layoff_ratio': ratio(closed[i], totals[i] - closed[i])
+        })
+    return result
+
+
+def history_stats(rows, csv_headers, normalize, top):
+    history = load_history(rows, csv_headers, normalize)
+    if len(history['day']) == 0:
+        return None
+    return {
+        'rows': len(history['day']),
+        'first': str(history['day'].min()),
+        'last': str(history['day'].max()),
+        'rolling': rolling_totals(history),
+        'companies': top_totals(history, 'company', top),
+        'counties': top_totals(history, 'county', top),
+        'years': yearly_totals(history)
+    }
+
+
+# JSON as is, or CSV in "long" form, one value per line: the section,
+# the key (the first field of its entries), the name, and the value.
+def print_stats(stats, output_format):
+    if output_format == "json":
+        print(json.dumps(stats, indent=1))
+        return
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["section", "key", "name", "value"])
+    for section, value in stats.items():
+        if not isinstance(value, list):
+            writer.writerow([section, "", "", value])
+            continue
+        for entry in value:
+            fields = list(entry.items())
+            key = fields[0][1]
+            for name, field in fields[1:]:
+                writer.writerow([section, key, name, "" if field is None else field])
@@ -0,0 +1,590 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import bisect
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+
+import warn_diff
+import warn_index
+import warn_metrics
+import warn_record
+
+# The history of all the notices we've seen is stored in segments: the
+# base segment (with the CSV headers as its first row), and a delta
+# segment (without headers) for every run that found new rows. The
+# manifest (summary.json) lists the segments in order, with their sizes
+# and digests:
+#
+#   {"headers": [...], "segments": [{"name": ..., "size": ..., "sha256": ...}, ...]}
+#
+# so a run only needs the manifest (and the digest index) to add a new
+# delta, no matter how big the history has grown. Readers go through
+# all of the segments in order, as if they were one CSV file.
+#
+# Segments are never changed once written. Every one of them gets a
+# name of its own (summary-<timestamp>-<random>.csv), including the new
+# base that the deltas get compacted into, so that saving (or uploading)
+# the manifest is what switches from one version of the history to the
+# next. The segments of the old version are removed only after that
+# (see remove_segments()): until then, the old manifest still describes
+# files that are all there, as they were.
+COMPACT_AFTER = 30
+
+
+def manifest_name(opts):
+    return f"{os.path.splitext(opts.summary)[0]}.json"
+
+
+def segment_path(opts, name):
+    return os.path.join(os.path.dirname(opts.summary), name)
+
+
+def file_entry(fname):
+    hashed = hashlib.sha256()
+    size = 0
+    with open(fname, 'rb') as infile:
+        for block in iter(lambda: infile.read(1048576), b""):
+            hashed.update(block)
+            size += len(block)
+    return {'name': os.path.basename(fname), 'size': size, 'sha256': hashed.hexdigest()}
+
+
+# Returns the manifest. Without one, but with a summary.csv file (from
+# before there were segments), that file becomes the base segment.
+def load_manifest(opts):
+    try:
+        with open(manifest_name(opts), encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except IOError:
+        pass
+    manifest = {'headers': None, 'segments': []}
+    if os.path.exists(opts.summary) and os.path.getsize(opts.summary) > 0:
+        with open(opts.summary, newline='', encoding="utf-8") as csvfile:
+            manifest['headers'] = next(csv.reader(csvfile), None)
+        manifest['segments'].append(file_entry(opts.summary))
+    return manifest
+
+
+def save_manifest(opts, manifest):
+    fname = manifest_name(opts)
+    tmp_fname = f"{fname}.{os.getpid()}"
+    with open(tmp_fname, 'w', encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.rename(tmp_fname, fname)
+
+
+# Identifies this version of the history, for the indexes built from
+# it. Returns the total size of the segments and a digest of the list.
+def signature(manifest):
+    size = sum(segment['size'] for segment in manifest['segments'])
+    listing = json.dumps(manifest['segments'], sort_keys=True).encode("utf-8")
+    return size, hashlib.sha256(listing).digest()
+
+
+# Make sure all of the segments can be read: either they're here
+# already, or opts.stream_segment (if set) streams them from where they
+# are kept (and segment_lines() checks them as they're read).
+def ensure_segments(opts, manifest):
+    if getattr(opts, 'stream_segment', None) is not None:
+        return
+    for segment in manifest['segments']:
+        fname = segment_path(opts, segment['name'])
+        if not os.path.exists(fname) or os.path.getsize(fname) != segment['size']:
+            print(f"Segment {fname} is missing or doesn't match {manifest_name(opts)}.")
+            sys.exit(1)
+
+
+# Split chunks of bytes into lines, the way readline() does
+def split_lines(chunks):
+    pending = b""
+    for chunk in chunks:
+        data = pending + chunk
+        start = 0
+        end = data.find(b"\n")
+        while end >= 0:
+            yield data[start:end+1]
+            start = end + 1
+            end = data.find(b"\n", start)
+        pending = data[start:]
+    if pending:
+        yield pending
+
+
+# Iterate over the rows in CSV lines (bytes), along with the byte offset
+# at which each row starts. Reading the lines ourselves (instead of
+# having the csv module do it) is what lets us keep track of the offsets,
+# even for rows with newlines inside quoted values.
+def iter_csv_lines(lines, start=0):
+    position = [start]
+
+    def decoded():
+        for line in lines:
+            position[0] += len(line)
+            yield line.decode("utf-8")
+
+    offset = start
+    for row in csv.reader(decoded()):
+        yield offset, row
+        offset = position[0]
+
+
+# Pass the chunks of a streamed segment through, and exit once they've
+# all been read if they don't add up to the size and digest that the
+# manifest has for it. That happens before the last line is split off,
+# so before anything gets written based on the rows.
+def checked_chunks(opts, segment, chunks):
+    hashed = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        hashed.update(chunk)
+        size += len(chunk)
+        yield chunk
+    if size != segment['size'] or hashed.hexdigest() != segment['sha256']:
+        print(f"Segment {segment['name']} doesn't match {manifest_name(opts)}.")
+        sys.exit(1)
+
+
+# The lines of a segment: from the file, if it's here (because this run
+# wrote it, or there is no opts.stream_segment), otherwise streamed.
+def segment_lines(opts, segment):
+    fname = segment_path(opts, segment['name'])
+    stream_segment = getattr(opts, 'stream_segment', None)
+    if stream_segment is None or (os.path.exists(fname) and
+                                  os.path.getsize(fname) == segment['size']):
+        with open(fname, 'rb') as csvfile:
+            yield from csvfile
+    else:
+        yield from split_lines(checked_chunks(opts, segment,
+                                              stream_segment(segment['name'])))
+
+
+# Iterate over the rows of all the segments (from the first'th one on),
+# along with their offset as if the segments were all one file.
+def iter_rows(opts, manifest, first=0):
+    base = sum(segment['size'] for segment in manifest['segments'][:first])
+    for number, segment in enumerate(manifest['segments'][first:], first):
+        rows = iter_csv_lines(segment_lines(opts, segment))
+        if number == 0:
+            # Skip the headers
+            next(rows, None)
+        for offset, row in rows:
+            yield base + offset, row
+        base += segment['size']
+
+
+def read_rows_at(opts, manifest, offsets):
+    starts = []
+    base = 0
+    for segment in manifest['segments']:
+        starts.append(base)
+        base += segment['size']
+    rows = []
+    for offset in sorted(offsets):
+        number = bisect.bisect_right(starts, offset) - 1
+        fname = segment_path(opts, manifest['segments'][number]['name'])
+        with open(fname, 'rb') as csvfile:
+            csvfile.seek(offset - starts[number])
+            lines = (line.decode("utf-8") for line in iter(csvfile.readline, b""))
+            rows.append(next(csv.reader(lines)))
+    return rows
+
+
+def write_segment(fname, csv_headers, rows):
+    tmp_fname = f"{fname}.{os.getpid()}"
+    with open(tmp_fname, 'w', newline='', encoding="utf-8") as csvfile:
+        writer = csv.writer(csvfile)
+        if csv_headers:
+            writer.writerow(csv_headers)
+        writer.writerows(rows)
+    os.rename(tmp_fname, fname)
+    return file_entry(fname)
+
+
+# A name for a new segment, that no other segment has had
+def new_segment_name(opts):
+    stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime())
+    stem = os.path.splitext(os.path.basename(opts.summary))[0]
+    return f"{stem}-{stamp}-{os.urandom(4).hex()}.csv"
+
+
+# Add the rows as a new segment: the base if there isn't one yet, a
+# delta otherwise. The caller saves the manifest.
+def add_segment(opts, manifest, csv_headers, rows):
+    name = new_segment_name(opts)
+    if opts.debug:
+        print(f"Adding segment {name} with {len(rows)} rows.")
+    headers = None if manifest['segments'] else csv_headers
+    manifest['headers'] = csv_headers
+    manifest['segments'].append(write_segment(segment_path(opts, name), headers, rows))
+
+
+# Replace all of the segments by a new base with these rows (which
+# may have been migrated along the way). The caller saves the manifest,
+# and then removes the old segments, which compact() returns.
+def compact(opts, manifest, csv_headers, rows):
+    name = new_segment_name(opts)
+    if opts.debug:
+        print(f"Compacting {len(manifest['segments'])} segments into {name}.")
+    old_segments = manifest['segments']
+    manifest['headers'] = csv_headers
+    manifest['segments'] = [write_segment(segment_path(opts, name), csv_headers, rows)]
+    return old_segments
+
+
+# Remove the files of the old segments that the (saved) manifest no
+# longer lists
+def remove_segments(opts, manifest, old_segments):
+    names = {segment['name'] for segment in manifest['segments']}
+    for segment in old_segments:
+        fname = segment_path(opts, segment['name'])
+        if segment['name'] not in names and os.path.exists(fname):
+            os.remove(fname)
+
+
+# Apply any migrations to the CSV headers of the history (the headers
+# of the spreadsheet tell which ones). Returns the headers (None if there
+# is no history yet), whether the existing rows have to be rewritten,
+# and whether "Related Industry" got added.
+def migrate_headers(csv_headers, headers):
+    if csv_headers is None:
+        print("No history yet.")
+        return None, False, False
+    csv_headers = list(csv_headers)
+
+    migrate = False
+    ri_added = False
+    ri_seen = False
+    for i, col in enumerate(csv_headers):
+        if col == "Received Date":
+            # Migrate from Received Date to Processed Date
+            csv_headers[i] = "Processed Date"
+            migrate = True
+        elif col == "Related Industry":
+            ri_seen = True
+    # Migration step, because the "Related Industry"
+    # column did not exist when I started tracking
+    # this in 2023.
+    if "Related Industry" in headers and not ri_seen:
+        print("Adding 'Related Industry' to CSV headers.")
+        csv_headers.append("Related Industry")
+        ri_added = True
+        migrate = True
+    return csv_headers, migrate, ri_added
+
+
+# The history has to have the same columns as the spreadsheet
+def check_headers(csv_headers, headers, useful_columns):
+    if len(csv_headers) != useful_columns:
+        print("Number of columns mismatch between existing data and new data.")
+        sys.exit(1)
+    for header in csv_headers:
+        if header not in headers:
+            print(f"Header '{header}' not present in new data.")
+            sys.exit(1)
+
+
+# Hash the rows of the report (as far as the columns of the history go)
+# and compare them with the digests of the history in known. Returns
+# the (row, digest) pairs of the rows that aren't in the history, the
+# digests of all of the rows, the number of duplicates, and, if
+# "Related Industry" got added (ri_added), the (digest, value) pairs to
+# backfill the rows of the history with, so that future duplicate
+# checking will work.
+def scan_report(report_rows, headers, csv_headers, ri_added, known):
+    fresh = []
+    seen = set()
+    dupes_total = 0
+    backfills = []
+    columns = [headers[header] for header in csv_headers]
+    hashed_columns = [not ri_added or header != "Related Industry" for header in csv_headers]
+    for report_row in report_rows:
+        newrow = []
+        hashed = hashlib.sha256()
+        for col, use_hash in zip(columns, hashed_columns):
+            value = str(report_row[col])
+            newrow.append(value)
+            if use_hash:
+                hashed.update(value.encode("utf-8"))
+        digest = hashed.digest()
+        if digest in known:
+            if ri_added:
+                backfills.append((digest, str(report_row[headers["Related Industry"]])))
+            dupes_total += 1
+        elif digest in seen:
+            dupes_total += 1
+        else:
+            fresh.append((newrow, digest))
+        seen.add(digest)
+    return fresh, seen, dupes_total, backfills
+
+
+# The rows of the history, as records (see warn_record)
+def read_history(opts, manifest):
+    with warn_metrics.span("segments"):
+        ensure_segments(opts, manifest)
+    build = warn_record.record_builder(manifest['headers'])
+    for _offset, row in warn_metrics.timed(iter_rows(opts, manifest), "history"):
+        yield build(row)
+
+
+# With --watch (opts.resident set), the history stays in memory between
+# runs of update_history(): the digest index (known), and once they've
+# been read, the rows (as records) and the position of every digest in
+# them, along with the signature of the version of the history they
+# are of. If something else changed the history in the meantime, its
+# signature no longer matches, and it's read again.
+def load_resident(opts):
+    manifest = load_manifest(opts)
+    opts.resident = {}
+    if manifest['headers'] is None:
+        return
+    known = warn_index.load_digest_index(warn_index.index_name(opts), signature(manifest))
+    if known is not None:
+        opts.resident = {'signature': signature(manifest), 'known': known,
+                         'rows': None, 'positions': None}
+
+
+def resident_history(opts, manifest):
+    resident = getattr(opts, 'resident', None)
+    if not resident or resident['signature'] != signature(manifest):
+        return None
+    return resident
+
+
+# Keep what is now the history, if it's being kept (see load_resident()):
+# the digest index, and the rows with their positions if there are any.
+def keep_resident(opts, manifest, csv_headers, known, rows=None, positions=None):
+    if getattr(opts, 'resident', None) is None:
+        return
+    if positions is not None:
+        rows = list(map(warn_record.record_builder(csv_headers), rows))
+    else:
+        rows = None
+    opts.resident = {'signature': signature(manifest), 'known': known,
+                     'rows': rows, 'positions': positions}
+
+
+# All of the rows of the history, and the position of every digest in
+# them, from memory if it's there (see load_resident())
+def history_rows(opts, manifest, resident):
+    if resident is not None and resident['rows'] is not None:
+        return list(resident['rows']), dict(resident['positions'])
+    rows = list(read_history(opts, manifest))
+    return rows, {warn_index.row_digest(row): i for i, row in enumerate(rows)}
+
+
+# Add the new rows of the report to the history, and replace the rows
+# EDD has corrected since (see warn_diff) by the corrected ones.
+# Returns the CSV headers, the new rows, and the updates, as (old row,
+# new row) pairs.
+def update_history(opts, headers, useful_columns, report_rows, normalize):
+    idx_fname = warn_index.index_name(opts)
+    rows = []
+    positions = {}
+
+    # During the same run where we add the header, we need to ignore
+    # it for the duplicate checking because the new spreadsheet added
+    # it retroactively for rows we've already processed and posted
+    # previously.
+    #
+    # Afterward we do add that new information to the existing rows so
+    # that the next time, when the new column does exist already, our
+    # duplicate checking doesn't go haywire in spite of it all.
+    manifest = load_manifest(opts)
+    csv_headers, migrate, ri_added = migrate_headers(manifest['headers'], headers)
+
+    if csv_headers is None:
+        # No headers yet? Copy the ones from the spreadsheet
+        csv_headers = list(headers)
+        print(f"<{csv_headers}>")
+    else:
+        check_headers(csv_headers, headers, useful_columns)
+    natural_key = warn_diff.key_function(csv_headers, normalize)
+
+    # Unless the existing rows need to be migrated or updated (which
+    # means reading and rewriting all of them), the digest index is all
+    # we need for the duplicate checking, and new rows simply go into a
+    # new segment.
+    resident = resident_history(opts, manifest)
+    rebuilt = False
+    if migrate:
+        rows, positions = history_rows(opts, manifest, resident)
+        known = {digest: natural_key(rows[i]) for digest, i in positions.items()}
+    elif resident is not None:
+        known = resident['known']
+    elif manifest['headers'] is not None:
+        known = warn_index.load_digest_index(idx_fname, signature(manifest))
+        if known is None:
+            print(f"Rebuilding digest index {idx_fname}.")
+            known = {warn_index.row_digest(row): natural_key(row)
+                     for row in read_history(opts, manifest)}
+            rebuilt = True
+    else:
+        known = {}
+        rebuilt = True
+
+    # The time spent on getting the rows is that of parsing the
+    # spreadsheet (or reading the cache), the rest is that of hashing
+    # and comparing them.
+    fresh, seen, dupes_total, backfills = scan_report(
+        warn_metrics.timed(report_rows, "parse", "hash"), headers, csv_headers, ri_added, known)
+    for digest, value in backfills:
+        rows[positions[digest]] = rows[positions[digest]].appended(value)
+    merged_total = len(backfills)
+
+    by_key = warn_diff.keyed_history(known) if fresh else {}
+    newrows, updates = warn_diff.classify(fresh, seen, lambda key: by_key.get(key, ()),
+                                          natural_key)
+    if opts.debug:
+        for newrow, _digest, _key in newrows:
+            print(f"New row: {newrow}")
+        print(f"{dupes_total} existing rows, {merged_total} merged rows, "
+              f"{len(updates)} updated rows, {len(newrows)} new rows.")
+    warn_metrics.count("existing_rows", dupes_total)
+    warn_metrics.count("updated_rows", len(updates))
+    warn_metrics.count("new_rows", len(newrows))
+
+    changed = []
+    with warn_metrics.span("write"):
+        if updates and not migrate:
+            rows, positions = history_rows(opts, manifest, resident)
+        for stale, newrow, _digest, _key in updates:
+            if opts.debug:
+                print(f"Updated row: {rows[positions[stale]]} -> {newrow}")
+            changed.append((rows[positions[stale]], newrow))
+            rows[positions[stale]] = newrow
+        if migrate or updates:
+            if newrows or updates:
+                rows.extend(newrow for newrow, _digest, _key in newrows)
+                old_segments = compact(opts, manifest, csv_headers, rows)
+                save_manifest(opts, manifest)
+                remove_segments(opts, manifest, old_segments)
+                entries = [(warn_index.row_digest(row), natural_key(row)) for row in rows]
+                warn_index.write_digest_index(idx_fname, signature(manifest), entries)
+                keep_resident(opts, manifest, csv_headers, dict(entries), rows,
+                              {digest: i for i, (digest, _key) in enumerate(entries)})
+            elif getattr(opts, 'resident', None) is not None:
+                # Migrated in memory only; the next run migrates it again
+                opts.resident = {}
+        elif newrows or rebuilt:
+            history = positions = None
+            if newrows:
+                if opts.debug:
+                    print(f"Adding {len(newrows)} rows to {opts.summary}.")
+                # Keep the search index up to date as well, if it exists
+                search_fname = warn_index.search_index_name(opts)
+                search_current = (len(manifest['segments']) > 0 and
+                                  warn_index.search_index_current(search_fname,
+                                                                  signature(manifest)))
+                first = len(manifest['segments'])
+                add_segment(opts, manifest, csv_headers,
+                            [newrow for newrow, _digest, _key in newrows])
+                if resident is not None and resident['rows'] is not None:
+                    # The rows in memory, and the new ones
+                    history, positions = history_rows(opts, manifest, resident)
+                    for newrow, digest, _key in newrows:
+                        positions[digest] = len(history)
+                        history.append(newrow)
+                old_segments = []
+                if len(manifest['segments']) > COMPACT_AFTER:
+                    # The offsets all change, so the search index gets
+                    # rebuilt the next time it's used.
+                    if history is None:
+                        history = list(read_history(opts, manifest))
+                    old_segments = compact(opts, manifest, csv_headers, history)
+                elif search_current:
+                    warn_index.append_search_index(search_fname, signature(manifest),
+                                                   csv_headers,
+                                                   iter_rows(opts, manifest, first))
+                save_manifest(opts, manifest)
+                remove_segments(opts, manifest, old_segments)
+            entries = [(digest, key) for _newrow, digest, key in newrows]
+            if rebuilt:
+                warn_index.write_digest_index(idx_fname, signature(manifest),
+                                              list(known.items()) + entries)
+            else:
+                warn_index.append_digest_index(idx_fname, signature(manifest), entries)
+            known.update(entries)
+            keep_resident(opts, manifest, csv_headers, known, history, positions)
+        elif resident is None:
+            # Nothing changed, but hold on to the digest index
+            keep_resident(opts, manifest, csv_headers, known)
+    return csv_headers, [newrow for newrow, _digest, _key in newrows], changed
+
+
+# --replay: the same as update_history() for every one of the snapshots
+# (an iterator over their name, headers, useful columns and rows, in
+# order), but with the whole history in memory, and written only once,
+# at the end. Returns the CSV headers and the numbers of new and
+# updated rows.
+def replay_history(opts, snapshots, normalize):
+    manifest = load_manifest(opts)
+    csv_headers = manifest['headers']
+    rows = list(read_history(opts, manifest)) if csv_headers is not None else []
+    changed = False
+    new_total = 0
+    updated_total = 0
+    known = None
+    build = warn_record.record_builder(csv_headers or [])
+    for fname, headers, useful_columns, report_rows in snapshots:
+        csv_headers, migrate, ri_added = migrate_headers(csv_headers, headers)
+        if csv_headers is None:
+            csv_headers = list(headers)
+            print(f"<{csv_headers}>")
+        else:
+            check_headers(csv_headers, headers, useful_columns)
+        if known is None or migrate:
+            build = warn_record.record_builder(csv_headers)
+            natural_key = warn_diff.key_function(csv_headers, normalize)
+            positions = {warn_index.row_digest(row): i for i, row in enumerate(rows)}
+            known = {digest: natural_key(rows[i]) for digest, i in positions.items()}
+
+        fresh, seen, dupes_total, backfills = scan_report(report_rows, headers, csv_headers,
+                                                          ri_added, known)
+        for digest, value in backfills:
+            rows[positions[digest]] = rows[positions[digest]].appended(value)
+        by_key = warn_diff.keyed_history(known) if fresh else {}
+        newrows, updates = warn_diff.classify(fresh, seen,
+                                              lambda key, by_key=by_key: by_key.get(key, ()),
+                                              natural_key)
+
+        # Keep the digests (and their positions) in step with the rows,
+        # for the next snapshot. After a migration the digests of the
+        # old rows change as well, so those are all done over.
+        for stale, newrow, digest, key in updates:
+            i = positions.pop(stale)
+            del known[stale]
+            rows[i] = build(newrow)
+            positions[digest] = i
+            known[digest] = key
+        for newrow, digest, key in newrows:
+            positions[digest] = len(rows)
+            known[digest] = key
+            rows.append(build(newrow))
+        if migrate:
+            positions = {warn_index.row_digest(row): i for i, row in enumerate(rows)}
+            known = {digest: natural_key(rows[i]) for digest, i in positions.items()}
+
+        if opts.verbose:
+            print(f"{fname}: {len(newrows)} new rows, {len(updates)} updated rows.")
+        if opts.debug:
+            print(f"{dupes_total} existing rows, {len(backfills)} merged rows.")
+        changed = changed or migrate or newrows or updates
+        new_total += len(newrows)
+        updated_total += len(updates)
+    warn_metrics.count("updated_rows", updated_total)
+    warn_metrics.count("new_rows", new_total)
+
+    if changed:
+        with warn_metrics.span("write"):
+            old_segments = compact(opts, manifest, csv_headers, rows)
+            save_manifest(opts, manifest)
+            remove_segments(opts, manifest, old_segments)
+            warn_index.write_digest_index(warn_index.index_name(opts), signature(manifest),
+                                          [(warn_index.row_digest(row), natural_key(row))
+                                           for row in rows])
+    return csv_headers, new_total, updated_total
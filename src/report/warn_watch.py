@@ -0,0 +1,64 @@
+# -*- mode: python; tab-width: 4; indent-tabs-mode: nil -*- for emacs
+
+import datetime
+import time
+
+import warn_metrics
+import warn_resources
+import warn_store
+
+
+def now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+# --watch: instead of this cron pair:
+#
+#  process_report.py --fetch --debug
+#  process_report.py --verbose --update --post --server <server> --token <token>
+#
+# keep running (process_report.py --watch --verbose --post ...), and
+# check for a new version of the spreadsheet every --interval seconds.
+# A check is a conditional request (see do_fetch()) over the connections
+# kept in the pool of warn_resources, so one that finds nothing new is a
+# single round trip, without content. Only a new version gets parsed,
+# and its new (or corrected) rows added to the history, the digest index
+# (and the rows, once they've been read) of which stay in memory in
+# between (see warn_store.load_resident()), as do the modules. With
+# --db, the history is left to SQLite and its indexes.
+#
+# A check that fails, on the network or with an error from the server,
+# is tried again at the next one; with --profile, the numbers are
+# printed after every new version. Stop it with ^C.
+def watch(opts):
+    adapter = opts.state
+    if not opts.db:
+        warn_store.load_resident(opts)
+    warn_resources.get_http()
+    # Imported by get_http() already
+    import urllib3 # pylint: disable=import-outside-toplevel
+    next_check = time.monotonic()
+    try:
+        while True:
+            try:
+                changed = adapter.fetch(opts)
+            except urllib3.exceptions.HTTPError as error:
+                print(f"{now()}: Checking for a new version failed: {error}")
+                changed = False
+            if changed is None:
+                # do_fetch() said why
+                print(f"{now()}: Checking for a new version failed.")
+            # --force only goes for the first check
+            opts.force = False
+            if changed:
+                print(f"{now()}: New version of the spreadsheet.")
+                headers, useful_columns, report_rows = adapter.load(opts)
+                adapter.update(opts, headers, useful_columns, report_rows)
+                if opts.profile:
+                    warn_metrics.print_profile()
+                    warn_metrics.reset(tracing=True)
+            # The next check, or right away if this one took that long
+            next_check = max(next_check + opts.interval, time.monotonic())
+            time.sleep(max(0, next_check - time.monotonic()))
+    except KeyboardInterrupt:
+        print("Stopped watching.")
@@ -28,6 +28,23 @@ resource "aws_s3_bucket_ownership_controls" "warn_bucket" {
   }
 }
 
+# The threads stored for the post Lambda (under threads/) are only
+# needed until they've been posted.
+resource "aws_s3_bucket_lifecycle_configuration" "warn_bucket" {
+  bucket = aws_s3_bucket.warn_bucket.id
+
+  rule {
+    id = "expire-threads"
+    status = "Enabled"
+    filter {
+      prefix = "threads/"
+    }
+    expiration {
+      days = 14
+    }
+  }
+}
+
 ######################################################################
 # SSM Parameter
 ######################################################################
@@ -65,8 +82,10 @@ resource "aws_sqs_queue" "posts" {
   # fifo_queue = true
 
   # This timeout needs to be at least as long as the timeout of the Lambda
-  # hooked up to this queue
-  visibility_timeout_seconds = 10
+  # hooked up to this queue (AWS recommends six times as long), or else a
+  # message becomes visible again while the Lambda (with POST_BATCH, up to
+  # its timeout) is still working on it, and is received a second time.
+  visibility_timeout_seconds = 6 * aws_lambda_function.post.timeout
   # content_based_deduplication = true
 
   redrive_policy = jsonencode({
@@ -9,25 +9,23 @@ variable "src" {
 # https://repost.aws/knowledge-center/lambda-python-package-compatible
 # Probably want to put the openpyxl bits in a layer, and tie that to the report Lambda?
 
-resource "null_resource" "install_report_dependencies" {
-  provisioner "local-exec" {
-    command = "rm -fr ${var.src}report/packaging; pip3 install -r ${var.src}report/requirements.txt -t ${var.src}report/packaging/"
-  }
-  triggers = {
-    dependencies_versions = filemd5("${var.src}report/requirements.txt")
-    source_versions = filemd5("${var.src}report/process_report.py")
-  }
+# process_report.py and the modules next to it
+locals {
+  report_source_versions = sha1(join(",", [
+    for filename in sort(fileset("${var.src}report", "*.py")) :
+    filemd5("${var.src}report/${filename}")
+  ]))
 }
 
-resource "null_resource" "install_report_source" {
-  depends_on = [
-    null_resource.install_report_dependencies
-  ]
+# The minimal package (see "make package-report"): the modules and
+# openpyxl, compiled ahead of time for a faster cold start
+resource "null_resource" "package_report" {
   provisioner "local-exec" {
-    command = "cp -p ${var.src}report/process_report.py ${var.src}report/packaging/"
+    command = "make -C ${var.src}.. package-report"
   }
   triggers = {
-    source_versions = filemd5("${var.src}report/process_report.py")
+    dependencies_versions = filemd5("${var.src}report/requirements.txt")
+    source_versions = local.report_source_versions
   }
 }
 
@@ -42,11 +40,9 @@ resource "null_resource" "install_report_source" {
 
 data "archive_file" "report" {
   depends_on = [
-    null_resource.install_report_dependencies,
-    null_resource.install_report_source
+    null_resource.package_report
   ]
   excludes = [
-    "__pycache__",
     "venv"
   ]
   source_dir = "${var.src}report/packaging"
@@ -90,6 +86,13 @@ resource "aws_lambda_function" "report" {
       S3_NAME  = var.bucket_name
       SQS_URL  = aws_sqs_queue.posts.url
       ESM_UUID = aws_lambda_event_source_mapping.post_trigger.uuid
+      # Comma separated list of the states to process
+      STATES   = "CA"
+      # "sqlite" to keep the history in <abbr>/summary.db instead of
+      # the CSV segments (filled from those the first time)
+      HISTORY_BACKEND = "csv"
+      # "true" to post the corrections to earlier notices as well
+      POST_UPDATES = "false"
     }
   }
 }
@@ -229,9 +232,21 @@ resource "aws_iam_policy" "warn_esm_reading" {
 
 # Zip file used for posts lambda
 
+resource "null_resource" "package_post" {
+  provisioner "local-exec" {
+    command = "make -C ${var.src}.. package-posts"
+  }
+  triggers = {
+    source_versions = filemd5("${var.src}posts/process_posts.py")
+  }
+}
+
 data "archive_file" "post" {
+  depends_on = [
+    null_resource.package_post
+  ]
   type = "zip"
-  source_file = "${var.src}posts/process_posts.py"
+  source_dir = "${var.src}posts/packaging"
   output_path = "lambda-post.zip"
 }
 
@@ -253,6 +268,19 @@ resource "aws_lambda_function" "post" {
   source_code_hash = data.archive_file.post.output_base64sha256
   publish = true
   timeout = 30
+
+  environment {
+    variables = {
+      # Set POST_BATCH to "true" to post multiple items of a thread per
+      # invocation, POST_PACING seconds apart, for as long as the time
+      # left (minus POST_SAFETY_MARGIN milliseconds) allows.
+      POST_BATCH         = "false"
+      POST_PACING        = "1"
+      POST_SAFETY_MARGIN = "5000"
+      # How long a warm Lambda holds on to the SSM parameters (seconds)
+      PARAMETER_TTL      = "900"
+    }
+  }
 }
 
 # Attach cloudwatch logging permissions and S3 access permissions to